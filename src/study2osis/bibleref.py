@@ -2,127 +2,301 @@
     Copyright (C) 2015 Tuomas Airaksinen.
     See LICENCE.txt
 """
-from functools import wraps
+from array import array
+from bisect import bisect_right
 
-from bs4 import Tag
-
-from .bible_data import BOOKREFS, CHAPTER_LAST_VERSES, LAST_CHAPTERS
+from .bible_data import BOOKREFS, BOOK_CHAPTERS, CHAPTER_VERSES
 
 
 class IllegalReference(Exception):
     pass
 
 
-def cached_refs(cls):
-    instances = {}
+def _build_verse_table():
+    """
+        Build compact tables of all verses in NRSV versification. Each verse gets a global
+        ordinal (Gen.1.1 is 0, Rev.22.21 is the last one) so that Ref arithmetic does not need
+        any string handling.
+    """
+    verse_numbers = bytes(range(1, 256))
+    book_parts = []
+    chapter_parts = []
+    number_parts = []
+    chapter_start = []  # chapter_start[book_int][chapter - 1] -> ordinal of the first verse of chapter
+    ordinal = 0
+    chapter_verses = iter(CHAPTER_VERSES)
+    for book_int, last_chapter in enumerate(BOOK_CHAPTERS):
+        starts = []
+        for chap in range(1, last_chapter + 1):
+            starts.append(ordinal)
+            last_verse = next(chapter_verses)
+            book_parts.append(bytes((book_int,)) * last_verse)
+            chapter_parts.append(bytes((chap,)) * last_verse)
+            number_parts.append(verse_numbers[:last_verse])
+            ordinal += last_verse
+        chapter_start.append(starts)
+    return (array('B', b''.join(book_parts)), array('B', b''.join(chapter_parts)),
+            array('B', b''.join(number_parts)), chapter_start)
+
+
+VERSE_BOOK, VERSE_CHAPTER, VERSE_NUMBER, CHAPTER_START = _build_verse_table()
+VERSE_COUNT = len(VERSE_BOOK)
+BOOK_INDEX = {book: i for i, book in enumerate(BOOKREFS)}
+
+_refs_by_ordinal = [None] * VERSE_COUNT
+_refs_by_string = {}
+
+
+def ordinal_of(book, chapter, verse):
+    """
+        Global ordinal of a verse, book given either as OSIS name or as index in BOOKREFS.
+        Raises IllegalReference if verse is not in the versification.
+    """
+    try:
+        book_int = book if isinstance(book, int) else BOOK_INDEX[book]
+        chapter = int(chapter)
+        verse = int(verse)
+        starts = CHAPTER_START[book_int]
+    except (KeyError, IndexError, ValueError):
+        raise IllegalReference('%s.%s.%s' % (book, chapter, verse))
+    if not 1 <= chapter <= len(starts) or verse < 1:
+        raise IllegalReference('%s.%s.%s' % (book, chapter, verse))
+    ordinal = starts[chapter - 1] + verse - 1
+    if ordinal >= VERSE_COUNT or VERSE_CHAPTER[ordinal] != chapter or VERSE_BOOK[ordinal] != book_int:
+        raise IllegalReference('%s.%s.%s' % (book, chapter, verse))
+    return ordinal
+
+
+def _preceding_ordinal(book_int, chapter, verse):
+    """ Ordinal of the last verse in versification that precedes (book, chapter, verse) """
+    starts = CHAPTER_START[book_int]
+    if chapter < 1:
+        return starts[0] - 1
+    if chapter > len(starts):
+        return _book_end_ordinal(book_int)
+    if verse < 1:
+        return starts[chapter - 1] - 1
+    return chapter_end(book_int, chapter).ordinal
+
+
+def _book_end_ordinal(book_int):
+    if book_int + 1 < len(CHAPTER_START):
+        return CHAPTER_START[book_int + 1][0] - 1
+    return VERSE_COUNT - 1
+
+
+def chapter_end(book, chapter):
+    """ Ref to the last verse of a chapter """
+    book_int = book if isinstance(book, int) else BOOK_INDEX[book]
+    starts = CHAPTER_START[book_int]
+    if chapter < len(starts):
+        return Ref.from_ordinal(starts[chapter] - 1)
+    return Ref.from_ordinal(_book_end_ordinal(book_int))
+
+
+class Ref:
+    """
+        Verse reference. There is only one (flyweight) instance per verse, identified
+        by its ordinal, so comparisons and iteration are plain integer arithmetic.
+
+        References that do not exist in NRSV versification (for example verse numbers
+        differing between translations) are OutsideRef instances, see below.
+    """
+    __slots__ = ('ordinal', 'key', '_string')
 
-    @wraps(cls)
-    def getinstance(*args):
+    class LastVerse(Exception):
+        pass
+
+    def __new__(cls, *args):
         assert args
         if len(args) == 1:
             ref_string, = args
         else:
             ref_string = args
 
-        if isinstance(ref_string, (list, tuple)):
-            ref_string = '%s.%s.%s' % tuple(ref_string)
-        if isinstance(ref_string, Ref.orig_cls):
+        if isinstance(ref_string, Ref):
             return ref_string
-        assert isinstance(ref_string, str)
-        if ':' in ref_string:
-            ref_string = ref_string.split(':')[1]
-        if ref_string not in instances:
-            instances[ref_string] = cls(ref_string)
-        return instances[ref_string]
-
-    getinstance.orig_cls = cls
-    return getinstance
-
-
-
+        if isinstance(ref_string, (list, tuple)):
+            return _ref_from_numbers(*ref_string)
 
-@cached_refs
-class Ref:
-    class LastVerse(Exception):
-        pass
+        ref = _refs_by_string.get(ref_string)
+        if ref is None:
+            assert isinstance(ref_string, str)
+            stripped = ref_string.rsplit(':', 1)[-1] if ':' in ref_string else ref_string
+            try:
+                book, chap, verse = stripped.split('.')
+            except ValueError:
+                raise IllegalReference(ref_string)
+            ref = _refs_by_string[ref_string] = _ref_from_numbers(book, chap, verse)
+        return ref
+
+    @classmethod
+    def from_ordinal(cls, ordinal):
+        ref = _refs_by_ordinal[ordinal]
+        if ref is None:
+            ref = _refs_by_ordinal[ordinal] = object.__new__(Ref)
+            ref.ordinal = ref.key = ordinal
+            ref._string = None
+        return ref
+
+    def __reduce__(self):
+        return Ref.from_ordinal, (self.ordinal,)
 
-    def __init__(self, *args):
-        ref_string, = args
-        book, chap, verse = ref_string.split('.')
-        bookint = BOOKREFS.index(book)
-        chapint = int(chap)
-        verseint = int(verse)
-        self.numref = (bookint, chapint, verseint)
+    @property
+    def numref(self):
+        o = self.ordinal
+        return VERSE_BOOK[o], VERSE_CHAPTER[o], VERSE_NUMBER[o]
 
     @property
     def book(self):
-        return BOOKREFS[self.numref[0]]
+        return BOOKREFS[self.book_int]
 
     @property
     def book_int(self):
-        return self.numref[0]
+        return VERSE_BOOK[self.ordinal]
 
     @property
     def chapter(self):
-        return self.numref[1]
+        return VERSE_CHAPTER[self.ordinal]
 
     @property
     def verse(self):
-        return self.numref[2]
+        return VERSE_NUMBER[self.ordinal]
+
+    @property
+    def first_ordinal(self):
+        """ Ordinal of this verse or the first verse in versification after it """
+        return self.ordinal
+
+    @property
+    def last_ordinal(self):
+        """ Ordinal of this verse or the last verse in versification before it """
+        return self.ordinal
 
     def __str__(self):
-        return '%s.%s.%s' % (BOOKREFS[self.numref[0]], self.numref[1], self.numref[2])
+        s = self._string
+        if s is None:
+            s = self._string = '%s.%s.%s' % (self.book, self.chapter, self.verse)
+        return s
 
     def __hash__(self):
-        return hash(self.numref)
+        return hash(self.key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Ref):
+            return NotImplemented
+        return self.key == other.key
+
+    def __ne__(self, other):
+        if not isinstance(other, Ref):
+            return NotImplemented
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def __le__(self, other):
+        return self.key <= other.key
 
     def __gt__(self, other):
-        return self.numref > other.numref
+        return self.key > other.key
 
     def __ge__(self, other):
-        return self.numref > other.numref or self.numref == other.numref
-
-    def __eq__(self, other):
-        return self.numref == other.numref
+        return self.key >= other.key
 
     def __repr__(self):
         return 'Ref("%s")' % str(self)
 
     def __next__(self):
-        if self.verse < CHAPTER_LAST_VERSES['%s.%s' % (self.book, self.chapter)]:
-            return Ref('%s.%s.%s' % (self.book, self.chapter, self.verse + 1))
-        elif self.chapter < LAST_CHAPTERS[self.book]:
-            return Ref('%s.%s.%s' % (self.book, self.chapter + 1, 1))
-        elif self.book != 'Rev':
-            return Ref('%s.%s.%s' % (BOOKREFS[self.book_int + 1], 1, 1))
-        else:
+        o = self.last_ordinal + 1
+        if o >= VERSE_COUNT:
             raise self.LastVerse
+        return Ref.from_ordinal(o)
 
     def iter(self):
-        n = self
-        while True:
-            yield n
-            try:
-                n = next(n)
-            except self.LastVerse:
-                break
+        return _xrefrange(self, VERSE_COUNT - 1)
+
+
+class OutsideRef(Ref):
+    """
+        Reference to a verse that is not in NRSV versification. It is ordered right after
+        the preceding verse that exists, its key being that ordinal plus a fraction.
+    """
+    __slots__ = ('_numref',)
+
+    def __reduce__(self):
+        return Ref, (self.book, self.chapter, self.verse)
+
+    @property
+    def numref(self):
+        return self._numref
+
+    @property
+    def book_int(self):
+        return self._numref[0]
+
+    @property
+    def chapter(self):
+        return self._numref[1]
+
+    @property
+    def verse(self):
+        return self._numref[2]
+
+    @property
+    def first_ordinal(self):
+        return int(self.key // 1) + 1
+
+    @property
+    def last_ordinal(self):
+        return int(self.key // 1)
+
+
+_outside_refs = {}
+
+
+def _ref_from_numbers(book, chapter, verse):
+    try:
+        return Ref.from_ordinal(ordinal_of(book, chapter, verse))
+    except IllegalReference:
+        if not (isinstance(book, int) or book in BOOK_INDEX):
+            raise
+        try:
+            numref = (book if isinstance(book, int) else BOOK_INDEX[book], int(chapter), int(verse))
+        except ValueError:
+            raise IllegalReference('%s.%s.%s' % (book, chapter, verse))
+        if not (0 <= numref[1] < 1000 and 0 <= numref[2] < 1000):
+            raise
+    ref = _outside_refs.get(numref)
+    if ref is None:
+        ref = _outside_refs[numref] = object.__new__(OutsideRef)
+        ref._numref = numref
+        ref.ordinal = None
+        ref.key = _preceding_ordinal(*numref) + (numref[1] * 1000 + numref[2] + 1) / 1e7
+        ref._string = None
+    return ref
 
 
 def verses(a):
-    if isinstance(a, Tag):
+    if not isinstance(a, str):
         a = a['annotateRef']
     return sorted([Ref(i) for i in a.split(' ')])
 
 
+def _xrefrange(start, stop_ordinal):
+    if start.ordinal is None:
+        yield start
+    from_ordinal = Ref.from_ordinal
+    for o in range(start.first_ordinal, stop_ordinal + 1):
+        yield from_ordinal(o)
+
+
 def xrefrange(start, stop):
     start = Ref(start)
     stop = Ref(stop)
     if stop < start:
-        return
-    for i in start.iter():
-        if i > stop:
-            return
-        yield i
+        return iter(())
+    return _xrefrange(start, stop.last_ordinal)
 
 
 def refrange(start, stop):
@@ -136,7 +310,191 @@ def references_to_string(vs, sort=True):
         return ' '.join(str(i) for i in vs)
 
 
+class VerseSet:
+    """
+        Set of verses stored as sorted, disjoint and non-adjacent intervals of verse ordinals.
+        Large verse ranges (whole chapters or books) therefore cost only one interval.
+
+        References that are not in the versification (OutsideRef) are kept separately
+        in a (usually empty) sorted tuple.
+    """
+    __slots__ = ('starts', 'stops', 'outside')
+
+    def __init__(self, intervals=(), outside=()):
+        starts = []
+        stops = []
+        for start, stop in sorted(intervals):
+            if start > stop:
+                continue
+            if stops and start <= stops[-1] + 1:
+                if stop > stops[-1]:
+                    stops[-1] = stop
+            else:
+                starts.append(start)
+                stops.append(stop)
+        self.starts = starts
+        self.stops = stops
+        self.outside = tuple(sorted(set(outside))) if outside else ()
+
+    @classmethod
+    def from_string(cls, ref):
+        """ Parse space separated OSIS references and ranges, such as 'Gen.1.1-Gen.1.5 Gen.2.1' """
+        intervals = []
+        outside = []
+        for r in ref.split(' '):
+            if '-' in r:
+                first, last = r.split('-')
+                first = Ref(first)
+                last = Ref(last)
+                if last < first:
+                    continue
+            else:
+                first = last = Ref(r)
+            if first.ordinal is None:
+                outside.append(first)
+            intervals.append((first.first_ordinal, last.last_ordinal))
+        return cls(intervals, outside)
+
+    @classmethod
+    def from_refs(cls, refs):
+        intervals = []
+        outside = []
+        for r in refs:
+            r = Ref(r)
+            if r.ordinal is None:
+                outside.append(r)
+            else:
+                intervals.append((r.ordinal, r.ordinal))
+        return cls(intervals, outside)
+
+    @classmethod
+    def range(cls, first, last):
+        first = Ref(first)
+        last = Ref(last)
+        return cls([(first.first_ordinal, last.last_ordinal)], [first] if first.ordinal is None else ())
+
+    def _new(self, starts, stops, outside):
+        result = object.__new__(VerseSet)
+        result.starts = starts
+        result.stops = stops
+        result.outside = outside
+        return result
+
+    def intervals(self):
+        return zip(self.starts, self.stops)
+
+    def ranges(self):
+        """ Yield (first, last) Ref pairs of the collapsed ranges in order """
+        from_ordinal = Ref.from_ordinal
+        outside = self.outside
+        i = 0
+        for start, stop in zip(self.starts, self.stops):
+            while i < len(outside) and outside[i].key < start:
+                yield outside[i], outside[i]
+                i += 1
+            yield from_ordinal(start), from_ordinal(stop)
+        for r in outside[i:]:
+            yield r, r
+
+    def __iter__(self):
+        from_ordinal = Ref.from_ordinal
+        outside = self.outside
+        i = 0
+        for start, stop in zip(self.starts, self.stops):
+            while i < len(outside) and outside[i].key < start:
+                yield outside[i]
+                i += 1
+            for o in range(start, stop + 1):
+                yield from_ordinal(o)
+        yield from outside[i:]
+
+    def __len__(self):
+        return sum(self.stops) - sum(self.starts) + len(self.starts) + len(self.outside)
+
+    def __bool__(self):
+        return bool(self.starts or self.outside)
+
+    def __contains__(self, ref):
+        ref = Ref(ref)
+        o = ref.ordinal
+        if o is None:
+            return ref in self.outside
+        i = bisect_right(self.starts, o) - 1
+        return i >= 0 and o <= self.stops[i]
+
+    @property
+    def first(self):
+        candidates = []
+        if self.starts:
+            candidates.append(Ref.from_ordinal(self.starts[0]))
+        if self.outside:
+            candidates.append(self.outside[0])
+        return min(candidates)
+
+    @property
+    def last(self):
+        candidates = []
+        if self.stops:
+            candidates.append(Ref.from_ordinal(self.stops[-1]))
+        if self.outside:
+            candidates.append(self.outside[-1])
+        return max(candidates)
+
+    def __or__(self, other):
+        return VerseSet(list(self.intervals()) + list(other.intervals()), self.outside + other.outside)
+
+    union = __or__
+
+    def __sub__(self, other):
+        starts = []
+        stops = []
+        other_starts = other.starts
+        other_stops = other.stops
+        j = 0
+        for start, stop in zip(self.starts, self.stops):
+            while j < len(other_stops) and other_stops[j] < start:
+                j += 1
+            k = j
+            while start <= stop:
+                if k >= len(other_starts) or other_starts[k] > stop:
+                    starts.append(start)
+                    stops.append(stop)
+                    break
+                if other_starts[k] > start:
+                    starts.append(start)
+                    stops.append(other_starts[k] - 1)
+                start = other_stops[k] + 1
+                k += 1
+        outside = tuple(r for r in self.outside if r not in other.outside)
+        return self._new(starts, stops, outside)
+
+    difference = __sub__
+
+    def __and__(self, other):
+        return self - (self - other)
+
+    intersection = __and__
+
+    def __eq__(self, other):
+        if not isinstance(other, VerseSet):
+            return NotImplemented
+        return self.starts == other.starts and self.stops == other.stops and self.outside == other.outside
+
+    def __hash__(self):
+        return hash((tuple(self.starts), tuple(self.stops), self.outside))
+
+    def __str__(self):
+        """ Collapsed OSIS reference, such as 'Gen.1.1-Gen.1.5 Gen.2.1' """
+        return ' '.join(str(first) if first == last else '%s-%s' % (first, last) for first, last in self.ranges())
+
+    def __repr__(self):
+        return 'VerseSet("%s")' % str(self)
+
+
 def first_reference(ref):
+    if isinstance(ref, VerseSet):
+        r = ref.first
+        return (r.book, r.chapter, r.verse)
     if ' ' in ref:
         ref = ref.split(' ')[0]
     if '-' in ref:
@@ -146,6 +504,9 @@ def first_reference(ref):
 
 
 def last_reference(ref):
+    if isinstance(ref, VerseSet):
+        r = ref.last
+        return (r.book, r.chapter, r.verse)
     if ' ' in ref:
         ref = ref.split(' ')[-1]
     if '-' in ref:
@@ -154,63 +515,17 @@ def last_reference(ref):
     return (r[0], int(r[1]), int(r[2]))
 
 
-def _expand_ranges(ref):
-    """
-    Expand ranges:
-    Gen.1.1-Gen.1.3 -> Gen1.1 Gen1.2 Gen1.3
+def expand_ranges(ref, verses=False, verse_set=False):
     """
-    verselist = []
-    if ' ' in ref:
-        return ' '.join(expand_ranges(i) for i in ref.split(' '))
-
-    firstb, firstc, firstv = first_reference(ref)
-    lastb, lastc, lastv = last_reference(ref)
-
-    firstb = BOOKREFS.index(firstb)
-    lastb = BOOKREFS.index(lastb)
-
-    if firstb == lastb and firstc == lastc:
-        for i in range(int(firstv), int(lastv) + 1):
-            verselist.append((BOOKREFS[firstb], firstc, i))
-    else:
-        # rest of first chapter
-        book_id = firstb
-        book = BOOKREFS[book_id]
-        for verse in range(firstv, CHAPTER_LAST_VERSES['%s.%s' % (book, firstc)] + 1):
-            verselist.append((book, firstc, verse))
-
-        if firstc == LAST_CHAPTERS[book]:
-            book_id = firstb + 1
-
-        # full chapters
-        for book_id1 in range(book_id, lastb + 1):
-            book = BOOKREFS[book_id1]
-            if book_id1 == lastb:
-                if firstb != lastb:
-                    first_chap = 1
-                else:
-                    first_chap = firstc + 1
-                last_chap = lastc
-            else:
-                first_chap = firstc + 1
-                last_chap = LAST_CHAPTERS[book]
+        Expand ranges:
+        Gen.1.1-Gen.1.3 -> Gen1.1 Gen1.2 Gen1.3
 
-            for chap in range(first_chap, last_chap + 1):
-                if book_id1 == lastb and chap == lastc:
-                    last_verse = lastv
-                else:
-                    last_verse = CHAPTER_LAST_VERSES['%s.%s' % (book, chap)]
-                for verse in range(1, last_verse + 1):
-                    verselist.append((book, chap, verse))
-
-    result = ' '.join('%s.%s.%s' % i for i in verselist)
-    return result
-
-
-def expand_ranges(ref, verses=False):
-    """ Make sure that expanded ranges are also sorted propertly"""
-    r = _expand_ranges(ref)
+        Results are sorted and each verse is listed only once. With verse_set=True, returns
+        VerseSet without enumerating the verses at all; with verses=True, list of Refs.
+    """
+    vs = VerseSet.from_string(ref)
+    if verse_set:
+        return vs
     if verses:
-        return sorted([Ref(i) for i in set(r.split(' '))])
-    else:
-        return ' '.join(str(j) for j in sorted([Ref(i) for i in set(r.split(' '))]))
+        return list(vs)
+    return ' '.join(str(i) for i in vs)
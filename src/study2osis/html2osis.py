@@ -8,14 +8,24 @@
 
 import logging
 import re
-
-from bs4 import NavigableString
+import sys
 
 logger = logging.getLogger('html2osis')
 
 from .bible_data import BOOKREFS
 from .bibleref import IllegalReference, first_reference, Ref
 
+_STUDYBIBLE_ID = re.compile(r'^[vn](\d{8}[abc]?(?:[-.]\d{8}[abc]?)*)$')
+_STUDYBIBLE_VERSE = re.compile(r'(\d\d)(\d\d\d)(\d\d\d)[abc]?')
+
+_studybible_references = {'n36002012-outline': 'Zeph.2.12'}  # exception found in ESV Study bible epub!
+
+
+def _osis_verse(match):
+    book, chap, ver = match.groups()
+    return '{}.{}.{}'.format(BOOKREFS[int(book) - 1], int(chap), int(ver))
+
+
 def parse_studybible_reference(html_id):
     """
         Takes studybibles reference html_id, which is in the following formats:
@@ -24,170 +34,177 @@ def parse_studybible_reference(html_id):
             'nBBCCCVVV-BBCCCVVV' (verse range defined)
             'nBBCCCVVV-BBCCCVVV BBCCCVVV-BBCCCVVV BBCCCVVV' (multiple verses/ranges defined)
 
-        Returns OSIS reference.
+        Returns OSIS reference. Results are memoized by html_id, as the same ids
+        are linked from many places.
 
     """
-
-    if html_id == 'n36002012-outline':  # exception found in ESV Study bible epub!
-        return 'Zeph.2.12'
-
-    if html_id[0] not in 'vn':
-        raise IllegalReference
-
-    html_id = html_id[1:]  # remove first letter
-
-    if '.' in html_id:
-        individual_refs = html_id.split('.')
-    else:
-        individual_refs = [html_id]
-
-    result = []
-    for iref in individual_refs:
-        if '-' in iref:
-            range_refs = iref.split('-')
+    try:
+        result = _studybible_references[html_id]
+    except KeyError:
+        m = _STUDYBIBLE_ID.match(html_id)
+        if m:
+            result = _STUDYBIBLE_VERSE.sub(_osis_verse, m.group(1).replace('.', ' '))
         else:
-            range_refs = [iref]
-
-        refs = []
-        for p in range_refs:
-            if len(p) == 9 and p[-1] in 'abc':
-                p = p[:-1]
-
-            if len(p) != 8:
-                raise IllegalReference
-            if p:
-                book = BOOKREFS[int(p[:2]) - 1]
-                chap = int(p[2:5])
-                ver = int(p[5:])
-                osisref = '{}.{}.{}'.format(book, chap, ver)
-                refs.append(osisref)
+            result = None
+        _studybible_references[html_id] = result
 
-        result.append('-'.join(refs))
-    return ' '.join(result)
+    if result is None:
+        raise IllegalReference(html_id)
+    return result
 
 
-class HTML2OsisMixin(object):
+def studybible_ref(html_id):
     """
-        HTML to OSIS fixes
+        Like parse_studybible_reference, but returns Ref (html_id must point to a single verse)
     """
+    return Ref(parse_studybible_reference(html_id))
+
+
+# Link text forms that are recognized by guess_range_end, tried in this order.
+# Placeholders: {c} start chapter, {v} start verse, {C} end chapter, {V} end verse.
+# Start chapter and verse must agree with the link target, end fields give the range end.
+# Forms marked as chapter links require link target to be the first verse of the chapter.
+_LINK_TEXT_FORMS = [
+    # (regex, chapter link)
+    (r'\d+[a-e]', False),  # '1a', (must be verse)
+    (r'\d+', False),  # '1', can mean either chapter or verse
+    (r'(?:Chapter|ch\.) {c}', True),  # 'Chapter 1', 'ch. 1'
+    (r'(?:Chapters|chs\.) {c}-\d+', True),  # 'chs. 1-2'
+    (r'\d+-\d+', False),  # '1-3', can mean either chapter or verse
+    (r'(?:v\.|Verse) {v}[a-e]?', False),  # 'v. 1'
+    (r'{c}:{v}[a-e]?', False),  # '1:1'
+    (r'vv\.? {v}[a-e]?', False),  # 'vv. 1'
+    (r'vv\.? {v}[a-e]?-{V}[a-e]?', False),  # 'vv. 1-3'
+    (r'{c}:{v}[a-e]?-{V}[a-e]?', False),  # '1:1-3'
+    (r'{c}:{v}[a-e]?-{C}:{V}[a-e]?', False),  # '11:1-12:10'
+    (r'[\w \.]+ {c}:{v}[a-e]?-{V}[a-e]?', False),  # 'Isa. 11:1-10'
+    (r'[\w \.]+ {c}:{v}[a-e]?-{C}:{V}[a-e]?', False),  # 'Isa. 11:1-12:10'
+]
+
+# There are many other (not so common) cases too, for example
+#   'Jude 1', 'Matt 1:1', 'Matt. 1-2', 'Matt. 1'
+# Let's handle the more common ones only.
+
+
+def _compile_link_text_forms():
+    alternatives = []
+    fields = {}
+    for idx, (regex, chapter_link) in enumerate(_LINK_TEXT_FORMS):
+        name = 'f%d' % idx
+        groups = {f: '%s_%s' % (name, f.lower() + ('_end' if f.isupper() else '')) for f in 'cvCV'}
+        alternatives.append('(?P<%s>%s)' % (name, regex.format(**{f: r'(?P<%s>\d+)' % g for f, g in groups.items()})))
+        fields[name] = ({f: g for f, g in groups.items() if '{%s}' % f in regex}, chapter_link)
+    return re.compile('^(?:%s)$' % '|'.join(alternatives)), fields
+
+_LINK_TEXT, _LINK_TEXT_FIELDS = _compile_link_text_forms()
+
+_range_ends = {}
+
+
+class _Conflict(str):
+    """ Cached message of AssertionError of _guess_range_end """
+
+
+def guess_range_end(ref, link_text):
+    """
+        Guess end of the verse range of link pointing to ref from the link text.
+        Returns Ref or None, if link text does not tell range end. Raises
+        AssertionError if link text is in conflict with ref.
 
-    def _guess_range_end(self, ref, link_tag):
-        """
-            This is not an easy task to implement robustly such that all cases are
-            handled, but at least certain clear cases can be easily done.
-        """
-        tag_content = link_tag.text.strip().replace('–', '-')
+        This is not an easy task to implement robustly such that all cases are
+        handled, but at least certain clear cases can be easily done.
+    """
+    key = (ref, link_text)
+    try:
+        result = _range_ends[key]
+    except KeyError:
+        try:
+            result = _guess_range_end(ref, link_text)
+        except AssertionError as e:
+            # exception instance is not cached: raising it again would grow its traceback
+            _range_ends[key] = _Conflict(e)
+            raise
+        _range_ends[key] = result
 
-        m = re.match(r'^(\d+)[a-e]$', tag_content) # '1', (must be verse)
-        if m:
-            return None
+    if isinstance(result, _Conflict):
+        raise AssertionError(str(result))
+    return result
 
-        m = re.match(r'^(\d+)$', tag_content) # '1', can mean either chapter or verse
-        if m:
-            return None
 
-        m = re.match(r'^(Chapter|ch\.) (\d+)$', tag_content) # 'Chapter 1', 'ch. 1'
-        if m:
-            startchap, = (int(i) for i in m.groups()[1:])
-            assert startchap == ref.chapter
-            assert ref.verse == 1
-            return None
+def _guess_range_end(ref, link_text):
+    m = _LINK_TEXT.match(link_text.strip().replace('–', '-'))
+    if not m:
+        return None
 
+    fields, chapter_link = _LINK_TEXT_FIELDS[m.lastgroup]
+    numbers = {f: int(m.group(g)) for f, g in fields.items()}
+    if 'c' in numbers:
+        assert numbers['c'] == ref.chapter
+    if chapter_link:
+        assert ref.verse == 1
+    if 'v' in numbers:
+        assert numbers['v'] == ref.verse
+    if 'V' in numbers:
+        return Ref(ref.book, numbers.get('C', ref.chapter), numbers['V'])
+    return None
 
-        m = re.match(r'^(Chapters|chs\.) (\d+)-(\d+)$', tag_content) # 'chs. 1-2'
-        if m:
-            startchap, endchap = (int(i) for i in m.groups()[1:])
-            assert startchap == ref.chapter
-            assert ref.verse == 1
-            return None
 
-        m = re.match(r'^(\d+)-(\d+)$', tag_content) # '1-3', can mean either chapter or verse
-        if m:
-            return None
-
-        m = re.match(r'^(v\.|Verse) (\d+)[a-e]?$', tag_content) # 'v. 1'
-        if m:
-            startver, = (int(i) for i in m.groups()[1:])
-            assert startver == ref.verse
-            return None
+class TagData(object):
+    """
+        Temporary data of tags that is needed only during conversion (origFile, postpone,
+        unwrap etc.). It is kept here, keyed by tag identity, instead of tag attributes,
+        so it never needs to be cleaned away from the output.
+    """
+    FLAGS = frozenset(['postpone', 'unwrap', 'wrap', 'new_empty', 'h3', 'move_to_first_verse'])
+    FIELDS = FLAGS | frozenset(['origFile', 'origRef', 'joined_from', 'old_name'])
 
-        m = re.match(r'^(\d+):(\d+)[a-e]?$', tag_content) # '1:1'
-        if m:
-            startchap, startver = (int(i) for i in  m.groups())
-            assert startchap == ref.chapter
-            assert startver == ref.verse
-            return None
+    def __init__(self):
+        # id(tag) -> (tag, fields). Tag is stored too, so that its id is not reused.
+        self._data = {}
 
-        m = re.match(r'^vv\.? (\d+)[a-e]?$', tag_content) # 'vv. 1'
-        if m:
-            startver, = (int(i) for i in  m.groups())
-            assert startver == ref.verse
-            return None
+    def set(self, tag, **fields):
+        item = self._data.get(id(tag))
+        if item is None:
+            self._data[id(tag)] = (tag, fields)
+        else:
+            item[1].update(fields)
 
-        m = re.match(r'^vv\.? (\d+)[a-e]?-(\d+)[a-e]?$', tag_content) # 'vv. 1-3'
-        if m:
-            startver, endver = (int(i) for i in  m.groups())
-            assert startver == ref.verse
-            return Ref(ref.book, ref.chapter, endver)
+    def get(self, tag, field, default=None):
+        item = self._data.get(id(tag))
+        if item is None:
+            return default
+        return item[1].get(field, default)
 
-        m = re.match(r'^(\d+):(\d+)[a-e]?-(\d+)[a-e]?$', tag_content) # '1:1-3'
-        if m:
-            startchap, startver, endver = (int(i) for i in  m.groups())
-            assert startchap == ref.chapter
-            assert startver == ref.verse
-            return Ref(ref.book, ref.chapter, endver)
+    def to_attributes(self, soup):
+        """
+            Write data of the tags in soup into their attributes, so that soup can be
+            passed as a string (see Commentary._map_files)
+        """
+        for tag in soup.find_all():
+            item = self._data.get(id(tag))
+            if item is not None:
+                for field, value in item[1].items():
+                    tag[field] = '1' if value is True else value
 
-        m = re.match(r'^(\d+):(\d+)[a-e]?-(\d+):(\d+)[a-e]?$', tag_content) # '11:1-12:10'
-        if m:
-            startchap, startver, endchap, endver = (int(i) for i in  m.groups())
-            assert startchap == ref.chapter
-            assert startver == ref.verse
-            return Ref(ref.book, endchap, endver)
+    def from_attributes(self, soup):
+        """
+            Reverse of to_attributes
+        """
+        for tag in soup.find_all():
+            fields = tag.attrs.keys() & self.FIELDS
+            if fields:
+                self.set(tag, **{f: True if f in self.FLAGS else sys.intern(tag[f]) for f in fields})
+                for f in fields:
+                    del tag[f]
 
 
-        m = re.match(r'^[\w \.]+ (\d+):(\d+)[a-e]?-(\d+)[a-e]?$', tag_content) # 'Isa. 11:1-10'
-        if m:
-            startchap, startver, endver = (int(i) for i in  m.groups())
-            assert startchap == ref.chapter
-            assert startver == ref.verse
-            return Ref(ref.book, ref.chapter, endver)
+class HTML2OsisMixin(object):
+    """
+        HTML to OSIS fixes
+    """
 
-        m = re.match(r'^[\w \.]+ (\d+):(\d+)[a-e]?-(\d+):(\d+)[a-e]?$', tag_content) # 'Isa. 11:1-12:10'
-        if m:
-            startchap, startver, endchap, endver = (int(i) for i in  m.groups())
-            assert startchap == ref.chapter
-            assert startver == ref.verse
-            return Ref(ref.book, endchap, endver)
-
-#        m = re.match(r'^(Philem|2 John|Jude) (\d+)$', tag_content) # 'Jude 1 (jude 1:1)
-#        if m:
-#            startver, = (int(i) for i in m.groups()[1:])
-#            assert startver == ref.verse
-#            return None
-#
-#        m = re.match(r'^[\w \.]+ (\d+):(\d+)[a-e]?$', tag_content) # 'Matt 1:1'
-#        if m:
-#            startchap, startver = (int(i) for i in  m.groups())
-#            assert startchap == ref.chapter
-#            assert startver == ref.verse
-#            return None
-#
-#        m = re.match(r'^([\w \.]+) (\d+)-(\d+)$', tag_content) # 'Matt. 1-2
-#        if m:
-#            startchap, endchap = (int(i) for i in m.groups()[1:])
-#            assert startchap == ref.chapter
-#            assert ref.verse == 1
-#            return None
-#
-#        m = re.match(r'^([\w \.]+) (\d+)$', tag_content) # 'Matt. 1
-#        if m:
-#            startchap, = (int(i) for i in m.groups()[1:])
-#            assert startchap == ref.chapter
-#            assert ref.verse == 1
-#            return None
-
-        # There are many other (not so common) cases too. Let's handle these more common ones only.
-        return None
+    def _guess_range_end(self, ref, link_tag):
+        return guess_range_end(ref, link_tag.text)
 
     def _try_to_get_range(self, ref, linktag):
         endref = None
@@ -201,326 +218,475 @@ class HTML2OsisMixin(object):
         else:
             return '%s'%ref
 
-    def _fix_bibleref_links(self, input_soup):
-        for a in input_soup.find_all('a'):
-            if a['href'].startswith('http'):
-                continue
-            a.name = 'reference'
-            url = a['href']
-            if '#' in url:
-                filename, verserange = url.split('#')
-            else:
-                filename = url
-                verserange = ''
-            ref = None
-            if filename.endswith('text.xhtml'):
-                ref = parse_studybible_reference(verserange)
-                ref = self._try_to_get_range(Ref(ref), a)
-                if self.options.bible_work_id != 'None':
-                    ref = '%s:%s' % (self.options.bible_work_id, ref)
-
-            elif filename.endswith('studynotes.xhtml'):
-                try:
-                    ref = '%s:%s' % (self.options.commentary_work_id, parse_studybible_reference(verserange))
-                except IllegalReference:
-                    a['postpone'] = '1'
-                    a['origRef'] = a['href']
-            elif any([filename.endswith(i) for i in ['footnotes.xhtml', 'main.xhtml', 'preferences.xhtml']]):
-                logger.warning('Link not handled %s, %s', filename, a.text)
-                a.replace_with('[%s]' % a.text)
-            elif any([filename.endswith(i) for i in ['intros.xhtml', 'resources.xhtml']]):
-                a['postpone'] = '1'
-                a['origRef'] = a['href']
-            else:
-                logger.error('Link not handled %s, %s', filename, a.text)
-                a.replace_with('[%s]' % a.text)
-
-            if ref:
-                a['osisRef'] = ref
-                # Ugly (hopefully temporary) and bible hack to show link content
-                # a.insert_before(a.text + ' (')
-                # a.insert_after(')')
-            del a['href']
-            if 'onclick' in a.attrs:
-                del a['onclick']
-
-    def _fix_text_tags(self, input_soup):
-
-        self._fix_bibleref_links(input_soup)
-
-        for s in input_soup.find_all():
-            if s.name == 'small':
-                # remove BOOK - NOTE ON XXX from studynotes
-                if 'NOTE ON' in s.text:
-                    s.extract()
-                elif 'online at' in s.text or 'ESV' == s.text:
-                    s['unwrap'] = '1'
-                elif s.text in ['A.D.', 'B.C.', 'A.M.', 'P.M.', 'KJV']:
-                    s.replace_with(s.text)
-                else:
-                    s.replace_with(s.text)
-                    logger.error('still some unhandled small %s', s)
-
-            # replace bolded strings
-            elif s.name == 'strong':
-                s.name = 'hi'
-                s['type'] = 'bold'
+    def _fix_bibleref_link(self, a):
+        """
+            Convert link into OSIS reference. Returns True if link was replaced by text.
+        """
+        if a['href'].startswith('http'):
+            return False
+        a.name = 'reference'
+        url = a['href']
+        if '#' in url:
+            filename, verserange = url.split('#')
+        else:
+            filename = url
+            verserange = ''
+        ref = None
+        replaced = False
+        if filename.endswith('text.xhtml'):
+            ref = self._try_to_get_range(studybible_ref(verserange), a)
+            if self.options.bible_work_id != 'None':
+                ref = '%s:%s' % (self.options.bible_work_id, ref)
+
+        elif filename.endswith('studynotes.xhtml'):
+            try:
+                ref = '%s:%s' % (self.options.commentary_work_id, parse_studybible_reference(verserange))
+            except IllegalReference:
+                self.tag_data.set(a, postpone=True, origRef=a['href'])
+        elif any([filename.endswith(i) for i in ['footnotes.xhtml', 'main.xhtml', 'preferences.xhtml']]):
+            logger.warning('Link not handled %s, %s', filename, a.text)
+            a.replace_with('[%s]' % a.text)
+            replaced = True
+        elif any([filename.endswith(i) for i in ['intros.xhtml', 'resources.xhtml']]):
+            self.tag_data.set(a, postpone=True, origRef=a['href'])
+        else:
+            logger.error('Link not handled %s, %s', filename, a.text)
+            a.replace_with('[%s]' % a.text)
+            replaced = True
+
+        if ref:
+            a['osisRef'] = ref
+            # Ugly (hopefully temporary) and bible hack to show link content
+            # a.insert_before(a.text + ' (')
+            # a.insert_after(')')
+        del a['href']
+        if 'onclick' in a.attrs:
+            del a['onclick']
+        return replaced
+
+    # Tag fixes, in groups. Each group maps a tag name to a handler method (with its
+    # arguments) and corresponds to a pass over the tree in the original implementation.
+    # _fix_tags does all requested groups in a single traversal; if a tag has handlers in
+    # several groups, they are applied in group order as long as tag keeps its name.
+
+    TEXT_FIXES = {
+        'small': ('_fix_small',),
+        'strong': ('_rename_tag', 'hi', (('type', 'bold'),)),
+        'sup': ('_rename_tag', 'hi', (('type', 'super'),)),
+        'h4': ('_fix_h4_h5',),
+        'h5': ('_fix_h4_h5',),
+        'ol': ('_rename_tag', 'list', ()),
+        'ul': ('_rename_tag', 'list', ()),
+        'br': ('_rename_tag', 'lb', ()),
+        # some tags that can be completely unwrapped
+        'blockquote': ('_mark_unwrap',),
+        'hr': ('_mark_unwrap',),
+        'colgroup': ('_mark_unwrap',),
+        'col': ('_mark_unwrap',),
+        'li': ('_rename_tag', 'item', ()),
+        'p': ('_fix_glossary_word',),
+        # replace italic strings
+        'i': ('_rename_tag', 'hi', (('type', 'italic'),)),
+        'cite': ('_rename_tag', 'hi', (('type', 'italic'),)),
+        # replace emphasized strings
+        'em': ('_rename_tag', 'hi', (('type', 'bold'),)),
+        'span': ('_fix_span',),
+    }
+
+    TABLE_FIXES = {
+        'tr': ('_rename_tag', 'row', ()),
+        'th': ('_rename_tag', 'cell', (('role', 'label'),)),
+        'td': ('_rename_tag', 'cell', ()),
+        'h3': ('_fix_title',),
+        'p': ('_rename_tag', 'div', (('type', 'paragraph'),)),
+    }
+
+    IMAGE_FIXES = {
+        'img': ('_fix_image',),
+    }
+
+    FACT_FIXES = {
+        'h2': ('_fix_title',),
+    }
+
+    SPAN_FIXES = {
+        # replace smallcaps
+        'smallcap': ('_fix_divine_name',),
+        'small-caps': ('_fix_divine_name',),
+        'divine-name': ('_fix_divine_name',),
+
+        # find outline-1 ('title' studynote covering verse range)
+        # find outline-2 (bigger studynote title, verse range highlighted)
+        # find outline-3 (smaller studynote title, verse range not highlighted)
+        # find outline-4 (even smaller studynote title, verse range not highlighted)
+        'outline-1': ('_fix_outline',),
+        'outline-2': ('_fix_outline',),
+        'outline-3': ('_fix_outline',),
+        'outline-4': ('_fix_outline',),
+
+        # find esv font definitions
+        'bible-version': ('_fix_bible_version',),
+        'h3-inline': ('_rename_tag', 'hi', (('type', 'bold'),)),
+        'initial': ('_rename_tag', 'hi', (('type', 'bold'),)),
+        'profile-lead': ('_rename_tag', 'hi', (('type', 'bold'),)),
+        'facts-lead': ('_rename_tag', 'hi', (('type', 'bold'),)),
+        'crossref-letter': ('_fix_crossref_letter',),
+        'underline': ('_rename_tag', 'hi', (('type', 'underline'),)),
+    }
+    for cls in ['good-king', 'mixture-king', 'bad-king', 'normal', 'smaller',
+                'hebrew', 'paleo-hebrew-unicode', 'major-prophet', 'minor-prophet',
+                'footnote', 'crossref', 'contributor-country', 'time', 'crossref-verse', None]:
+        SPAN_FIXES[cls] = ('_mark_unwrap',)
+    del cls
+
+    _tag_fixers = {}
+
+    @classmethod
+    def _get_tag_fixers(cls, groups):
+        key = tuple(id(g) for g in groups)
+        fixers = cls._tag_fixers.get(key)
+        if fixers is None:
+            fixers = {}
+            for group in groups:
+                for name, (method, *args) in group.items():
+                    fixers.setdefault(name, []).append((getattr(cls, method), args))
+            cls._tag_fixers[key] = fixers
+        return fixers
+
+    def _fix_tags(self, soup, *groups):
+        """
+            Apply fix groups (TEXT_FIXES etc.) to all tags inside soup, in a single traversal.
 
-            elif s.name == 'sup':
+            Tags are collected first (links are fixed while collecting, as they were fixed before
+            other text fixes), so that the fixes, that move and remove tags, do not affect which
+            tags are processed.
+        """
+        from bs4 import Tag
+
+        text = any(g is self.TEXT_FIXES for g in groups)
+        tables = any(g is self.TABLE_FIXES for g in groups)
+
+        tags = []
+        has_spans = False
+        stack = [c for c in reversed(soup.contents) if isinstance(c, Tag)]
+        while stack:
+            tag = stack.pop()
+            name = tag.name
+            if name == 'a' and text:
+                if self._fix_bibleref_link(tag):
+                    continue
+            elif name in ('td', 'th') and tables and ('colspan' in tag.attrs or 'rowspan' in tag.attrs):
+                has_spans = True
+            tags.append(tag)
+            stack.extend(c for c in reversed(tag.contents) if isinstance(c, Tag))
+
+        fixers = self._get_tag_fixers(groups)
+        cells_first = False
+        if has_spans:
+            # Inserting empty cells needs tables with original td's (see normalize_table),
+            # so table cells are fixed separately, in the original order.
+            cells_first = groups.index(self.TABLE_FIXES) < groups.index(self.TEXT_FIXES) if text else True
+            fixers = {name: f for name, f in fixers.items() if name not in ['tr', 'th', 'td']}
+            if cells_first:
+                self.normalize_table(soup)
+
+        for tag in tags:
+            name = tag.name
+            for method, args in fixers.get(name, ()):
+                if tag.name != name:
+                    break
+                method(self, tag, *args)
+
+        if has_spans and not cells_first:
+            self.normalize_table(soup)
+
+        if text:
+            # find all hi's without content and remove them
+            for tag in [t for t in tags if t.name == 'hi' and not t.contents]:
+                tag.extract()
+
+    def _rename_tag(self, tag, name, attrs):
+        tag.name = name
+        for key, value in attrs:
+            tag[key] = value
+
+    def _mark_unwrap(self, tag):
+        self.tag_data.set(tag, unwrap=True)
+
+    def _fix_title(self, tag):
+        tag.name = 'title'
+        self.tag_data.set(tag, origFile=self.current_filename)
+
+    def _fix_small(self, s):
+        text = s.text
+        # remove BOOK - NOTE ON XXX from studynotes
+        if 'NOTE ON' in text:
+            s.extract()
+        elif 'online at' in text or 'ESV' == text:
+            self.tag_data.set(s, unwrap=True)
+        elif text in ['A.D.', 'B.C.', 'A.M.', 'P.M.', 'KJV']:
+            s.replace_with(text)
+        else:
+            s.replace_with(text)
+            logger.error('still some unhandled small %s', s)
+
+    def _fix_h4_h5(self, s):
+        logger.warning('h4 or h5 tag used: %s', s)
+        s.name = 'title'
+
+    def _fix_glossary_word(self, s):
+        if s.attrs.get('class', '') == 'glossary-word':
+            s.name = 'title'
+            s.find_next_sibling('p', class_='glossary-entry').insert(0, s.extract())
+
+    def _fix_span(self, s):
+        cls = s.attrs.get('class')
+        fix = self.SPAN_FIXES.get(cls)
+        if fix:
+            method, *args = fix
+            getattr(self, method)(s, *args)
+        else:
+            logger.warning('Span class not known %s, in %s', cls, s)
+            self.tag_data.set(s, unwrap=True)
+
+    def _fix_divine_name(self, s):
+        from bs4 import NavigableString
+
+        s.name = 'divineName'
+        text = s.text
+        if text == text.upper():
+            text = text.lower()
+            s.string = text
+        p = s.previous_element
+        if not isinstance(p, NavigableString):
+            logger.error('Erroneous smallcaps: %s', p)
+        else:
+            if text == 'ord' and p[-1] == 'L':
+                p.replace_with(p[:-1])
+                s.string = 'Lord'
+            elif text == 'od' and p[-1] == 'G':
+                p.replace_with(p[:-1])
+                s.string = 'God'
+            elif text == 'am' and p[-2:] == 'I ':
+                p.replace_with(p[:-2])
+                s.string = 'I am'
+            elif text == 'am who' and p[-2:] == 'I ':
+                p.replace_with(p[:-2])
+                s.string = 'I am who'
+            else:
                 s.name = 'hi'
-                s['type'] = 'super'
-
-            elif s.name in ['h4', 'h5']:
-                logger.warning('h4 or h5 tag used: %s', s)
-                s.name = 'title'
-            # s.name = 'div'
-            #    s['type'] = 'paragraph'
-
-            elif s.name in ['ol', 'ul']:
-                s.name = 'list'
-
-            elif s.name == 'br':
-                s.name = 'lb'
-
-            # some tags that can be completely unwrapped
-            elif s.name in ['blockquote', 'hr', 'colgroup', 'col']:
-                s['unwrap'] = '1'
-
-            elif s.name == 'li':
-                s.name = 'item'
+                s['type'] = 'small-caps'
+                logger.warning('SMALLCAPS that was not recognized %s ::: %s', s.previous_element, s)
+
+    def _fix_outline(self, s):
+        s.name = 'hi'
+        s['type'] = 'bold'
+        new_tag = self.root_soup.new_tag('hi', type='underline')
+        s.wrap(new_tag)
+
+    def _fix_bible_version(self, s):
+        text = s.text
+        assert text.lower() in ['esv', 'lxx', 'kjv', 'mt', 'nkjv', 'nasb'], text
+        s.replace_with(text.upper())
+
+    def _fix_crossref_letter(self, s):
+        tag = self.root_soup.new_tag('hi', type='super')
+        tag.string = '%s'%s.text
+        s.replace_with(tag)
+
+    def _fix_image(self, img):
+        if self.options.images:
+            img.name = 'figure'
+            img['src'] = img['src'].replace('../Images/', self.images_path)
+            self.images.append(img['src'].split('/')[-1])
+        else:
+            img.replace_with('[figures disabled]')
 
-            elif s.name == 'p':
-                if s.attrs.get('class', '') == 'glossary-word':
-                    s.name = 'title'
-                    s.find_next_sibling('p', class_='glossary-entry').insert(0, s.extract())
+    def _fix_text_tags(self, input_soup):
+        self._fix_tags(input_soup, self.TEXT_FIXES)
 
-            # replace italic strings
-            elif s.name in ['i', 'cite']:
-                s.name = 'hi'
-                s['type'] = 'italic'
+    def normalize_table(self, soup, rowspan=True, colspan=True, rename=True):
+        """
+            Replaces rowspan=n and colspan=n with empty cells (add=1) in HTML tables inside soup.
 
-            # replace emphasized strings
-            elif s.name == 'em':
-                s.name = 'hi'
-                s['type'] = 'bold'
-
-            # replace smallcaps
-            elif s.name == 'span':
-                cls = s.attrs.get('class')
-                if cls in ['smallcap', 'small-caps', 'divine-name']:
-                    s.name = 'divineName'
-                    if s.text == s.text.upper():
-                        s.string = s.text.lower()
-                    p = s.previous_element
-                    if not isinstance(p, NavigableString):
-                        logger.error('Erroneous smallcaps: %s', p)
+            Each row group (thead, tbody, tfoot, or rows directly in table) is laid out once as
+            a grid: cells of a row are placed to the first columns that are not covered by rowspans
+            of the rows above in the same group, and each row is padded with empty cells in a single
+            pass. If rename, tr/th/td are renamed to OSIS row/cell at the same time.
+        """
+        from bs4 import Tag
+
+        cell_name = 'cell' if rename else 'td'
+        row_groups = {}  # id(parent of rows) -> rows of the row group
+        for tr in soup.find_all('tr'):
+            row_groups.setdefault(id(tr.parent), []).append(tr)
+
+        for rows in row_groups.values():
+            covered = {}  # row index -> columns covered by rowspans from the rows above
+            for row_idx, tr in enumerate(rows):
+                row_covered = covered.pop(row_idx, set())
+                contents = []
+                col = 0
+                padded = False
+                for child in tr.contents:
+                    if isinstance(child, Tag) and child.name in ('td', 'th'):
+                        while col in row_covered:
+                            contents.append(self._new_empty_cell(cell_name))
+                            col += 1
+                            padded = True
+                        width = int(child.attrs.pop('colspan') if colspan and 'colspan' in child.attrs else 1)
+                        height = int(child.attrs.pop('rowspan') if rowspan and 'rowspan' in child.attrs else 1)
+                        if rename:
+                            if child.name == 'th':
+                                child['role'] = 'label'
+                            child.name = 'cell'
+                        contents.append(child)
+                        for i in range(width - 1):
+                            contents.append(self._new_empty_cell(cell_name))
+                            padded = True
+                        for r in range(row_idx + 1, min(row_idx + height, len(rows))):
+                            covered.setdefault(r, set()).update(range(col, col + width))
+                        col += width
                     else:
-                        if s.text == 'ord' and p[-1] == 'L':
-                            p.replace_with(p[:-1])
-                            s.string = 'Lord'
-                        elif s.text == 'od' and p[-1] == 'G':
-                            p.replace_with(p[:-1])
-                            s.string = 'God'
-                        elif s.text == 'am' and p[-2:] == 'I ':
-                            p.replace_with(p[:-2])
-                            s.string = 'I am'
-                        elif s.text == 'am who' and p[-2:] == 'I ':
-                            p.replace_with(p[:-2])
-                            s.string = 'I am who'
-                        else:
-                            s.name = 'hi'
-                            s['type'] = 'small-caps'
-                            logger.warning('SMALLCAPS that was not recognized %s ::: %s', s.previous_element, s)
-
-                # find outline-1 ('title' studynote covering verse range)
-                # find outline-2 (bigger studynote title, verse range highlighted)
-                # find outline-3 (smaller studynote title, verse range not highlighted)
-                # find outline-4 (even smaller studynote title, verse range not highlighted)
-
-                elif cls in ['outline-%s' % i for i in range(1, 5)]:
-                    s.name = 'hi'
-                    s['type'] = 'bold'
-                    new_tag = self.root_soup.new_tag('hi', type='underline')
-                    s.wrap(new_tag)
-
-                # find esv font definitions
-                elif cls == 'bible-version':
-                    assert s.text.lower() in ['esv', 'lxx', 'kjv', 'mt', 'nkjv', 'nasb'], s.text
-                    s.replace_with(s.text.upper())
-                elif cls in ['h3-inline', 'initial', 'profile-lead', 'facts-lead']:
-                    s.name = 'hi'
-                    s['type'] = 'bold'
-                elif cls in ['good-king', 'mixture-king', 'bad-king', 'normal', 'smaller',
-                             'hebrew', 'paleo-hebrew-unicode', 'major-prophet', 'minor-prophet',
-                             'footnote', 'crossref', 'contributor-country', 'time', 'crossref-verse', None]:
-                    s['unwrap'] = '1'
-                elif cls in ['crossref-letter']:
-                    tag = self.root_soup.new_tag('hi', type='super')
-                    tag.string = '%s'%s.text
-                    s.replace_with(tag)
-                elif cls in ['underline']:
-                    s.name = 'hi'
-                    s['type'] = 'underline'
-                else:
-                    logger.warning('Span class not known %s, in %s', cls, s)
-                    s['unwrap'] = '1'
-
-        # find all hi's without content and remove them
-        for s in input_soup.find_all('hi'):
-            if len(s) == 0:
-                s.extract()
+                        contents.append(child)
+                if row_covered and col <= max(row_covered):
+                    for i in range(col, max(row_covered) + 1):
+                        contents.append(self._new_empty_cell(cell_name))
+                    padded = True
+                if padded:
+                    tr.clear()
+                    tr.extend(contents)
+                if rename:
+                    tr.name = 'row'
+
+    def _new_empty_cell(self, name):
+        cell = self.root_soup.new_tag(name, add=1)
+        cell.string = ' '
+        return cell
 
     def fix_table_rowspan(self, table):
         """
             Replaces rowspan=n with empty <td>'s in HTML table
         """
-        for td in table.find_all('td', rowspan=True):
-            rowspan = int(td['rowspan'])
-            del td.attrs['rowspan']
-            par_tr = td.parent
-            idx = len(td.find_previous_siblings('td'))
-            count = 1
-            for tr in par_tr.find_next_siblings('tr'):
-                n_td = self.root_soup.new_tag('td', add=1)
-                n_td.string = ' '
-                tr.insert(idx,n_td)
-                count += 1
-                if count > rowspan - 1:
-                    break
+        self.normalize_table(table, colspan=False, rename=False)
 
     def fix_table_colspan(self, table):
         """
             Replaces colspan=n with empty <td>'s in HTML table
         """
-        for td in table.find_all('td', colspan=True):
-            colspan = int(td['colspan'])
-            del td.attrs['colspan']
-            for i in range(colspan-1):
-                n_td = self.root_soup.new_tag('td', add=1)
-                n_td.string = ' '
-                td.insert_after(n_td)
-
+        self.normalize_table(table, rowspan=False, rename=False)
 
     def _fix_table(self, table_div):
-        self.fix_table_colspan(table_div)
-        self.fix_table_rowspan(table_div)
-
-        for n in table_div.find_all('tr'):
-            n.name = 'row'
-        for n in table_div.find_all('th'):
-            n.name = 'cell'
-            n['role'] = 'label'
-        for n in table_div.find_all('td'):
-            n.name = 'cell'
-        for p in table_div.find_all('h3'):
-            p.name = 'title'
-            p['origFile'] = self.current_filename
-
-        for p in table_div.find_all('p'):
-            p.name = 'div'
-            p['type'] = 'paragraph'
+        self._fix_tags(table_div, self.TABLE_FIXES)
 
     def _fix_figure_and_table(self, img_div):
-        self._fix_table(img_div)
-        for img in img_div.find_all('img'):
-            if self.options.images:
-                img.name = 'figure'
-                img['src'] = img['src'].replace('../Images/', self.images_path)
-                self.images.append(img['src'].split('/')[-1])
-            else:
-                img.replace_with('[figures disabled]')
+        self._fix_tags(img_div, self.TABLE_FIXES, self.IMAGE_FIXES)
 
     def _fix_fact(self, fact_div):
-        for n in fact_div.find_all('h2'):
-            n.name = 'title'
-            n['origFile'] = self.current_filename
+        self._fix_tags(fact_div, self.FACT_FIXES)
 
     def _all_fixes(self, soup):
-        self._fix_text_tags(soup)
-        self._fix_figure_and_table(soup)
-
-    def _adjust_studynotes(self):
-        for rootlevel_tag in self.osistext.find_all(recursive=False, origFile=True):
-            self.current_filename = rootlevel_tag['origFile']
-            move_to_first_verse = False
-            if rootlevel_tag.name in ['h1', 'hr']:
-                rootlevel_tag['wrap'] = '1'
-            elif rootlevel_tag.name == 'header':
-                continue
-            elif isinstance(rootlevel_tag, NavigableString):
-                assert str(rootlevel_tag).strip() == ''
-                rootlevel_tag.extract()
-                continue
-            elif rootlevel_tag.name == 'div':
-                cls = rootlevel_tag['class']
-                if cls.startswith('object '):
-                    type = cls.split(' ')[1]
-                    if type not in ['chart', 'map', 'illustration', 'diagram', 'info']:
-                        logger.error('Unknown object type')
-                    self._fix_figure_and_table(rootlevel_tag)
-                    move_to_first_verse = True
-                elif cls == 'fact':
-                    self._fix_fact(rootlevel_tag)
-                elif cls == 'profile':
-                    self._fix_fact(rootlevel_tag)
-                else:
-                    logger.error('Unknown div class %s', cls)
-            elif rootlevel_tag.name == 'p':
-                if rootlevel_tag['class'] not in ['outline-1', 'outline-3', 'outline-4', 'study-note-continue',
-                                                  'study-note']:
-                    logger.error('not handled %s', rootlevel_tag['class'])
-            elif rootlevel_tag.name == 'table':
-                rootlevel_tag = rootlevel_tag.wrap(self.root_soup.new_tag('div', type='paragraph'))
-                self._fix_table(rootlevel_tag)
-            elif rootlevel_tag.name == 'ol':
-                rootlevel_tag = rootlevel_tag.wrap(self.root_soup.new_tag('div', type='paragraph'))
-            else:
-                logger.error('Not handled %s', rootlevel_tag)
-
-            self._fix_text_tags(rootlevel_tag)
-            rootlevel_tag.name = 'div'
-            rootlevel_tag['type'] = 'paragraph'
-
-            if 'id' in rootlevel_tag.attrs:
-                try:
-                    ref = parse_studybible_reference(rootlevel_tag['id'])
-                except IllegalReference:
-                    # let's silence this single warning about 'Studynotes for *' titles, one per bible book
-                    if rootlevel_tag['id'].endswith('-studynotes') and rootlevel_tag.attrs.get('wrap') and len(list(rootlevel_tag.find_all())) == 0:
-                        pass
-                    else:
-                        logger.warning('NOT writing %s', rootlevel_tag)
-                    rootlevel_tag.extract()
-                    continue
-
-                del rootlevel_tag['id']
+        self._fix_tags(soup, self.TEXT_FIXES, self.TABLE_FIXES, self.IMAGE_FIXES)
 
-                new_div = self.root_soup.new_tag('div')
-                new_div['type'] = 'section'
-                new_div['annotateType'] = 'commentary'
-                new_div['annotateRef'] = ref
-                new_div['origFile'] = rootlevel_tag['origFile']
-                rootlevel_tag.wrap(new_div)
+    def _fix_studynote(self, rootlevel_tag):
+        """
+            Fixes for a root level tag of a studynotes file. These depend only on the tag
+            itself, so they can be done for each file separately (see Commentary.read_studynotes).
+            Tags with a verse id are wrapped in commentary divs, others are moved later in
+            _adjust_studynotes.
+        """
+        from bs4 import NavigableString
+
+        self.current_filename = self.tag_data.get(rootlevel_tag, 'origFile')
+        fixes = ()  # fixes to be done before text fixes
+        if rootlevel_tag.name in ['h1', 'hr']:
+            self.tag_data.set(rootlevel_tag, wrap=True)
+        elif rootlevel_tag.name == 'header':
+            return
+        elif isinstance(rootlevel_tag, NavigableString):
+            assert str(rootlevel_tag).strip() == ''
+            rootlevel_tag.extract()
+            return
+        elif rootlevel_tag.name == 'div':
+            cls = rootlevel_tag['class']
+            if cls.startswith('object '):
+                type = cls.split(' ')[1]
+                if type not in ['chart', 'map', 'illustration', 'diagram', 'info']:
+                    logger.error('Unknown object type')
+                fixes = (self.TABLE_FIXES, self.IMAGE_FIXES)
+                self.tag_data.set(rootlevel_tag, move_to_first_verse=True)
+            elif cls == 'fact':
+                fixes = (self.FACT_FIXES,)
+            elif cls == 'profile':
+                fixes = (self.FACT_FIXES,)
             else:
-                if move_to_first_verse:
-                    now = previous = rootlevel_tag.find_previous_sibling('div', annotateType='commentary')
-                    r = Ref(first_reference(previous['annotateRef']))
-                    chapter = r.chapter
-                    # find earliest studynote that is in this same chapter and add figure / table there
-                    while r.chapter == chapter:
-                        now = previous
-                        previous = previous.find_previous_sibling('div', annotateType='commentary')
-                        r = Ref(first_reference(previous['annotateRef']))
-                    previous = now
-                #
+                logger.error('Unknown div class %s', cls)
+        elif rootlevel_tag.name == 'p':
+            if rootlevel_tag['class'] not in ['outline-1', 'outline-3', 'outline-4', 'study-note-continue',
+                                              'study-note']:
+                logger.error('not handled %s', rootlevel_tag['class'])
+        elif rootlevel_tag.name == 'table':
+            rootlevel_tag = rootlevel_tag.wrap(self.root_soup.new_tag('div', type='paragraph'))
+            fixes = (self.TABLE_FIXES,)
+        elif rootlevel_tag.name == 'ol':
+            rootlevel_tag = rootlevel_tag.wrap(self.root_soup.new_tag('div', type='paragraph'))
+        else:
+            logger.error('Not handled %s', rootlevel_tag)
+
+        self._fix_tags(rootlevel_tag, *fixes, self.TEXT_FIXES)
+        rootlevel_tag.name = 'div'
+        rootlevel_tag['type'] = 'paragraph'
+
+        if 'id' in rootlevel_tag.attrs:
+            try:
+                ref = parse_studybible_reference(rootlevel_tag['id'])
+            except IllegalReference:
+                # let's silence this single warning about 'Studynotes for *' titles, one per bible book
+                if rootlevel_tag['id'].endswith('-studynotes') and self.tag_data.get(rootlevel_tag, 'wrap') and len(list(rootlevel_tag.find_all())) == 0:
+                    pass
                 else:
-                    previous = rootlevel_tag.find_previous_sibling('div', annotateType='commentary')
-                #                previous = rootlevel_tag.find_previous_sibling('div', annotateType='commentary')
+                    logger.warning('NOT writing %s', rootlevel_tag)
                 rootlevel_tag.extract()
-                previous.append(rootlevel_tag)
+                return
+
+            del rootlevel_tag['id']
+
+            new_div = self.root_soup.new_tag('div')
+            new_div['type'] = 'section'
+            new_div['annotateType'] = 'commentary'
+            new_div['annotateRef'] = ref
+            self.tag_data.set(new_div, origFile=self.current_filename)
+            rootlevel_tag.wrap(new_div)
+
+    def _adjust_studynotes(self, rootlevel_tags):
+        """
+            Move root level tags without verse id (fixed by _fix_studynote) into previous
+            commentary divs. Commentary divs are indexed by their first verse into
+            self.first_comments on the way.
+        """
+        previous = chapter_first = chapter = None
+        for rootlevel_tag in rootlevel_tags:
+            if rootlevel_tag.name == 'header':
+                continue
+            if rootlevel_tag.attrs.get('annotateType') == 'commentary':
+                r = Ref(first_reference(rootlevel_tag['annotateRef']))
+                self.first_comments.setdefault(r, rootlevel_tag)
+                # earliest studynote of the consecutive studynotes in this same chapter
+                if r.chapter != chapter:
+                    chapter = r.chapter
+                    chapter_first = rootlevel_tag
+                previous = rootlevel_tag
+                continue
+            if self.tag_data.get(rootlevel_tag, 'move_to_first_verse'):
+                # add figure / table to the earliest studynote that is in this same chapter
+                target = chapter_first
+            else:
+                target = previous
+            rootlevel_tag.extract()
+            target.append(rootlevel_tag)
 
     def _write_studynotes_into_osis(self, input_html):
         for n in input_html.find_all('studynote', recursive=False):
             n.name = 'div'
-            n['origFile'] = self.current_filename
+            self.tag_data.set(n, origFile=self.current_filename)
             self.osistext.append(n)
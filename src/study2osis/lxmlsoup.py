@@ -0,0 +1,141 @@
+# encoding: utf-8
+"""
+    Copyright (C) 2015 Tuomas Airaksinen.
+    See LICENCE.txt
+"""
+
+from bs4 import BeautifulSoup, Tag, NavigableString, Comment
+from bs4.element import NamespacedAttribute, XMLProcessingInstruction, Doctype
+from lxml import etree
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+XMLNS_NAMESPACE = 'http://www.w3.org/2000/xmlns/'
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+
+class _SoupBuilder(object):
+    """
+        Builds BeautifulSoup tree from a parsed lxml.etree tree.
+
+        BeautifulSoup's own lxml tree builder gets every element and every piece of text
+        via Python callbacks from lxml parser target interface, and then finds the
+        correct place for each object in the tree. Here the document is parsed by lxml
+        in C first, and each object is then linked directly to the end of the tree.
+        The resulting tree is the same as BeautifulSoup(data, 'xml', parse_only=parse_only)
+        would give. Elements not matching parse_only are not materialized at all.
+    """
+
+    def __init__(self, parse_only=None):
+        self.soup = BeautifulSoup('', 'xml')
+        self.parse_only = parse_only
+        self.last = None
+
+    def _link(self, obj, parent):
+        # as BeautifulSoup links new objects while parsing (PageElement.setup links the
+        # previous element and the previous sibling)
+        obj.setup(parent, self.last)
+        parent.contents.append(obj)
+        self.last = obj
+
+    def _allowed(self, string, parent):
+        # like in BeautifulSoup, parse_only applies only outside of the matched tags
+        return self.parse_only is None or parent is not self.soup or self.parse_only.allow_string_creation(string)
+
+    def _add_string(self, text, parent):
+        if text:
+            if not text.strip(ASCII_SPACES):
+                text = '\n' if '\n' in text else ' '
+            if self._allowed(text, parent):
+                self._link(NavigableString(text), parent)
+
+    def _add_special(self, node, parent):
+        if isinstance(node, etree._Comment):
+            obj = Comment(node.text or '')
+        elif isinstance(node, etree._ProcessingInstruction):
+            # BeautifulSoup keeps the separating space also when there is no data
+            obj = XMLProcessingInstruction('%s %s' % (node.target, node.text or ''))
+        else:
+            # entity references are resolved by the parser, so no other node types exist
+            return
+        if self._allowed(obj, parent):
+            self._link(obj, parent)
+
+    def _attrs(self, element, declarations, prefixes):
+        attrs = {}
+        for key, value in element.attrib.items():
+            if key[0] == '{':
+                namespace, key = key[1:].split('}', 1)
+                key = NamespacedAttribute(prefixes.get(namespace), key, namespace)
+            attrs[key] = value
+        for prefix, namespace in declarations:
+            attrs[NamespacedAttribute('xmlns', prefix, XMLNS_NAMESPACE)] = namespace
+        return attrs
+
+    @staticmethod
+    def _name(element, prefixes):
+        name = element.tag
+        namespace = prefix = None
+        if name[0] == '{':
+            namespace, name = name[1:].split('}', 1)
+            prefix = prefixes.get(namespace)
+        return name, namespace, prefix
+
+    def build(self, data):
+        parser = etree.XMLParser(strip_cdata=False, recover=True, resolve_entities=True)
+        root = etree.fromstring(data, parser)
+        dtd = root.getroottree().docinfo.internalDTD
+        if dtd is not None:
+            # as BeautifulSoup gets it from lxml parser (name, public id, system id)
+            doctype = Doctype.for_name_and_ids(dtd.name, dtd.external_id, dtd.system_url)
+            if self._allowed(doctype, self.soup):
+                self._link(doctype, self.soup)
+        for node in reversed(list(root.itersiblings(preceding=True))):
+            self._add_special(node, self.soup)
+
+        # prefixes: namespace -> prefix mappings in scope, one per open element that declares namespaces
+        prefixes = [{XML_NAMESPACE: 'xml'}]
+        declarations = []
+        stack = [(self.soup, False)]
+        for event, node in etree.iterwalk(root, events=('start', 'end', 'start-ns', 'comment', 'pi')):
+            if event == 'start-ns':
+                declarations.append(node)
+            elif event == 'start':
+                if declarations:
+                    scope = dict(prefixes[-1])
+                    # default namespace has prefix '' in BeautifulSoup
+                    scope.update((namespace, prefix) for prefix, namespace in declarations)
+                    prefixes.append(scope)
+                parent = stack[-1][0]
+                attrs = self._attrs(node, declarations, prefixes[-1])
+                name, namespace, prefix = self._name(node, prefixes[-1])
+                if (self.parse_only is not None and parent is self.soup
+                        and not self.parse_only.allow_tag_creation(prefix, name, attrs)):
+                    # not materialized, contents may still match
+                    tag = parent
+                else:
+                    tag = Tag(self.soup, self.soup.builder, name, namespace, prefix, attrs)
+                    self._link(tag, parent)
+                stack.append((tag, bool(declarations)))
+                declarations = []
+                self._add_string(node.text, tag)
+            elif event == 'end':
+                tag, declared = stack.pop()
+                if declared:
+                    prefixes.pop()
+                if node is not root:
+                    self._add_string(node.tail, stack[-1][0])
+            else:
+                self._add_special(node, stack[-1][0])
+                self._add_string(node.tail, stack[-1][0])
+
+        for node in root.itersiblings():
+            self._add_special(node, self.soup)
+        return self.soup
+
+
+def etree_to_soup(data, parse_only=None):
+    """
+        Parse XML data with lxml.etree and return it as BeautifulSoup tree.
+        parse_only is a SoupStrainer, as in BeautifulSoup.
+    """
+    return _SoupBuilder(parse_only).build(data)
@@ -4,6 +4,7 @@
     See LICENCE.txt
 """
 import os
+import bisect
 import zipfile
 import tempfile
 import codecs
@@ -13,13 +14,11 @@ import logging
 import time
 import re
 import optparse
+import contextlib
 
-from bs4 import BeautifulSoup
-import jinja2
-
-from .html2osis import HTML2OsisMixin, parse_studybible_reference
-from .overlapping import FixOverlappingVersesMixin, sort_tag_content
-from .bibleref import Ref
+from .html2osis import HTML2OsisMixin, TagData, studybible_ref
+from .overlapping import FixOverlappingVersesMixin, VerseMembership, sort_tag_content
+from .bibleref import Ref, OutsideRef
 
 HTML_DIRECTORY = ['OEBPS', 'Text']
 IMAGE_DIRECTORY = ['OEBPS', 'Images']
@@ -56,6 +55,10 @@ def dict_to_options(opts):
         sword=True,
         osis=False,
         no_nonadj=False,
+        overlap_resolver='intervals',
+        collapse_ranges=False,
+        parser='bs4',
+        jobs=1,
     )
     for key, value in default_options.items():
         options.setdefault(key, value)
@@ -63,6 +66,44 @@ def dict_to_options(opts):
     return options
 
 
+def make_soup(data, features='xml', parser='bs4', parse_only=None):
+    """
+        bs4 is imported only when first needed, to keep startup fast.
+
+        With parser='lxml', XML is parsed with lxml.etree and the soup is built
+        from the parsed tree (same result, but faster).
+
+        parse_only can be given as arguments of SoupStrainer (name or (name, attrs)); then
+        only the matching tags (and their contents) are materialized.
+    """
+    if parse_only is not None:
+        from bs4 import SoupStrainer
+        parse_only = SoupStrainer(*parse_only) if isinstance(parse_only, tuple) else SoupStrainer(parse_only)
+    if parser == 'lxml' and features == 'xml':
+        from .lxmlsoup import etree_to_soup
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return etree_to_soup(data, parse_only)
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(data, features, parse_only=parse_only)
+
+
+def _html_text(text):
+    """
+        Text content of (possibly escaped) HTML in text. Plain text is returned as is, it
+        would come out of the HTML parser unchanged.
+    """
+    if '<' in text or '&' in text or text[:1].isspace():
+        return make_soup(text, None).text
+    return text
+
+
+def render_template(template_filename, **context):
+    import jinja2
+    with codecs.open(template_filename, 'r', 'utf-8') as f:
+        return jinja2.Template(f.read()).render(**context)
+
+
 def fix_osis_id(osisid):
     """Remove illegal characters from osisIDs"""
     osisid = re.sub(r'[^\w]', ' ', osisid)
@@ -81,51 +122,76 @@ class AbstractStudyBible(object):
         Some common methods for Commentary and Articles
     """
 
-    def clean_tags(self):
+    KEEP_ATTRIBUTES = frozenset(['osisID', 'type', 'src', 'role', 'osisRef', 'osisWork', 'href', 'annotateRef',
+                                 'annotateType'])
+
+    def finalize(self, link_map=None):
         """
-            Finally remove all temporary/illegal attributes
+            Finally fix postponed reference links from link_map (see collect_linkmap), and
+            remove all temporary/illegal attributes. Done in a single traversal.
         """
+        from bs4 import Tag
 
-        for i in self.osistext.find_all(unwrap=True):
-            i.unwrap()
-
+        logger.info('Fixing postponed references and cleaning up tags (%s)', self.__class__.__name__)
+        unwrap = []
         attrs = set()
-        for t in self.osistext.find_all():
-            for a in list(t.attrs.keys()):
-                if a not in ['osisID', 'type', 'src', 'role', 'osisRef', 'osisWork', 'href', 'annotateRef',
-                             'annotateType']:
-                    attrs.add(a)
-                    del t[a]
+        stack = [c for c in reversed(self.osistext.contents) if isinstance(c, Tag)]
+        while stack:
+            t = stack.pop()
+            if link_map is not None and t.name == 'reference' and self.tag_data.get(t, 'postpone'):
+                orig_ref = self.tag_data.get(t, 'origRef')
+                if orig_ref in link_map:
+                    t['osisRef'] = link_map[orig_ref]
+                else:
+                    t.replace_with('[%s]' % t.text)
+                    logger.error('link not found %s', orig_ref)
+                    continue
+            if self.tag_data.get(t, 'unwrap'):
+                unwrap.append(t)
+            if not t.attrs.keys() <= self.KEEP_ATTRIBUTES:
+                for a in list(t.attrs.keys()):
+                    if a not in self.KEEP_ATTRIBUTES:
+                        attrs.add(a)
+                        del t[a]
+            stack.extend(c for c in reversed(t.contents) if isinstance(c, Tag))
+
+        for i in unwrap:
+            i.unwrap()
         logger.info('Removed attributes: %s', ', '.join(attrs))
 
-    def fix_postponed_references(self, link_map):
-        """ Fix postponed reference links from the mapping collected in self.link_map"""
-        logger.info('Fixing postponed references')
-        for r in self.osistext.find_all('reference', postpone='1'):
-            if r['origRef'] in link_map:
-                r['osisRef'] = link_map[r['origRef']]
-                del r['postpone']
-            else:
-                r.replace_with('[%s]' % r.text)
-                logger.error('link not found %s', r['origRef'])
+    def write_osis(self, *outputs):
+        """
+            Write OSIS document into binary file objects outputs, serialized only once
+        """
+        if self.options.debug:
+            data = self.root_soup.prettify().encode('utf-8')
+            for output in outputs:
+                output.write(data)
+        else:
+            from .soupwriter import write_soup
+            write_soup(self.root_soup, outputs)
+
+    def write_osis_file(self, *output_filenames):
+        logger.info('Writing OSIS file %s (%s)', ', '.join(output_filenames), self.__class__.__name__)
+        with contextlib.ExitStack() as stack:
+            self.write_osis(*[stack.enter_context(open(f, 'wb')) for f in output_filenames])
 
     def collect_linkmap(self, linkmap):
         """
             Collect mapping from HTML ids to osisRefs
         """
-        logger.info('Collecting linkmap (%s)', self.__class__.__name__)
-        for t in self.osistext.find_all(id=True):
-            id = t['id']
-            if 'origFile' in t.attrs:
-                origfile = t['origFile']
-            else:
-                p = t.find_parent(origFile=True)
-                origfile = p['origFile']
-
-            origfile = origfile.split(os.path.sep)[-1]
-            origref = '%s#%s' % (origfile, id)
+        from bs4 import Tag
 
-            linkmap[origref] = self._get_full_ref(t)
+        logger.info('Collecting linkmap (%s)', self.__class__.__name__)
+        # stack items: (tag, origFile of the closest ancestor that has one)
+        stack = [(c, None) for c in reversed(self.osistext.contents) if isinstance(c, Tag)]
+        while stack:
+            t, origfile = stack.pop()
+            origfile = self.tag_data.get(t, 'origFile', origfile)
+            if 'id' in t.attrs:
+                origref = '%s#%s' % (origfile.split(os.path.sep)[-1], t['id'])
+                linkmap[origref] = self._get_full_ref(t)
+            stack.extend((c, origfile) for c in reversed(t.contents) if isinstance(c, Tag))
 
 
 class Commentary(AbstractStudyBible, HTML2OsisMixin, FixOverlappingVersesMixin):
@@ -140,32 +206,88 @@ class Commentary(AbstractStudyBible, HTML2OsisMixin, FixOverlappingVersesMixin):
         self.options = options
         self.images_path = options.commentary_images_path
         self.work_id = options.commentary_work_id
+        self.comment_records = {}  # id(commentary div) -> CommentRecord
+        self.tag_data = TagData()
+        self.first_comments = {}  # Ref -> first commentary div that begins from that verse (see _adjust_studynotes)
         self.verse_comment_dict = {}
-        self.verse_comments_all_dict = {}  # list of comments that appear on verses
+        self.verse_comments_all = VerseMembership()  # comments that appear on verses
         # this mapping is used only for pushing crossrefs into comments in .read_crossreferences
         self.verse_comments_firstref_dict = {}
         self.images = []
         self.link_map = {}
         self.current_filename = ''
 
-        template = jinja2.Template(open(COMMENTARY_TEMPLATE_XML).read())
-        output_xml = BeautifulSoup(template.render(commentary_work_id=self.work_id, metadata=options.metadata), 'xml')
+        output_xml = make_soup(render_template(COMMENTARY_TEMPLATE_XML, commentary_work_id=self.work_id,
+                                               metadata=options.metadata), parser=options.parser)
         self.root_soup = output_xml
         self.osistext = output_xml.find('osisText')
 
     def _get_full_ref(self, t):
-        target = t.find_parent('div', annotateType='commentary')['annotateRef'].split(' ')[0]
+        target = self.comment_records[id(t.find_parent('div', annotateType='commentary'))].verses.first
         return '%s:%s' % (self.work_id, target)
 
-    def write_osis_file(self, output_filename):
-        logger.info('Writing OSIS file %s', output_filename)
+    def write_zcom(self, path):
+        """
+            Write commentary as SWORD zCom module files (chapter blocks, zip compression) into path,
+            directly from the comment records, as an alternative to osis2mod. Content of each
+            commentary div is the entry of its first verse, and the other verses are linked to it.
+            Links cannot cross testaments, so a comment spanning both has an entry in each.
+        """
+        import io
+        from .soupwriter import write_soup
+        from .zcom import ZComWriter, verse_index
+
+        logger.info('Writing zCom module into %s', path)
+        writer = ZComWriter(path)
+        for comment in self._comments_in_document_order():
+            verses = [v for v in comment.verses if not isinstance(v, OutsideRef)]
+            if not verses:
+                continue
+            text = io.BytesIO()
+            for child in comment.tag.contents:
+                write_soup(child, [text])
+            first_verses = {}  # testament -> verse that has the entry
+            for v in verses:
+                testament = verse_index(v)[0]
+                if testament in first_verses:
+                    writer.link_entry(v, first_verses[testament])
+                else:
+                    first_verses[testament] = v
+                    writer.set_entry(v, text.getvalue())
+        writer.close()
+
+    def _map_files(self, method, epub_zip, filenames):
+        """
+            Call method(filename, data) for each file and yield the results, in the order
+            of filenames. Method returns (soup, result), where soup is the parsed and fixed
+            file.
 
-        out = codecs.open(output_filename, 'w', encoding='utf-8')
-        if self.options.debug:
-            out.write(self.root_soup.prettify())
+            If options.jobs > 1, files are processed in worker processes, and soups are
+            passed back serialized.
+        """
+        if self.options.jobs > 1 and len(filenames) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(self.options.jobs, initializer=_init_worker,
+                                     initargs=(self.options,)) as executor:
+                tasks = ((method.__name__, fn, epub_zip.read(fn)) for fn in filenames)
+                for fn, (data, result, images) in zip(filenames, executor.map(_process_in_worker, tasks)):
+                    self.current_filename = fn
+                    self.images.extend(images)
+                    soup = make_soup(data, parser=self.options.parser)
+                    self.tag_data.from_attributes(soup)
+                    yield soup, result
         else:
-            out.write(str(self.root_soup))
-        out.close()
+            for fn in filenames:
+                yield method(fn, epub_zip.read(fn))
+
+    def _read_studynotes_file(self, filename, data_in):
+        logger.debug('Reading studynotes %s', filename)
+        self.current_filename = filename
+        soup = make_soup(data_in, parser=self.options.parser)
+        for i in soup.find('body').find_all(recursive=False):
+            self.tag_data.set(i, origFile=filename)
+            self._fix_studynote(i)
+        return soup, None
 
     def read_studynotes(self, epub_zip):
         studynote_files = [i for i in epub_zip.namelist() if i.endswith('studynotes.xhtml')]
@@ -176,17 +298,30 @@ class Commentary(AbstractStudyBible, HTML2OsisMixin, FixOverlappingVersesMixin):
             studynote_files = studynote_files[:2]
 
         logger.info('Reading studynotes')
-        for fn in studynote_files:
-            logger.debug('Reading studynotes %s %s', studynote_files.index(fn), fn)
-            data_in = epub_zip.read(fn)
-            self.current_filename = fn
-
-            body = BeautifulSoup(data_in, 'xml').find('body')
-            for i in body.find_all(recursive=False):
-                i['origFile'] = fn
+        rootlevel_tags = []
+        for soup, _ in self._map_files(self._read_studynotes_file, epub_zip, studynote_files):
+            for i in soup.find('body').find_all(recursive=False):
+                rootlevel_tags.append(i)
                 self.osistext.append(i.extract())
 
-        self._adjust_studynotes()
+        self._adjust_studynotes(rootlevel_tags)
+
+    def _read_crossrefs_file(self, filename, data_in):
+        logger.debug('Reading crossreferences %s', filename)
+        self.current_filename = filename
+        # only crossref paragraphs are parsed into the soup
+        soup = make_soup(data_in, parser=self.options.parser, parse_only=('p', {'class': 'crossref'}))
+        body = soup.new_tag('body')
+        verses = []
+        for p in soup.find_all('p', class_='crossref', recursive=False):
+            verses.append(studybible_ref(p.a.extract()['href'].split('#')[1]))
+            p.name = 'item'
+            p.insert(0, self.root_soup.new_string('ESV: '))
+            self._all_fixes(p)
+            body.append(p)
+        soup.clear()
+        soup.append(body)
+        return soup, verses
 
     def read_cross_references(self, epub_zip):
         crossref_files = [p for p in epub_zip.namelist() if p.endswith('crossrefs.xhtml')]
@@ -197,45 +332,77 @@ class Commentary(AbstractStudyBible, HTML2OsisMixin, FixOverlappingVersesMixin):
             crossref_files = crossref_files[:2]
 
         logger.info('Reading crossreferences')
-        for fn in crossref_files:
-            logger.debug('Reading studynotes %s %s', crossref_files.index(fn), fn)
-            data_in = epub_zip.read(fn)
-            self.current_filename = fn
-
-            body = BeautifulSoup(data_in, 'xml').find('body')
-            for p in body.find_all('p', class_='crossref', recursive=False):
-                p.extract()
-                verse = Ref(parse_studybible_reference(p.a.extract()['href'].split('#')[1]))
+        # ordinals of the verses in verse_comments_firstref_dict, sorted (verses outside of
+        # versification are left out, as next() never gives them)
+        firstref_ordinals = sorted(r.ordinal for r in self.verse_comments_firstref_dict
+                                   if not isinstance(r, OutsideRef))
+        # new empty comments are inserted in the tree at the end, all at once:
+        # id(tag) -> new comment tags to be inserted before tag, None for the end
+        insert_before = {}
+        for soup, verses in self._map_files(self._read_crossrefs_file, epub_zip, crossref_files):
+            for p, verse in zip(soup.find('body').find_all('item', recursive=False), verses):
                 target_comment = self.verse_comments_firstref_dict.get(verse)
-                p.name = 'item'
-                p.insert(0, self.root_soup.new_string('ESV: '))
-                self._all_fixes(p)
 
                 if target_comment:
-                    links = target_comment.find('list', cls='reference_links')
-                    if not links:
-                        links = self.create_new_reference_links_list(target_comment)
-                    links.append(p)
+                    target_comment.crossrefs.append(p)
                 else:
                     target_comment = self._create_empty_comment(verse)
-                    links = self.create_new_reference_links_list(target_comment)
-                    links.append(p)
+                    target_comment.crossrefs.append(p)
 
-                    # We need to add this comment after all the other comments of this verse
-                    n = verse
-                    try:
-                        while n not in self.verse_comments_firstref_dict:
-                            n = next(n)
-                        position = self.verse_comments_firstref_dict[n]
-                        position.insert_before(target_comment)
-                    except n.LastVerse:
-                        self.osistext.append(target_comment)
+                    # We need to add this comment before the comments of the next verse that has comments
+                    i = bisect.bisect_right(firstref_ordinals, verse.last_ordinal)
+                    if i < len(firstref_ordinals):
+                        position = self.verse_comments_firstref_dict[Ref.from_ordinal(firstref_ordinals[i])]
+                        insert_before.setdefault(id(position.tag), []).append(target_comment.tag)
+                    else:
+                        insert_before.setdefault(None, []).append(target_comment.tag)
 
                     self.verse_comments_firstref_dict[verse] = target_comment
-                    vl = self.verse_comments_all_dict.get(verse)
-                    if not vl:
-                        vl = self.verse_comments_all_dict[verse] = set()
-                    vl.add(target_comment)
+                    if not isinstance(verse, OutsideRef):
+                        firstref_ordinals.insert(i, verse.ordinal)
+                    self.verse_comments_all.add(target_comment, target_comment.orig_verses)
+
+        if insert_before:
+            self._insert_comments(insert_before)
+
+    def _insert_comments(self, insert_before):
+        """
+            Rebuild osistext contents with the new comment tags inserted (see read_cross_references).
+            New tags can have new tags inserted before them, too.
+        """
+        contents = []
+        stack = [(tag, False) for tag in reversed(self.osistext.contents + insert_before.get(None, []))]
+        while stack:
+            tag, expanded = stack.pop()
+            before = insert_before.get(id(tag))
+            if expanded or not before:
+                contents.append(tag)
+            else:
+                stack.append((tag, True))
+                stack.extend((t, False) for t in reversed(before))
+        self.osistext.clear()
+        self.osistext.extend(contents)
+
+
+_worker_commentary = None
+
+
+def _init_worker(options):
+    global _worker_commentary
+    _worker_commentary = Commentary(options)
+
+
+def _process_in_worker(task):
+    """
+        Run Commentary file processing method in worker process (see Commentary._map_files)
+    """
+    method_name, filename, data_in = task
+    _worker_commentary.images = []
+    soup, result = getattr(_worker_commentary, method_name)(filename, data_in)
+    _worker_commentary.tag_data.to_attributes(soup)
+    _worker_commentary.tag_data = TagData()
+    return str(soup), result, _worker_commentary.images
+
 
 class Articles(AbstractStudyBible, HTML2OsisMixin):
     """
@@ -249,19 +416,24 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
     class ExceptionalProcessing(Exception):
         pass
 
-    def __init__(self, options, commentary_xml):
+    def __init__(self, options, commentary=None):
         if isinstance(options, dict):
             options = dict_to_options(options)
         self.options = options
         self.images_path = options.articles_images_path
         self.work_id = options.articles_work_id
-        self.commentary_xml = commentary_xml
+        # some articles are moved into commentary, so temporary tag data is shared with it
+        self.commentary = commentary
+        self.tag_data = commentary.tag_data if commentary else TagData()
         self.current_filename = ''
         self.images = []
         self.used_resources = []
+        self.article_ids = {}  # osisID -> article div in self.articles
+        self.sections = []  # section divs, in the order they are created
+        self._node_infos = {}  # see _node_info
 
-        template = jinja2.Template(open(GENBOOK_TEMPLATE_XML).read())
-        output_xml = BeautifulSoup(template.render(articles_work_id=self.work_id, metadata=options.metadata), 'xml')
+        output_xml = make_soup(render_template(GENBOOK_TEMPLATE_XML, articles_work_id=self.work_id,
+                                               metadata=options.metadata), parser=options.parser)
         self.root_soup = output_xml
         self.osistext = output_xml.find('osisText')
         self.articles = output_xml.new_tag('div', type='book', osisID=fix_osis_id('Articles'))
@@ -292,7 +464,7 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
         self.zip = epub_zip  # TODO check if this is used?
 
         logger.info('Reading articles')
-        soup = self._give_soup(os.path.join(self.path, 'toc.xhtml'))
+        soup = self._give_soup(os.path.join(self.path, 'toc.xhtml'), parse_only='li')
         self._process_toc(soup)
 
         bookintro_files = [i for i in epub_zip.namelist() if i.endswith('intros.xhtml')]
@@ -314,36 +486,42 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
         #             for pt in c.find_all('div', type='section'):
         #                 pt.unwrap()
 
-        for pt in self.root_soup.find_all('div', type='section'):
-            pt['osisID'] = fix_osis_id(pt.title.text)
+        self._set_section_ids()
+
+    def _set_section_ids(self):
+        """
+            Section titles are final only after all the fixes, so osisIDs of sections are set last.
+            Sections that have been moved into commentary are skipped.
+        """
+        for pt in self.sections:
+            if any(p is self.root_soup for p in pt.parents):
+                pt['osisID'] = fix_osis_id(pt.title.text)
+        self._node_infos.clear()
 
     def post_process(self):
+        """
+            Final rewrite of the articles tree, in a single ordered traversal: h3 titles are
+            made bold paragraphs, paragraph divs are renamed to p, and passage title, subsection
+            and typeless divs are unwrapped. Then tables of contents are generated.
+        """
         logger.info('Postprosessing resources')
-        for t in self.root_soup.find_all('title', h3=1):
-            t.name = 'p'
-            hi = self.root_soup.new_tag('hi', type='bold')
-            for c in t.children:
-                hi.append(c.extract())
-            t.append(hi)
-
-        for p in self.root_soup.find_all('div', type='paragraph'):
-            p.name = 'p'
-            del p.attrs['type']
-
-        for pt in self.root_soup.find_all('div', class_='passagetitle'):
-            pt.unwrap()
-        for pt in self.root_soup.find_all('div'):
-            if 'epub:type' in pt.attrs:
-                del pt['epub:type']
-
-        for pt in self.root_soup.find_all('div', type='subSection'):
-            pt.unwrap()
-
-        for pt in self.root_soup.find_all('div'):
-            if 'type' not in pt.attrs:
-                pt.unwrap()
+        for t in self.root_soup.find_all(['title', 'div']):
+            if t.name == 'title':
+                if self.tag_data.get(t, 'h3'):
+                    self._fix_h3_title(t)
+            elif t.attrs.get('type') == 'paragraph':
+                t.name = 'p'
+                del t.attrs['type']
+            elif t.attrs.get('class') == 'passagetitle':
+                t.unwrap()
+            else:
+                if 'epub:type' in t.attrs:
+                    del t['epub:type']
+                if 'type' not in t.attrs or t['type'] == 'subSection':
+                    t.unwrap()
 
         sort_tag_content(self.other, key=lambda x: x.attrs.get('osisID', ''), recursive=False)
+        self._node_infos.clear()
 
         full_toc = self.root_soup.new_tag('div', type='book', osisID=fix_osis_id('Full Table of Contents'))
         full_toc.append(self.root_soup.new_tag('title'))
@@ -362,44 +540,85 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
                     p.append(root_list)
                     d.find('div', osisID=True).insert_before(p)
 
-    def write_osis_file(self, output_filename):
-        logger.info('Writing articles into OSIS file %s', output_filename)
-        output = codecs.open(output_filename, 'w', encoding='utf-8')
-        if self.options.debug:
-            output.write(self.root_soup.prettify())
+    def _fix_h3_title(self, t):
+        t.name = 'p'
+        hi = self.root_soup.new_tag('hi', type='bold')
+        for c in t.children:
+            hi.append(c.extract())
+        t.append(hi)
+
+    def _node_info(self, tag):
+        """
+            Returns (genbook path, closest section div, closest chapter div) of tag, tag
+            itself included. Memoized for each node, so that each branch is climbed only once.
+            Memo must be cleared whenever tree structure or osisIDs change.
+        """
+        item = self._node_infos.get(id(tag))
+        if item is not None:
+            return item[1]
+        if tag.parent is None:
+            info = (None, None, None)
         else:
-            output.write(str(self.root_soup))
-        output.close()
+            path, section, chapter = self._node_info(tag.parent)
+            if 'osisID' in tag.attrs:
+                path = tag['osisID'] if path is None else '%s%s%s' % (path, GENBOOK_BRANCH_SEPARATION_LETTER,
+                                                                     tag['osisID'])
+            if tag.name == 'div':
+                type = tag.attrs.get('type')
+                if type == 'section':
+                    section = tag
+                elif type == 'chapter':
+                    chapter = tag
+            info = (path, section, chapter)
+        self._node_infos[id(tag)] = (tag, info)
+        return info
+
+    def write_genbook(self, path):
+        """
+            Write articles as SWORD RawGenBook module files (path.bdt, path.idx and path.dat)
+            directly from the div[osisID] tree, as an alternative to xml2gbs. Keys are the genbook
+            paths of the divs (as in _get_full_ref), and the entry of each div is its content
+            without its child divs.
+        """
+        import io
+        from bs4 import Tag
+        from .soupwriter import write_soup
+        from .rawgenbook import RawGenBookWriter
+
+        logger.info('Writing RawGenBook module into %s', path)
+        self._node_infos.clear()
+        writer = RawGenBookWriter(path, GENBOOK_BRANCH_SEPARATION_LETTER)
+        for tag in self.osistext.find_all(osisID=True):
+            text = io.BytesIO()
+            for child in tag.contents:
+                if not (isinstance(child, Tag) and 'osisID' in child.attrs):
+                    write_soup(child, [text])
+            writer.set_entry(self._node_info(tag)[0], text.getvalue())
+        writer.close()
 
     def _get_full_ref(self, t):
-        target_tag = None
         if 'osisID' in t.attrs:
             target_tag = t
-        if not target_tag:
-            target_tag = t.find_parent('div', type='section')
-        if not target_tag:
-            target_tag = t.find_parent('div', type='chapter')
-
-        target = target_tag['osisID']
-        for t in target_tag.parents:
-            if 'osisID' in t.attrs:
-                target = '%s%s%s' % (t['osisID'], GENBOOK_BRANCH_SEPARATION_LETTER, target)
-
-        return '%s:%s' % (self.work_id, target)
+        else:
+            _, section, chapter = self._node_info(t.parent)
+            target_tag = section if section is not None else chapter
+        return '%s:%s' % (self.work_id, self._node_info(target_tag)[0])
 
     def _fix_section_one_level(self, soup, tag, type):
         h_tags = soup.find_all(tag, recursive=False)
         for i in range(len(h_tags)):
             start = h_tags[i]
             next_siblings = list(start.next_siblings)
-            start['old_name'] = start.name
+            self.tag_data.set(start, old_name=start.name, origFile=self.current_filename)
             start.name = 'title'
-            start['origFile'] = self.current_filename
 
             if tag == 'h3':
-                start['h3'] = 1
+                self.tag_data.set(start, h3=True)
 
-            section = self.root_soup.new_tag('div', type=type, origFile=self.current_filename)
+            section = self.root_soup.new_tag('div', type=type)
+            self.tag_data.set(section, origFile=self.current_filename)
+            if type == 'section':
+                self.sections.append(section)
             start.wrap(section)
             end = None
             if i < len(h_tags) - 1:
@@ -431,7 +650,9 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
         """
         tag = tag.extract()
         self._all_fixes(tag)
-        studynote = self.commentary_xml.find('div', annotateRef=re.compile('^%s' % target_ref))
+        studynote = self.commentary.first_comments.get(Ref(target_ref))
+        if studynote is None:
+            studynote = self.commentary.osistext.find('div', annotateRef=re.compile('^%s' % target_ref))
         tag['type'] = 'paragraph'
         studynote.append(tag)
         logger.info('Moved %s to %s', tag.title.text, target_ref)
@@ -444,16 +665,18 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
         titletag, title = self._find_title(soup)
 
         if titletag.attrs.get('class', '') == 'concordance-section':
-            target = self.articles.find(osisID=fix_osis_id('Concordance'))
+            target = self.article_ids.get(fix_osis_id('Concordance'))
             target.append(soup.extract())
             titletag.name = 'title'
-            titletag['origFile'] = self.current_filename
+            self.tag_data.set(titletag, origFile=self.current_filename)
             soup['type'] = 'section'
+            self.sections.append(soup)
             self._fix_sections(soup)
             self._all_fixes(soup)
             soup.name = 'div'
             soup['osisID'] = fix_osis_id(title)
-            soup['origFile'] = self.current_filename
+            self.tag_data.set(soup, origFile=self.current_filename)
+            self.article_ids.setdefault(soup['osisID'], soup)
             raise self.ExceptionalProcessing
 
         # TODO: first check if this is really ESV Study Bible!
@@ -465,8 +688,8 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
 
         if title in ['Ezra—History of Salvation in the Old Testament',
                      'Song of Solomon—History of Salvation in the Old Testament']:
-            target = self.articles.find(osisID=fix_osis_id('History of Salvation in the Old Testament'
-                                                           '  Preparing the Way for Christ'))
+            target = self.article_ids.get(fix_osis_id('History of Salvation in the Old Testament'
+                                                      '  Preparing the Way for Christ'))
             self._fix_sections(soup)
             self._all_fixes(soup)
             for i in soup.children:
@@ -484,9 +707,9 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
 
         soup.name = 'div'
         soup['type'] = 'chapter'
-        soup['origFile'] = self.current_filename
+        self.tag_data.set(soup, origFile=self.current_filename)
         titletag.name = 'title'
-        titletag['origFile'] = self.current_filename
+        self.tag_data.set(titletag, origFile=self.current_filename)
         # titletag.string = title
         soup['osisID'] = fix_osis_id(title)
         self._fix_sections(soup)
@@ -505,6 +728,7 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
                     logger.error('No title in %s, skipping.', self.current_filename)
                     continue
                 self.articles.append(soup)
+                self.article_ids.setdefault(soup['osisID'], soup)
 
     def _generate_toc(self, node, depth):
         if not depth:
@@ -523,9 +747,54 @@ class Articles(AbstractStudyBible, HTML2OsisMixin):
         if root_list.contents:
             return root_list
 
-    def _give_soup(self, fname):
+    def _give_soup(self, fname, parse_only=None):
         input_data = self.zip.read(fname)
-        return BeautifulSoup(input_data, 'xml')
+        return make_soup(input_data, parser=self.options.parser, parse_only=parse_only)
+
+
+class ToolRunner(object):
+    """
+        Runs external tools (osis2mod, xml2gbs) concurrently, and collects their exit codes and timings
+    """
+
+    def __init__(self):
+        self.processes = []  # (name, process, start time)
+        self.results = {}  # name -> (exit code, seconds)
+
+    def start(self, name, cmdline, **kwargs):
+        logger.info('Starting %s', name)
+        process = subprocess.Popen(cmdline, stdout=subprocess.DEVNULL, **kwargs)
+        self.processes.append((name, process, time.time()))
+        return process
+
+    def wait(self):
+        """
+            Wait until all tools have finished. Raises an exception if some of them failed.
+        """
+        for name, process, start in self.processes:
+            process.wait()
+            self.results[name] = (process.returncode, time.time() - start)
+            logger.info('%s finished with exit code %s in %.1f seconds', name, process.returncode,
+                        self.results[name][1])
+        failed = ['%s (exit code %s)' % (name, code) for name, (code, seconds) in self.results.items() if code]
+        if failed:
+            raise Exception('Sword tools failed: %s' % ', '.join(failed))
+        return self.results
+
+    def cleanup(self):
+        """
+            Close input pipes and stop tools that are still running (after an error)
+        """
+        for name, process, start in self.processes:
+            if process.stdin:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            if process.poll() is None:
+                logger.warning('Terminating %s', name)
+                process.terminate()
+                process.wait()
 
 
 class Convert(object):
@@ -554,6 +823,12 @@ class Convert(object):
         articles_data_path = 'modules/genbook/rawgenbook/{wid}/{wid}'.format(wid=articles_work_id.replace(' ', '_'))
 
         self.options.setdefault('cipher_key', None)
+        if self.options.cipher_key in ('None', ''):
+            self.options.cipher_key = None  # command line default
+        self.options.setdefault('commentary_writer', 'osis2mod')
+        self.options.setdefault('articles_writer', 'xml2gbs')
+        if self.options.commentary_writer == 'native' and self.options.cipher_key:
+            raise Exception('Native commentary writer does not support encryption (cipher_key)')
         self.options.setdefault('images', True)
         self.options.setdefault('cross_references', True)
         self.options.setdefault('commentary_work_id', commentary_work_id)
@@ -569,7 +844,7 @@ class Convert(object):
         """
         time_start = time.time()
         self.commentary = Commentary(self.options)
-        self.articles = Articles(self.options, self.commentary.osistext)
+        self.articles = Articles(self.options, self.commentary)
 
         self.commentary.read_studynotes(self.epub_zip)
 
@@ -586,47 +861,39 @@ class Convert(object):
         self.articles.collect_linkmap(self.linkmap)
         self.articles.post_process()
 
-        self.commentary.fix_postponed_references(self.linkmap)
-        self.articles.fix_postponed_references(self.linkmap)
+        self.commentary.finalize(self.linkmap)
+        self.articles.finalize(self.linkmap)
 
-        logger.info('Cleaning up illegal/temporary attributes')
-        self.commentary.clean_tags()
-        self.articles.clean_tags()
+        osis_filename = None
+        if self.options.osis:
+            osis_filename = output_filename or '%s.xml' % self.epub_filename.rsplit('.')[0]
 
         if self.options.sword:
-            self.make_sword_module(output_filename)
-
-        if self.options.osis:
-            output_filename = output_filename or '%s.xml' % self.epub_filename.rsplit('.')[0]
-            self.commentary.write_osis_file(output_filename)
-            self.articles.write_osis_file('articles_' + output_filename)
+            self.make_sword_module(output_filename, osis_filename)
+        elif osis_filename:
+            self.commentary.write_osis_file(osis_filename)
+            self.articles.write_osis_file('articles_' + osis_filename)
 
         logger.info('Processing took %.2f minutes', (time.time() - time_start) / 60.)
 
     def read_metadata(self, epub_zip):
-        data = BeautifulSoup(epub_zip.read('OEBPS/content.opf'), 'xml').find('metadata')
+        data = make_soup(epub_zip.read('OEBPS/content.opf'), parser=self.options.parser,
+                         parse_only='metadata').find('metadata')
         metadata = {}
         for d in data.find_all(recursive=False):
-            txt = BeautifulSoup(d.text).text
+            txt = _html_text(d.text)
             if txt:
                 metadata[d.name] = txt
         return Options(metadata)
 
-    def make_sword_module(self, output_filename):
+    def make_sword_module(self, output_filename, osis_filename=None):
+        """
+            If osis_filename is given, OSIS files are written from the same serialization
+            as the input files of osis2mod and xml2gbs.
+        """
         from study2osis import __version__
 
         logger.info('Making sword module')
-        fd, bible_osis_filename = tempfile.mkstemp()
-        temp = codecs.open(bible_osis_filename, 'w', 'utf-8')
-        temp.write(str(self.commentary.root_soup))
-        temp.close()
-        os.close(fd)
-        fd, articles_osis_filename = tempfile.mkstemp()
-        temp = codecs.open(articles_osis_filename, 'w', 'utf-8')
-        temp.write(str(self.articles.root_soup))
-        temp.close()
-        os.close(fd)
-
         module_dir = tempfile.mkdtemp()
 
         os.mkdir(os.path.join(module_dir, 'mods.d'))
@@ -649,7 +916,8 @@ class Convert(object):
 
         # Bible conf
         conf_filename = os.path.join('mods.d', self.options.commentary_work_id.replace(' ', '_').lower() + '.conf')
-        conf_str = jinja2.Template(codecs.open(BIBLE_CONF_TEMPLATE, 'r', 'utf-8').read()).render(
+        conf_str = render_template(
+            BIBLE_CONF_TEMPLATE,
             abbreviation=initials(self.options.commentary_work_id),
             commentary_work_id=self.options.commentary_work_id,
             commentary_data_path=self.options.commentary_data_path,
@@ -663,7 +931,8 @@ class Convert(object):
 
         # Articles+resources conf
         conf_filename = os.path.join('mods.d', self.options.articles_work_id.replace(' ', '_').lower() + '.conf')
-        conf_str = jinja2.Template(codecs.open(GENBOOK_CONF_TEMPLATE, 'r', 'utf-8').read()).render(
+        conf_str = render_template(
+            GENBOOK_CONF_TEMPLATE,
             abbreviation=initials(self.options.articles_work_id),
             articles_work_id=self.options.articles_work_id,
             articles_data_path=self.options.articles_data_path,
@@ -674,20 +943,7 @@ class Convert(object):
         with codecs.open(os.path.join(module_dir, conf_filename), 'w', 'utf-8') as f:
             f.write(conf_str)
 
-        cipher_key = self.options.cipher_key
-        cmdline = ['osis2mod', commentary_save_path, bible_osis_filename, '-v', 'NRSV', '-z', '-b', '3']
-        if cipher_key:
-            cmdline.extend(['-c', cipher_key])
-
-        process = subprocess.Popen(cmdline, stdout=subprocess.PIPE)
-        process.communicate()
-        process.wait()
-        os.unlink(bible_osis_filename)
-
-        process = subprocess.Popen(['xml2gbs', articles_osis_filename, articles_save_path], stdout=subprocess.PIPE)
-        process.communicate()
-        process.wait()
-        os.unlink(articles_osis_filename)
+        self._run_sword_tools(commentary_save_path, articles_save_path, osis_filename)
 
         zip_filename = output_filename or '%s_module.zip' % self.epub_filename.rsplit('.')[0]
         sword_zip = zipfile.ZipFile(zip_filename, 'w')
@@ -699,8 +955,57 @@ class Convert(object):
         shutil.rmtree(module_dir)
         logger.info('Sword module written in %s', zip_filename)
 
-
-def main():
+    def _run_sword_tools(self, commentary_save_path, articles_save_path, osis_filename=None):
+        """
+            Run osis2mod and xml2gbs at the same time. Commentary is streamed into osis2mod
+            through its stdin. xml2gbs needs a file, so articles are written first, and xml2gbs
+            is running while commentary is being serialized and converted. With native
+            writers, module files are written by write_zcom and write_genbook instead.
+        """
+        tools = ToolRunner()
+        articles_osis_filename = None
+        try:
+            articles_osis_filenames = ['articles_' + osis_filename] if osis_filename else []
+            if self.options.articles_writer == 'native':
+                if articles_osis_filenames:
+                    self.articles.write_osis_file(*articles_osis_filenames)
+                self.articles.write_genbook(articles_save_path)
+            else:
+                fd, articles_osis_filename = tempfile.mkstemp()
+                os.close(fd)
+                self.articles.write_osis_file(articles_osis_filename, *articles_osis_filenames)
+                tools.start('xml2gbs', ['xml2gbs', articles_osis_filename, articles_save_path])
+
+            if self.options.commentary_writer == 'native':
+                if osis_filename:
+                    self.commentary.write_osis_file(osis_filename)
+                self.commentary.write_zcom(commentary_save_path)
+            else:
+                cmdline = ['osis2mod', commentary_save_path, '-', '-v', 'NRSV', '-z', '-b', '3']
+                if self.options.cipher_key:
+                    cmdline.extend(['-c', self.options.cipher_key])
+                osis2mod = tools.start('osis2mod', cmdline, stdin=subprocess.PIPE)
+                logger.info('Writing commentary into osis2mod%s',
+                            ' and OSIS file %s' % osis_filename if osis_filename else '')
+                with contextlib.ExitStack() as stack:
+                    outputs = [stack.enter_context(open(osis_filename, 'wb'))] if osis_filename else []
+                    try:
+                        self.commentary.write_osis(*(outputs + [osis2mod.stdin]))
+                        osis2mod.stdin.close()
+                    except BrokenPipeError:
+                        logger.error('osis2mod closed its input')
+                        try:
+                            osis2mod.stdin.close()
+                        except BrokenPipeError:
+                            pass
+            tools.wait()
+        finally:
+            tools.cleanup()
+            if articles_osis_filename:
+                os.unlink(articles_osis_filename)
+
+
+def option_parser():
     parser = optparse.OptionParser(usage='Usage. %prog [options] directory_or_epub_file')
     parser.add_option('--debug', action='store_true', dest='debug', default=False,
                       help='Debug mode')
@@ -712,21 +1017,41 @@ def main():
                       help='Write OSIS files.')
     parser.add_option('--no_nonadj', action='store_true', dest='no_nonadj', default=False,
                       help='Do not create empty comments (with only links) for non-adjacent verse ranges')
+    parser.add_option('--overlap_resolver', dest='overlap_resolver', default='intervals',
+                      choices=['intervals', 'legacy'],
+                      help='Algorithm for resolving overlapping comment ranges: "intervals" (default) or "legacy"')
+    parser.add_option('--collapse_ranges', action='store_true', dest='collapse_ranges', default=False,
+                      help='Write consecutive verses as ranges (Gen.1.1-Gen.1.5) in annotateRef attributes')
+    parser.add_option('--commentary_writer', dest='commentary_writer', default='osis2mod',
+                      choices=['osis2mod', 'native'],
+                      help='Commentary module writer: "osis2mod" (default) or "native" (no libsword tools needed, '
+                           'no encryption)')
+    parser.add_option('--articles_writer', dest='articles_writer', default='xml2gbs',
+                      choices=['xml2gbs', 'native'],
+                      help='Articles module writer: "xml2gbs" (default) or "native" (no libsword tools needed)')
+    parser.add_option('--parser', dest='parser', default='bs4', choices=['bs4', 'lxml'],
+                      help='XML parser used to read input: "bs4" (default) or "lxml" (lxml.etree, faster)')
+    parser.add_option('--jobs', dest='jobs', type='int', default=1,
+                      help='Number of worker processes used to read studynotes and crossreferences')
     parser.add_option('--bible_work_id', dest='bible_work_id', default='None',
                       help='Bible work_id (verses are linked there). "None" -> no work_id specification')
     parser.add_option('--cipher_key', dest='cipher_key', default='None',
                       help='Encryption key. "None" -> no encryption')
+    return parser
 
+
+def main():
+    parser = option_parser()
     options, args = parser.parse_args()
     if len(args) == 1:
         input_file = args[0]
-        if options.debug or True:
+        if options.debug:
             from ipdb import launch_ipdb_on_exception
 
             with launch_ipdb_on_exception():
                 Convert(options, input_file).process_epub()
         else:
-            Convert(options, input_file).process_epub(input_file)
+            Convert(options, input_file).process_epub()
 
     else:
         parser.print_help()
@@ -2,19 +2,23 @@
     Copyright (C) 2015 Tuomas Airaksinen.
     See LICENCE.txt
 """
-from copy import copy
+from bisect import bisect_left, bisect_right
+import heapq
+import itertools
 import logging
 import re
 
 logger = logging.getLogger('study2osis')
 
-from .bible_data import LAST_CHAPTERS, CHAPTER_LAST_VERSES
-from .bibleref import verses, references_to_string, expand_ranges, Ref
+from .bible_data import LAST_CHAPTERS
+from .bibleref import references_to_string, expand_ranges, Ref, VerseSet, chapter_end
 
 LINK_MAX_LENGTH = 38
 NUMBER_OF_CHAPTERS_FOR_FIGURES_AND_TABLES = 10
 
 def find_subranges(orig_verses, actual_verses):
+    if not isinstance(actual_verses, (set, VerseSet)):
+        actual_verses = set(actual_verses)
     ranges = []
     r = []
     for ov in orig_verses:
@@ -36,6 +40,295 @@ def sort_tag_content(soup, key, *args, reverse=False, **kwargs):
         soup.append(i)
 
 
+class CommentRecord(object):
+    """
+        Overlap processing state of one commentary div. Until annotateRef is written
+        (at the end of fix_overlapping_ranges), this is the source of truth for the verses
+        of the comment.
+
+            tag: the commentary div
+            orig_ref: original reference string(s), for debugging
+            orig_verses: VerseSet of the expanded original reference
+            verses: VerseSet of the verses this comment currently owns
+            links: set of comments that are linked from this comment ('See also')
+            crossrefs: crossreference items of this comment ('See also')
+            link_summary: (title, osisRef) for links to this comment, see _link_summary
+            replaced_by: record of the comment that this comment has been merged into
+
+        'See also' list tags are written from links and crossrefs only at the end of
+        fix_overlapping_ranges, see _write_reference_links.
+    """
+    __slots__ = ('tag', 'orig_ref', 'orig_verses', 'verses', 'links', 'crossrefs', 'link_summary',
+                 'replaced_by')
+
+    def __init__(self, tag, orig_ref, orig_verses):
+        self.tag = tag
+        self.orig_ref = orig_ref
+        self.orig_verses = orig_verses
+        self.verses = orig_verses
+        self.links = set()
+        self.crossrefs = []
+        self.link_summary = None
+        self.replaced_by = None
+
+    def __repr__(self):
+        return 'CommentRecord("%s")' % self.orig_ref
+
+
+def final_comment(comment):
+    """
+        Follow replaced_by links of merged comment records to the one that finally contains
+        them. The links form a union-find forest; paths are compressed on the way.
+    """
+    root = comment
+    while root.replaced_by is not None:
+        root = root.replaced_by
+    while comment.replaced_by is not None and comment.replaced_by is not root:
+        comment.replaced_by, comment = root, comment.replaced_by
+    return root
+
+
+class VerseOwners(object):
+    """
+        Maps verses to the comment record that owns them. Ownership is kept as sorted, disjoint
+        segments of verse ordinals, and the dict operations used by FixOverlappingVersesMixin
+        are supported (keys are Refs). Verses outside versification (OutsideRef) are kept
+        in a dict.
+    """
+
+    def __init__(self, starts=None, stops=None, owners=None, outside=None):
+        self.starts = starts or []
+        self.stops = stops or []
+        self.owners = owners or []
+        self.outside = outside or {}  # OutsideRef -> owner
+
+    def _index(self, ordinal):
+        i = bisect_right(self.starts, ordinal) - 1
+        if i >= 0 and ordinal <= self.stops[i]:
+            return i
+        return None
+
+    def owner_at(self, ordinal):
+        i = self._index(ordinal)
+        return None if i is None else self.owners[i]
+
+    def owners_in(self, start, stop):
+        """ Yield owners of the segments that intersect verses start..stop (ordinals), in order """
+        i = bisect_right(self.starts, start) - 1
+        if i < 0 or self.stops[i] < start:
+            i += 1
+        starts, owners = self.starts, self.owners
+        while i < len(starts) and starts[i] <= stop:
+            yield owners[i]
+            i += 1
+
+    def get(self, ref, default=None):
+        ref = Ref(ref)
+        owner = self.outside.get(ref) if ref.ordinal is None else self.owner_at(ref.ordinal)
+        return default if owner is None else owner
+
+    def __getitem__(self, ref):
+        owner = self.get(ref)
+        if owner is None:
+            raise KeyError(ref)
+        return owner
+
+    def __setitem__(self, ref, owner):
+        ref = Ref(ref)
+        if ref.ordinal is None:
+            self.outside[ref] = owner
+        else:
+            self.assign(ref.ordinal, ref.ordinal, owner)
+
+    def __contains__(self, ref):
+        return self.get(ref) is not None
+
+    def assign(self, start, stop, owner):
+        """
+            Give verses start..stop (ordinals) to owner, taking them away from their previous
+            owners. Segments are spliced, so this is for single changes after the segments have
+            been built (see VerseClaims).
+        """
+        starts, stops, owners = self.starts, self.stops, self.owners
+        i = bisect_right(starts, start) - 1
+        if i < 0 or stops[i] < start:
+            i += 1
+        j = i
+        new_starts = []
+        new_stops = []
+        new_owners = []
+        right = None
+        while j < len(starts) and starts[j] <= stop:
+            if starts[j] < start:
+                new_starts.append(starts[j])
+                new_stops.append(start - 1)
+                new_owners.append(owners[j])
+            if stops[j] > stop:
+                right = (stop + 1, stops[j], owners[j])
+            j += 1
+        new_starts.append(start)
+        new_stops.append(stop)
+        new_owners.append(owner)
+        if right:
+            new_starts.append(right[0])
+            new_stops.append(right[1])
+            new_owners.append(right[2])
+        starts[i:j] = new_starts
+        stops[i:j] = new_stops
+        owners[i:j] = new_owners
+
+    def verse_sets(self):
+        """ id(owner) -> VerseSet of the verses it owns """
+        intervals = {}
+        outside = {}
+        for start, stop, owner in zip(self.starts, self.stops, self.owners):
+            intervals.setdefault(id(owner), []).append((start, stop))
+        for ref, owner in self.outside.items():
+            outside.setdefault(id(owner), []).append(ref)
+        return {k: VerseSet(intervals.get(k, ()), outside.get(k, ())) for k in intervals.keys() | outside.keys()}
+
+
+class VerseClaims(object):
+    """
+        Verse ownership while comments claim their verses in document order, later claim
+        winning (see FixOverlappingVersesMixin._process_overlapping_verses_intervals).
+
+        Boundaries of all the intervals to be claimed are sorted once, and claims are painted
+        on a segment tree over the elementary segments between them: a claim and an owner lookup
+        cost O(log n). Verses outside versification (OutsideRef) are claimed as single points,
+        they are ordered between ordinals by their key. Finally, owners() builds the VerseOwners
+        segments in one pass.
+    """
+
+    def __init__(self, intervals):
+        self.bounds = sorted({b for start, stop in intervals for b in (start, stop + 1)})
+        size = 1
+        while size < len(self.bounds):
+            size *= 2
+        self.size = size
+        # tree nodes: number of the latest claim that covers the whole node, and its owner
+        self.claim_numbers = [-1] * (2 * size)
+        self.claim_owners = [None] * (2 * size)
+        self.claims = 0
+        self.outside = {}  # OutsideRef -> owner
+        self._heads = {}  # id(owner) -> heap of (key, OutsideRef or None) of verses that may be its first
+
+    def _segment(self, ordinal):
+        i = bisect_right(self.bounds, ordinal) - 1
+        return i if 0 <= i < len(self.bounds) - 1 else None
+
+    def owner_at(self, ordinal):
+        i = self._segment(ordinal)
+        if i is None:
+            return None
+        numbers, owners = self.claim_numbers, self.claim_owners
+        i += self.size
+        number, owner = -1, None
+        while i:
+            if numbers[i] > number:
+                number, owner = numbers[i], owners[i]
+            i >>= 1
+        return owner
+
+    def get(self, ref):
+        ref = Ref(ref)
+        return self.outside.get(ref) if ref.ordinal is None else self.owner_at(ref.ordinal)
+
+    def claim(self, start, stop, owner):
+        """ Give verses start..stop (ordinals, boundaries given in __init__) to owner """
+        numbers, owners = self.claim_numbers, self.claim_owners
+        number = self.claims
+        self.claims += 1
+        lo = bisect_left(self.bounds, start) + self.size
+        hi = bisect_left(self.bounds, stop + 1) + self.size
+        while lo < hi:
+            if lo & 1:
+                numbers[lo], owners[lo] = number, owner
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                numbers[hi], owners[hi] = number, owner
+            lo >>= 1
+            hi >>= 1
+        self._push_head(owner, start, None)
+        # verse after the claim may now be the first verse of its owner
+        after = self.owner_at(stop + 1)
+        if after is not None:
+            self._push_head(after, stop + 1, None)
+
+    def claim_outside(self, ref, owner):
+        self.outside[ref] = owner
+        self._push_head(owner, ref.key, ref)
+
+    def _push_head(self, owner, key, ref):
+        heap = self._heads.get(id(owner))
+        if heap is None:
+            heap = self._heads[id(owner)] = []
+        heapq.heappush(heap, (key, ref))
+
+    def first_verse(self, owner):
+        """ First verse (Ref) that owner currently owns (None if it owns nothing) """
+        heap = self._heads.get(id(owner), [])
+        while heap:
+            key, ref = heap[0]
+            if ref is None:
+                if self.owner_at(key) is owner:
+                    return Ref.from_ordinal(key)
+            elif self.outside.get(ref) is owner:
+                return ref
+            heapq.heappop(heap)
+        return None
+
+    def owners(self):
+        """ Final ownership as VerseOwners, built in one pass over the elementary segments """
+        numbers, owners, size, bounds = self.claim_numbers, self.claim_owners, self.size, self.bounds
+        # push the latest claims down to the leaves (parents come before their children)
+        for i in range(2, size + len(bounds) - 1):
+            parent = i >> 1
+            if numbers[parent] > numbers[i]:
+                numbers[i], owners[i] = numbers[parent], owners[parent]
+        starts, stops, segment_owners = [], [], []
+        for i in range(len(bounds) - 1):
+            owner = owners[size + i]
+            if owner is None:
+                continue
+            if segment_owners and segment_owners[-1] is owner and stops[-1] == bounds[i] - 1:
+                stops[-1] = bounds[i + 1] - 1
+            else:
+                starts.append(bounds[i])
+                stops.append(bounds[i + 1] - 1)
+                segment_owners.append(owner)
+        return VerseOwners(starts, stops, segment_owners, dict(self.outside))
+
+
+class VerseMembership(object):
+    """
+        Records which comments refer to which verses. Each comment is stored once, with its
+        verses as a VerseSet, so that for example a figure linked to 10 chapters costs a single
+        interval instead of one set entry per verse.
+    """
+
+    def __init__(self):
+        self._index = {}  # id(comment) -> position in self._entries
+        self._entries = []  # [comment, VerseSet]
+
+    def add(self, comment, verse_set):
+        idx = self._index.get(id(comment))
+        if idx is None:
+            self._index[id(comment)] = len(self._entries)
+            self._entries.append([comment, verse_set])
+        else:
+            entry = self._entries[idx]
+            entry[1] = entry[1] | verse_set
+
+    def __iter__(self):
+        for comment, verse_set in self._entries:
+            yield comment, verse_set
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class FixOverlappingVersesMixin(object):
     """
     SWORD does not support overlapping verse ranges at all in commentary modules. This means
@@ -49,6 +342,7 @@ class FixOverlappingVersesMixin(object):
     verses to this verse. Approach seems to work pretty well with most SWORD applications.
 
     This class provides fix_overlapping_ranges() function and it's helper functions.
+    State of each comment is kept in CommentRecords (self.comment_records, by id of the div).
     """
 
     def fix_overlapping_ranges(self):
@@ -62,162 +356,191 @@ class FixOverlappingVersesMixin(object):
         """
         logger.info('Fixing overlapping ranges')
         logger.info('... process overlapping verses')
-        self._process_overlapping_verses()
+        if self.options.overlap_resolver == 'legacy':
+            self._process_overlapping_verses()
+        else:
+            self._process_overlapping_verses_intervals()
         if not self.options.no_nonadj:
             logger.info('... create empty comments for nonadjacent ranges (optional step)')
             self._create_empty_comments_for_nonadjancent_ranges()
         logger.info('... add reference links to strings')
         self._add_reference_links_to_comments()
-        logger.info('... sort links')
-        self._sort_links()
+        logger.info('... write link lists')
+        self._write_reference_links()
+        self._write_annotate_refs()
 
-    def create_new_reference_links_list(self, target):
+    def _new_reference_links_list(self, comment):
+        """ 'See also' list of a comment: crossreferences first, then links sorted by verse (last first) """
         links = self.root_soup.new_tag('list', cls='reference_links')
         title = self.root_soup.new_tag('title')
         title.string = 'See also'
         links.append(title)
-        target.append(links)
+        for item in comment.crossrefs:
+            links.append(item)
+        for target in sorted(comment.links, key=lambda c: c.verses.first, reverse=True):
+            title_text, osis_ref = self._link_summary(target)
+            link_item = self.root_soup.new_tag('item')
+            link_tag = self.root_soup.new_tag('reference', osisRef=osis_ref, cls='reference_links')
+            link_tag.append(self.root_soup.new_string(title_text))
+            link_item.append(link_tag)
+            links.append(link_item)
         return links
 
-    def _add_reference_link(self, comment, link_target_comment):
-        def get_final_comment(com):
-            if com.replaced_by:
-                return get_final_comment(com.replaced_by)
-            else:
-                return com
-
-        link_target_comment = get_final_comment(link_target_comment)
-        if comment != link_target_comment and link_target_comment not in comment.links:
-            comment.links.append(link_target_comment)
+    def _write_reference_links(self):
+        # all lists are built before any is added, so that link titles are taken from comment text only
+        lists = [(comment, self._new_reference_links_list(comment)) for comment in self._comments_in_document_order()
+                 if comment.links or comment.crossrefs]
+        for comment, links in lists:
+            comment.tag.append(links)
 
-            links = comment.find('list', cls='reference_links')
-            if not links:
-                links = self.create_new_reference_links_list(comment)
+    def _comments_in_document_order(self):
+        records = self.comment_records
+        return [records[id(t)] for t in self.osistext.find_all('div', annotateType='commentary', recursive=False)]
 
-            link_item = self.root_soup.new_tag('item', comment_link='1')
-            links.append(link_item)
-            is_fig = False
-            is_tab = False
+    def _link_summary(self, comment):
+        """
+            Title and osisRef of 'See also' links to comment. Computed once for each comment,
+            from the beginning of its text only.
+        """
+        summary = comment.link_summary
+        if summary is None:
+            tag = comment.tag
+            parts = []
+            text_length = 0
+            for string in tag.strings:
+                parts.append(string)
+                text_length += len(string)
+                if text_length >= LINK_MAX_LENGTH:
+                    break
+            text = ''.join(parts)
+            objects = {t.name for t in tag.find_all(['figure', 'table'])}
 
             # trying to keep lenght pretty short so that mobile phones would show only one line/link
-            length = LINK_MAX_LENGTH
-            if link_target_comment.find('figure'):
-                length -= 3
-                is_fig = True
-
-            if link_target_comment.find('table'):
-                length -= 3
-                is_tab = True
-
-            title_text = link_target_comment.text[:length].rsplit(' ', 1)[0] + '...'
-
-            if is_fig:
+            length = LINK_MAX_LENGTH - 3 * len(objects)
+            title_text = text[:length].rsplit(' ', 1)[0] + '...'
+            if 'figure' in objects:
                 title_text += ' [F]'
-
-            if is_tab:
+            if 'table' in objects:
                 title_text += ' [T]'
 
-            link_tag = self.root_soup.new_tag('reference', osisRef=self.work_id + ':' +
-                                                                   str(verses(link_target_comment)[0]),
-                                              cls='reference_links')
+            summary = comment.link_summary = (title_text, '%s:%s' % (self.work_id, comment.verses.first))
+        return summary
 
-            link_tag.append(self.root_soup.new_string(title_text))
-            link_item.append(link_tag)
+    def _add_reference_link(self, comment, link_target_comment):
+        link_target_comment = final_comment(link_target_comment)
+        if comment is not link_target_comment:
+            comment.links.add(link_target_comment)
+
+    def _join_comment_content(self, comment, prev_comment):
+        """ Move content of comment into prev_comment and remove comment alltogether """
+        comment.tag.extract()
+        comment.replaced_by = prev_comment
+
+        for tag in list(comment.tag.children):
+            self.tag_data.set(tag, joined_from=comment.orig_ref)
+            prev_comment.tag.append(tag.extract())
+        prev_comment.orig_ref += ' ' + comment.orig_ref
+        prev_comment.crossrefs.extend(comment.crossrefs)
 
     def _merge_into_previous_comment(self, comment, prev_comment):
         """ if the verse is the first reference of prev_item, then merge content of this comment
             into it and remove this comment alltogether """
-        comment = comment.extract()
-        comment['removed'] = 1
-        comment.replaced_by = prev_comment
-
-        for tag in list(comment.children):
-            tag['joined_from'] = comment['origRef']
-            prev_comment.append(tag.extract())
+        self._join_comment_content(comment, prev_comment)
 
-        new_verses = sorted(set(verses(comment) + verses(prev_comment)))
+        new_verses = comment.verses | prev_comment.verses
 
         for v in new_verses:
             existing_comment = self.verse_comment_dict.get(v)
             if not existing_comment:
-                assert 'removed' not in prev_comment.attrs
+                assert prev_comment.replaced_by is None
                 self.verse_comment_dict[v] = prev_comment
-            elif existing_comment == prev_comment:
+            elif existing_comment is prev_comment:
                 pass
-            elif existing_comment == comment:
+            elif existing_comment is comment:
                 self.verse_comment_dict[v] = prev_comment
             else:
                 # some earlier, merged comment
-                assert verses(existing_comment)[0] < new_verses[0]
-                verses_for_existing = verses(existing_comment)
-                verses_for_existing.remove(v)
-                existing_comment['annotateRef'] = references_to_string(verses_for_existing, sort=False)
-                assert existing_comment['annotateRef']
+                assert existing_comment.verses.first < new_verses.first
+                existing_comment.verses -= VerseSet.from_refs([v])
+                assert existing_comment.verses
                 self.verse_comment_dict[v] = prev_comment
 
-        prev_comment['origRef'] += ' ' + comment['origRef']
-        prev_comment['annotateRef'] = ' '.join(str(i) for i in new_verses)
-        assert prev_comment['annotateRef']
+        prev_comment.verses = new_verses
 
     def expand_all_ranges(self):
         all_comments = self.osistext.find_all('div', annotateType='commentary', recursive=False)
 
         # first expand all ranges
         for comment in all_comments:
-            comment['origRef'] = comment['annotateRef']
-            comment.links = []
-            comment.replaced_by = None
-
-            vs = expand_ranges(comment['annotateRef'], verses=True)
-            comment['firstRef'] = str(vs[0])
-            self.verse_comments_firstref_dict[vs[0]] = comment
+            vs = expand_ranges(comment['annotateRef'], verse_set=True)
+            first = vs.first
+            record = CommentRecord(comment, comment['annotateRef'], vs)
+            self.verse_comments_firstref_dict[first] = record
 
             # make figures and tables linked to some larger range: rest of this chapter as well as whole next chapter
             if comment.find(re.compile('(figure|table)')):
-                first = vs[0]
                 chap = min(first.chapter + NUMBER_OF_CHAPTERS_FOR_FIGURES_AND_TABLES, LAST_CHAPTERS[first.book])
-                ver = CHAPTER_LAST_VERSES['%s.%s' % (first.book, chap)]
-                last = Ref('%s.%s.%s' % (first.book, chap, ver))
-                vs2 = expand_ranges('%s-%s' % (first, last), verses=True)
-                vs = sorted(set(vs + vs2))
-
-            comment.orig_expanded = vs
-            comment['annotateRef'] = ' '.join(str(i) for i in vs)
-            assert comment['annotateRef']
-            for v in vs:
-                vl = self.verse_comments_all_dict.get(v)
-                if not vl:
-                    vl = self.verse_comments_all_dict[v] = set()
-                vl.add(comment)
+                vs |= VerseSet.range(first, chapter_end(first.book_int, chap))
+                record.orig_verses = record.verses = vs
+
+            self.comment_records[id(comment)] = record
+            self.verse_comments_all.add(record, vs)
 
     def _process_overlapping_verses(self):
-        all_comments = self.osistext.find_all('div', annotateType='commentary', recursive=False)
-        for comment in all_comments:
-            if 'removed' in comment.attrs:
+        for comment in self._comments_in_document_order():
+            if comment.replaced_by is not None:
                 # this comment has been merged earlier
                 continue
 
-            comment_verses = verses(comment)
-            for v in copy(comment_verses):
+            comment_verses = list(comment.verses)
+            for v in comment_verses:
                 prev_comment = self.verse_comment_dict.get(v)
                 if prev_comment:
-                    verses_for_prev = verses(prev_comment)
-                    if v == verses_for_prev[0] == comment_verses[0]:
+                    if v == prev_comment.verses.first == comment_verses[0]:
                         self._merge_into_previous_comment(comment, prev_comment)
                         break
 
-                    if v in verses_for_prev:
-                        verses_for_prev.remove(v)
-
-                    prev_comment['annotateRef'] = ' '.join(str(i) for i in verses_for_prev)
-                    assert prev_comment['annotateRef']
+                    prev_comment.verses -= VerseSet.from_refs([v])
+                    assert prev_comment.verses
                     self.verse_comment_dict[v] = comment
 
                 else:
-                    assert 'removed' not in comment.attrs
+                    assert comment.replaced_by is None
                     self.verse_comment_dict[v] = comment
 
-            comment['annotateRef'] = ' '.join(str(i) for i in comment_verses)
+    def _process_overlapping_verses_intervals(self):
+        """
+            Same result as _process_overlapping_verses, but verses are claimed interval by
+            interval (see VerseClaims), and each comment claims its verses only once.
+
+            Comments are processed in document order: later comment takes the verses
+            from earlier ones, except if its first verse is also the first verse of the
+            current owner, in which case it is merged into that owner.
+        """
+        all_comments = self._comments_in_document_order()
+        claims = VerseClaims([i for comment in all_comments for i in comment.orig_verses.intervals()])
+        roots = []
+        for comment in all_comments:
+            verse_set = comment.orig_verses
+            first = verse_set.first
+            prev_comment = claims.get(first)
+            if prev_comment is not None and claims.first_verse(prev_comment) == first:
+                self._join_comment_content(comment, prev_comment)
+                target = prev_comment
+            else:
+                roots.append(comment)
+                target = comment
+            for start, stop in verse_set.intervals():
+                claims.claim(start, stop, target)
+            for ref in verse_set.outside:
+                claims.claim_outside(ref, target)
+
+        owners = claims.owners()
+        verse_sets = owners.verse_sets()
+        for comment in roots:
+            comment.verses = verse_sets.get(id(comment))
+            assert comment.verses, 'comment %s lost all of its verses' % comment.orig_ref
+        self.verse_comment_dict = owners
 
     def _create_empty_comments_for_nonadjancent_ranges(self):
         """
@@ -228,46 +551,56 @@ class FixOverlappingVersesMixin(object):
                     Step is optional -- if we leave this step, then those verses will be linked
             to the original verse in its range
         """
-        all_comments = self.osistext.find_all('div', annotateType='commentary', recursive=False)
-        for comment in all_comments:
-            orig_verses = comment.orig_expanded
-            actual_verses = verses(comment)
-            new_actual_verses = set(copy(actual_verses))
-
-            for rng in find_subranges(orig_verses, actual_verses)[1:]:
+        for comment in self._comments_in_document_order():
+            moved_verses = []
+            for rng in find_subranges(comment.orig_verses, comment.verses)[1:]:
                 empty_comment = self._create_empty_comment(rng)
                 for v in rng:
-                    assert self.verse_comment_dict[v] == comment
+                    assert self.verse_comment_dict[v] is comment
                     self.verse_comment_dict[v] = empty_comment
-                new_actual_verses -= set(rng)
-                comment.insert_after(empty_comment)
-            comment['annotateRef'] = references_to_string(new_actual_verses)
-            assert comment['annotateRef']
+                moved_verses.extend(rng)
+                comment.tag.insert_after(empty_comment.tag)
+            if moved_verses:
+                comment.verses -= VerseSet.from_refs(moved_verses)
+            assert comment.verses
 
     def _add_reference_links_to_comments(self):
         # Add 'see also' reference links to comments with larger range
-        for ref, comment_set in self.verse_comments_all_dict.items():
-            main_comment = self.verse_comment_dict[ref]
-            for comment in comment_set:
-                if comment != main_comment:
+        verse_comment_dict = self.verse_comment_dict
+        for comment, verse_set in self.verse_comments_all:
+            if isinstance(verse_comment_dict, VerseOwners):
+                # one lookup per owner segment instead of one per verse
+                main_comments = itertools.chain(
+                    (owner for start, stop in verse_set.intervals() for owner in verse_comment_dict.owners_in(start, stop)),
+                    (verse_comment_dict[ref] for ref in verse_set.outside))
+            else:
+                main_comments = (verse_comment_dict[ref] for ref in verse_set)
+            previous_main_comment = None
+            for main_comment in main_comments:
+                # consecutive verses mostly share the main comment
+                if main_comment is not previous_main_comment and main_comment is not comment:
                     self._add_reference_link(main_comment, comment)
+                previous_main_comment = main_comment
 
-    def _sort_links(self):
-        # Sort links
-        for ref_links_list in self.osistext.find_all('list', cls='reference_links'):
-            ref_links_list.parent.append(ref_links_list.extract()) # make sure this list is last
-            sort_tag_content(ref_links_list, lambda x: Ref(x.reference['osisRef']), 'item', comment_link=True, reverse=True)
+    def _write_annotate_refs(self):
+        """
+            Write final verses of each comment into annotateRef attributes, either as
+            collapsed OSIS ranges (Gen.1.1-Gen.1.5) or as fully enumerated verse lists.
+        """
+        collapse = self.options.collapse_ranges
+        for comment in self._comments_in_document_order():
+            if collapse:
+                comment.tag['annotateRef'] = str(comment.verses)
+            else:
+                comment.tag['annotateRef'] = ' '.join(str(i) for i in comment.verses)
 
     def _create_empty_comment(self, verses):
         if isinstance(verses, (list, set)):
             verses = references_to_string(verses)
         verses = str(verses)
 
-        comment = self.root_soup.new_tag('div', annotateType='commentary', type='section', annotateRef=verses,
-                                         new_empty='1')
-        comment.links = []
-        comment['origRef'] = comment['annotateRef']
-        comment.orig_expanded = expand_ranges(verses, verses=True)
-        comment['origFile'] = self.current_filename
-        comment.replaced_by = None
-        return comment
+        comment = self.root_soup.new_tag('div', annotateType='commentary', type='section', annotateRef=verses)
+        self.tag_data.set(comment, new_empty=True, origFile=self.current_filename)
+        record = CommentRecord(comment, verses, expand_ranges(verses, verse_set=True))
+        self.comment_records[id(comment)] = record
+        return record
@@ -0,0 +1,103 @@
+# encoding: utf-8
+"""
+    Copyright (C) 2015 Tuomas Airaksinen.
+    See LICENCE.txt
+"""
+import struct
+
+NODE_OFFSETS = struct.Struct('<iii')  # parent, next sibling, first child (as .idx offsets, -1 if none)
+ENTRY_DATA = struct.Struct('<II')  # start and size of entry in .bdt file
+IDX_ENTRY = struct.Struct('<I')  # start of node record in .dat file
+
+
+class RawGenBookWriter(object):
+    """
+        Writes SWORD RawGenBook module files: entries into path.bdt and the tree key
+        (TreeKeyIdx) into path.idx and path.dat. Path is the DataPath of the module,
+        as given to xml2gbs.
+
+        Keys are paths of node names separated by separator ('/' in xml2gbs); missing
+        parent nodes are created on the way. Each node record is written only once, in the
+        order the nodes were created.
+    """
+
+    def __init__(self, path, separator='/'):
+        self.path = path
+        self.separator = separator
+        # node id -> [name, parent, next sibling, first child, (entry start, size) or None]
+        self.nodes = [['', -1, -1, -1, None]]
+        self.last_child = {}  # node id -> its last child id
+        self.node_ids = {'': 0}  # key -> node id
+        self.data = open(path + '.bdt', 'wb')
+
+    def _node(self, key):
+        node = self.node_ids.get(key)
+        if node is None:
+            parent_key, _, name = key.rpartition(self.separator)
+            parent = self._node(parent_key)
+            node = len(self.nodes)
+            self.nodes.append([name, parent, -1, -1, None])
+            last_child = self.last_child.get(parent)
+            if last_child is None:
+                self.nodes[parent][3] = node
+            else:
+                self.nodes[last_child][2] = node
+            self.last_child[parent] = node
+            self.node_ids[key] = node
+        return node
+
+    def set_entry(self, key, text):
+        """ Write entry text (bytes) of key """
+        self.nodes[self._node(key)][4] = (self.data.tell(), len(text))
+        self.data.write(text)
+
+    def close(self):
+        self.data.close()
+        idx_offset = IDX_ENTRY.size
+        with open(self.path + '.dat', 'wb') as dat, open(self.path + '.idx', 'wb') as idx:
+            for name, parent, next_sibling, first_child, entry in self.nodes:
+                idx.write(IDX_ENTRY.pack(dat.tell()))
+                dat.write(NODE_OFFSETS.pack(*[n * idx_offset if n >= 0 else -1
+                                              for n in (parent, next_sibling, first_child)]))
+                dat.write(name.encode('utf-8') + b'\0')
+                if entry is None:
+                    dat.write(struct.pack('<H', 0))
+                else:
+                    dat.write(struct.pack('<H', ENTRY_DATA.size) + ENTRY_DATA.pack(*entry))
+
+
+def read_genbook(path, separator='/'):
+    """
+        Read entries of a RawGenBook module. Returns dict key -> entry text (bytes),
+        for keys that have an entry.
+    """
+    with open(path + '.idx', 'rb') as f:
+        idx = f.read()
+    with open(path + '.dat', 'rb') as f:
+        dat = f.read()
+    with open(path + '.bdt', 'rb') as f:
+        bdt = f.read()
+
+    def node(idx_offset):
+        start = IDX_ENTRY.unpack_from(idx, idx_offset)[0]
+        parent, next_sibling, first_child = NODE_OFFSETS.unpack_from(dat, start)
+        name_end = dat.index(b'\0', start + NODE_OFFSETS.size)
+        name = dat[start + NODE_OFFSETS.size:name_end].decode('utf-8')
+        entry = None
+        if struct.unpack_from('<H', dat, name_end + 1)[0] >= ENTRY_DATA.size:
+            entry = ENTRY_DATA.unpack_from(dat, name_end + 3)
+        return name, next_sibling, first_child, entry
+
+    entries = {}
+    stack = [(node(0)[2], '')]  # (idx offset, key of parent)
+    while stack:
+        idx_offset, parent_key = stack.pop()
+        if idx_offset < 0:
+            continue
+        name, next_sibling, first_child, entry = node(idx_offset)
+        key = '%s%s%s' % (parent_key, separator, name) if parent_key else name
+        if entry is not None:
+            entries[key] = bdt[entry[0]:entry[0] + entry[1]]
+        stack.append((next_sibling, parent_key))
+        stack.append((first_child, key))
+    return entries
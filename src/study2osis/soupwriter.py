@@ -0,0 +1,89 @@
+# encoding: utf-8
+"""
+    Copyright (C) 2015 Tuomas Airaksinen.
+    See LICENCE.txt
+"""
+
+from bs4 import BeautifulSoup, Tag, NavigableString
+
+CHUNK_SIZE = 1 << 16
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _quoted_attribute(value):
+    # same as EntitySubstitution.quoted_attribute_value
+    if isinstance(value, (list, tuple)):
+        value = ' '.join(value)
+    value = _escape(str(value))
+    if '"' in value:
+        if "'" in value:
+            return '"%s"' % value.replace('"', '&quot;')
+        return "'%s'" % value
+    return '"%s"' % value
+
+
+def _start_tag(tag, empty):
+    name = '%s:%s' % (tag.prefix, tag.name) if tag.prefix else tag.name
+    attrs = ''.join(' %s=%s' % (key, _quoted_attribute(value)) if value is not None else ' %s' % key
+                    for key, value in sorted(tag.attrs.items()))
+    return '<%s%s%s>' % (name, attrs, '/' if empty else ''), '</%s>' % name
+
+
+def write_soup(soup, outputs, encoding='utf-8', chunk_size=CHUNK_SIZE):
+    """
+        Serialize soup (a document or a single tag) into binary file objects outputs.
+        The result is the same as str(soup).encode(encoding), but the document is
+        walked once and written in encoded chunks of about chunk_size characters,
+        so that it is never in memory as a single string, and the same
+        serialization can be written into several outputs (files or pipes).
+    """
+    pieces = []
+    size = 0
+
+    def flush():
+        data = ''.join(pieces).encode(encoding)
+        for output in outputs:
+            output.write(data)
+        pieces.clear()
+
+    if isinstance(soup, BeautifulSoup):
+        if soup.is_xml:
+            pieces.append('<?xml version="1.0" encoding="%s"?>\n' % encoding)
+        stack = [iter(soup.contents)]
+    else:
+        stack = [iter([soup])]
+    end_tags = [None]
+
+    while stack:
+        for node in stack[-1]:
+            if isinstance(node, Tag):
+                if node.hidden:
+                    stack.append(iter(node.contents))
+                    end_tags.append(None)
+                    break
+                empty = not node.contents and node.can_be_empty_element
+                start, end = _start_tag(node, empty)
+                pieces.append(start)
+                size += len(start)
+                if node.contents:
+                    stack.append(iter(node.contents))
+                    end_tags.append(end)
+                    break
+                if not empty:
+                    pieces.append(end)
+            else:
+                piece = _escape(node) if type(node) is NavigableString else node.output_ready('minimal')
+                pieces.append(piece)
+                size += len(piece)
+            if size > chunk_size:
+                flush()
+                size = 0
+        else:
+            stack.pop()
+            end = end_tags.pop()
+            if end is not None:
+                pieces.append(end)
+    flush()
@@ -0,0 +1,166 @@
+# encoding: utf-8
+"""
+    Copyright (C) 2015 Tuomas Airaksinen.
+    See LICENCE.txt
+"""
+import logging
+import os
+import struct
+import zlib
+
+from .bible_data import BOOK_CHAPTERS, CHAPTER_VERSES
+from .bibleref import Ref, VERSE_BOOK, VERSE_CHAPTER, VERSE_NUMBER, VERSE_COUNT
+
+logger = logging.getLogger('study2osis')
+
+OT_BOOKS = 39
+VERSE_BLOCKS, CHAPTER_BLOCKS, BOOK_BLOCKS = 2, 3, 4
+BLOCK_LETTERS = {VERSE_BLOCKS: 'v', CHAPTER_BLOCKS: 'c', BOOK_BLOCKS: 'b'}  # zVerse::uniqueIndexID
+TESTAMENTS = ('ot', 'nt')
+VERSE_ENTRY = struct.Struct('<IIH')  # block, start in uncompressed block, size
+BLOCK_ENTRY = struct.Struct('<III')  # start in .zz file, compressed size, uncompressed size
+MAX_ENTRY_SIZE = 0xffff  # entry sizes are 16-bit in the verse index
+
+
+def _build_index_table():
+    """
+        Index of each chapter heading within its testament, as in SWORD VersificationMgr
+        (intros included): 0 is module heading and 1 testament heading, and each book and
+        chapter has a heading entry before its chapters and verses.
+        Returns chapter headings per book and number of index entries in each testament.
+    """
+    headings = []
+    offset = 1
+    nt_start = 0
+    chapter_verses = iter(CHAPTER_VERSES)
+    for book_int, last_chapter in enumerate(BOOK_CHAPTERS):
+        if book_int == OT_BOOKS:
+            nt_start = offset
+            offset += 1  # testament heading
+        offset += 1  # book heading
+        book_headings = []
+        for chap in range(last_chapter):
+            offset += 1
+            book_headings.append(offset - nt_start)
+            offset += next(chapter_verses)
+        headings.append(book_headings)
+    return headings, (nt_start + 1, offset - nt_start + 1)
+
+
+CHAPTER_HEADINGS, TESTAMENT_SIZES = _build_index_table()
+
+
+def verse_index(ref):
+    """ (testament, index within testament) of a verse in a zVerse module """
+    ordinal = ref.ordinal
+    book_int = VERSE_BOOK[ordinal]
+    return int(book_int >= OT_BOOKS), CHAPTER_HEADINGS[book_int][VERSE_CHAPTER[ordinal] - 1] + VERSE_NUMBER[ordinal]
+
+
+class ZComWriter(object):
+    """
+        Writes SWORD zCom module files (NRSV versification, zip compression), in the same way
+        as libsword zVerse does for osis2mod: entries are collected into a block until a verse
+        of another block (chapter, book or verse, depending on block_type) is written,
+        and the block is then compressed and written.
+    """
+
+    def __init__(self, path, block_type=CHAPTER_BLOCKS):
+        self.path = path
+        self.block_type = block_type
+        self.verse_indexes = [bytearray(VERSE_ENTRY.size * size) for size in TESTAMENT_SIZES]
+        self.blocks = ([], [])  # (start, compressed size, size) of the written blocks of each testament
+        self.text_files = [open(self._filename(t, 'z'), 'wb') for t in TESTAMENTS]
+        self.cache = bytearray()
+        self.cache_block = None  # (testament, block number) of the block in cache
+        self.last_key = None
+
+    def _filename(self, testament, kind):
+        return os.path.join(self.path, '%s.%sz%s' % (testament, BLOCK_LETTERS[self.block_type], kind))
+
+    def _block_key(self, ref):
+        key = (int(VERSE_BOOK[ref.ordinal] >= OT_BOOKS), VERSE_BOOK[ref.ordinal])
+        if self.block_type <= CHAPTER_BLOCKS:
+            key += (VERSE_CHAPTER[ref.ordinal],)
+        if self.block_type <= VERSE_BLOCKS:
+            key += (VERSE_NUMBER[ref.ordinal],)
+        return key
+
+    def set_entry(self, ref, text):
+        """ Write entry text (bytes) of verse ref """
+        if len(text) > MAX_ENTRY_SIZE:
+            raise Exception('Entry of %s is too long for zCom (%s bytes)' % (ref, len(text)))
+        key = self._block_key(ref)
+        if key != self.last_key:
+            self._flush()
+        self.last_key = key
+        testament, index = verse_index(ref)
+        if self.cache_block is None:
+            self.cache_block = (testament, len(self.blocks[testament]))
+            self.cache = bytearray()
+        block, start = (self.cache_block[1], len(self.cache)) if text else (0, 0)
+        VERSE_ENTRY.pack_into(self.verse_indexes[testament], index * VERSE_ENTRY.size, block, start, len(text))
+        self.cache += text
+
+    def link_entry(self, ref, source_ref):
+        """ Make verse ref refer to the entry of source_ref, which must be in the same testament """
+        testament, index = verse_index(ref)
+        source_testament, source = verse_index(source_ref)
+        if source_testament != testament:
+            raise Exception('Cannot link %s to %s in another testament' % (ref, source_ref))
+        source *= VERSE_ENTRY.size
+        verse_index_data = self.verse_indexes[testament]
+        verse_index_data[index * VERSE_ENTRY.size:(index + 1) * VERSE_ENTRY.size] = \
+            verse_index_data[source:source + VERSE_ENTRY.size]
+
+    def _flush(self):
+        if self.cache_block is not None and self.cache:
+            testament = self.cache_block[0]
+            data = zlib.compress(bytes(self.cache), 6)
+            text_file = self.text_files[testament]
+            self.blocks[testament].append((text_file.tell(), len(data), len(self.cache)))
+            text_file.write(data)
+        self.cache_block = None
+        self.cache = bytearray()
+
+    def close(self):
+        self._flush()
+        for i, testament in enumerate(TESTAMENTS):
+            self.text_files[i].close()
+            with open(self._filename(testament, 's'), 'wb') as f:
+                for block in self.blocks[i]:
+                    f.write(BLOCK_ENTRY.pack(*block))
+            with open(self._filename(testament, 'v'), 'wb') as f:
+                f.write(self.verse_indexes[i])
+
+
+def read_zcom(path, block_type=CHAPTER_BLOCKS):
+    """
+        Read entries of a zCom module. Returns dict verse ordinal -> entry text (bytes),
+        for verses that have an entry.
+    """
+    letter = BLOCK_LETTERS[block_type]
+    data = {}
+    for testament in TESTAMENTS:
+        with open(os.path.join(path, '%s.%szs' % (testament, letter)), 'rb') as f:
+            index = f.read()
+        blocks = [BLOCK_ENTRY.unpack_from(index, i) for i in range(0, len(index), BLOCK_ENTRY.size)]
+        with open(os.path.join(path, '%s.%szz' % (testament, letter)), 'rb') as f:
+            text = f.read()
+        with open(os.path.join(path, '%s.%szv' % (testament, letter)), 'rb') as f:
+            data[testament] = (blocks, text, f.read())
+
+    entries = {}
+    uncompressed = {}
+    for ordinal in range(VERSE_COUNT):
+        testament, index = verse_index(Ref.from_ordinal(ordinal))
+        blocks, text, verse_index_data = data[TESTAMENTS[testament]]
+        if (index + 1) * VERSE_ENTRY.size > len(verse_index_data):
+            continue
+        block, start, size = VERSE_ENTRY.unpack_from(verse_index_data, index * VERSE_ENTRY.size)
+        if size:
+            if (testament, block) not in uncompressed:
+                block_start, zsize, _ = blocks[block]
+                uncompressed[testament, block] = zlib.decompress(text[block_start:block_start + zsize])
+            entries[ordinal] = uncompressed[testament, block][start:start + size]
+    return entries
@@ -3,12 +3,18 @@
     Copyright (C) 2015 Tuomas Airaksinen.
     See LICENCE.txt
 """
-from study2osis.html2osis import parse_studybible_reference, HTML2OsisMixin
-from study2osis.overlapping import find_subranges
+from study2osis.html2osis import parse_studybible_reference, studybible_ref, guess_range_end, HTML2OsisMixin
+from study2osis.overlapping import find_subranges, VerseMembership
 
-from study2osis.main import Commentary, Articles
-from study2osis.bibleref import Ref, expand_ranges, first_reference, last_reference, xrefrange, refrange
+from study2osis.main import Commentary, Articles, make_soup
+from study2osis.bibleref import Ref, expand_ranges, first_reference, last_reference, xrefrange, refrange, \
+    chapter_end, IllegalReference, VerseSet
 from bs4 import BeautifulSoup
+import pickle
+import os
+import shutil
+import traceback
+import subprocess
 
 def com_text(osistext, ref):
     com = osistext.find_all('div', annotateRef=str(ref))
@@ -33,6 +39,10 @@ class options:
     commentary_images_path = ''
     articles_images_path = ''
     no_nonadj = False
+    overlap_resolver = "intervals"
+    collapse_ranges = False
+    parser = "bs4"
+    jobs = 1
     tag_level = 0
     metadata = {}
 
@@ -202,6 +212,26 @@ def test_rowspan(osistext, result):
     s.fix_table_rowspan(osistext_.find('body'))
     assert str(osistext_) == str(result__)
 
+def test_normalize_table():
+    osistext = BeautifulSoup("""<body><table><tr><th colspan="2" rowspan="2">a</th><td>b</td></tr>"""
+                             """<tr><td rowspan="2">c</td></tr><tr><td>d</td></tr></table></body>""", 'xml')
+    result = BeautifulSoup("""<body><table><row><cell role="label">a</cell><cell add="1"> </cell><cell>b</cell></row>"""
+                           """<row><cell add="1"> </cell><cell add="1"> </cell><cell>c</cell></row>"""
+                           """<row><cell>d</cell><cell add="1"> </cell><cell add="1"> </cell></row></table></body>""",
+                           'xml')
+
+    s = Articles(options, None)
+    s.normalize_table(osistext.find('body'))
+    assert str(osistext) == str(result)
+
+    # rowspans do not continue from thead into tbody
+    osistext = BeautifulSoup("""<table><thead><tr><th rowspan="3">a</th><th>b</th></tr></thead>"""
+                             """<tbody><tr><td>c</td><td>d</td></tr></tbody></table>""", 'xml')
+    s.normalize_table(osistext)
+    assert str(osistext.table) == \
+        """<table><thead><row><cell role="label">a</cell><cell role="label">b</cell></row></thead>""" \
+        """<tbody><row><cell>c</cell><cell>d</cell></row></tbody></table>"""
+
 def test_expand_ranges():
     assert expand_ranges("Gen.2.4-Gen.2.6") == "Gen.2.4 Gen.2.5 Gen.2.6"
     assert expand_ranges("Gen.1.30-Gen.2.1") == "Gen.1.30 Gen.1.31 Gen.2.1"
@@ -250,6 +280,28 @@ def test_ref():
     assert list(xrefrange(Ref('Gen.1.1'), 'Gen.1.4')) == [Ref("Gen.1.1"), Ref("Gen.1.2"), Ref("Gen.1.3"), Ref("Gen.1.4")]
     assert Ref('Rev', 1, 1) == Ref('Rev.1.1')
 
+def test_ref_ordinals():
+    assert Ref('Gen.1.1').ordinal == 0
+    assert Ref('Rev.22.21').ordinal == 31102
+    assert Ref('Gen.1.1') is Ref('Gen', 1, 1) is Ref(('Gen', 1, 1)) is Ref.from_ordinal(0)
+    assert next(Ref('Gen.1.1')).ordinal == 1
+    assert list(Ref('Rev.22.20').iter()) == [Ref('Rev.22.20'), Ref('Rev.22.21')]
+    with pytest.raises(Ref('Rev.22.21').LastVerse):
+        next(Ref('Rev.22.21'))
+    assert pickle.loads(pickle.dumps(Ref('Gen.1.1'))) is Ref('Gen.1.1')
+    assert chapter_end('Gen', 1) == Ref('Gen.1.31')
+    assert chapter_end('Gen', 50) == Ref('Gen.50.26')
+    with pytest.raises(IllegalReference):
+        Ref('Blah.1.1')
+
+def test_ref_outside_versification():
+    assert Ref('Isa.12.6') < Ref('Isa.12.10') < Ref('Isa.12.11') < Ref('Isa.13.1')
+    assert Ref('Isa.12.10').chapter == 12 and Ref('Isa.12.10').verse == 10
+    assert str(Ref('Isa.12.10')) == 'Isa.12.10'
+    assert next(Ref('Isa.12.10')) == Ref('Isa.13.1')
+    assert list(xrefrange('Isa.12.5', 'Isa.12.10')) == [Ref('Isa.12.5'), Ref('Isa.12.6')]
+    assert pickle.loads(pickle.dumps(Ref('Isa.12.10'))) is Ref('Isa.12.10')
+
 def test_guess_range_end():
     h = HTML2OsisMixin()
     g = h._guess_range_end
@@ -263,6 +315,30 @@ def test_guess_range_end():
     assert g(Ref('1Cor.3.16'), c('1 Cor. 3:16–17')) == Ref('1Cor.3.17')
     assert g(Ref('1Cor.3.16'), c('vv. 16-17')) == Ref('1Cor.3.17')
 
+def test_guess_range_end_conflicts():
+    assert guess_range_end(Ref('Gen.2.1'), 'ch. 2') is None
+    assert guess_range_end(Ref('Gen.2.3'), 'v. 3') is None
+    assert guess_range_end(Ref('Gen.2.3'), '2:3a-4:1') == Ref('Gen.4.1')
+    assert guess_range_end(Ref('Gen.2.3'), 'Matt 1:1') is None
+    errors = []
+    for i in range(3):  # later times from memo
+        with pytest.raises(AssertionError) as e:
+            guess_range_end(Ref('Gen.2.3'), 'ch. 2')
+        errors.append(e.value)
+        with pytest.raises(AssertionError):
+            guess_range_end(Ref('Gen.2.3'), 'vv. 4-5')
+    # a new exception each time, so tracebacks do not accumulate
+    assert errors[1] is not errors[2]
+    assert len(traceback.extract_tb(errors[1].__traceback__)) == len(traceback.extract_tb(errors[2].__traceback__))
+
+def test_parse_studybible_reference_illegal():
+    assert studybible_ref('v01002003') is Ref('Gen.2.3')
+    assert parse_studybible_reference('n36002012-outline') == 'Zeph.2.12'
+    for html_id in ['n01001001-outline', 'x01001001', 'n0100100', 'n01001001d', '']:
+        for i in range(2):
+            with pytest.raises(IllegalReference):
+                parse_studybible_reference(html_id)
+
 def test_find_subranges():
     orig_range = refrange('Gen.1.1', 'Gen.1.8')
     act_range = refrange('Gen.1.1', 'Gen.1.3') + refrange('Gen.1.6', 'Gen.1.8')
@@ -279,3 +355,725 @@ def test_find_subranges():
     subranges = find_subranges(orig_range, act_range)
     assert subranges == [refrange('Gen.1.1', 'Gen.1.4'),  refrange('Gen.1.6', 'Gen.1.8')]
 
+
+def test_versification_table(tmp_path):
+    from study2osis.bible_data import (LAST_CHAPTERS, CHAPTER_LAST_VERSES, BOOK_CHAPTERS, CHAPTER_VERSES,
+                                       write_versification_table, read_versification_table)
+    assert LAST_CHAPTERS['Ps'] == 150
+    assert CHAPTER_LAST_VERSES['Ps.119'] == 176
+    assert sum(CHAPTER_VERSES) == 31103
+    filename = str(tmp_path / 'table.bin')
+    write_versification_table(LAST_CHAPTERS, CHAPTER_LAST_VERSES, filename)
+    assert read_versification_table(filename) == (BOOK_CHAPTERS, CHAPTER_VERSES)
+
+    from study2osis.bible_data import get_verse_ranges, VERSIFICATION_TABLE
+    osis_file = tmp_path / 'esvs.osis'
+    osis_file.write_text('<osis><verse osisID="Gen.1.1"/><verse osisID="Gen.1.2"/><verse osisID="Gen.2.1"/></osis>')
+    table_mtime = os.stat(VERSIFICATION_TABLE).st_mtime
+    assert get_verse_ranges(str(osis_file)) == ({'Gen': 2}, {'Gen.1': 2, 'Gen.2': 1})
+    assert os.stat(VERSIFICATION_TABLE).st_mtime == table_mtime
+
+def test_lazy_imports():
+    import sys
+    code = 'import sys, study2osis; print(sorted({"bs4", "jinja2", "ipdb"} & set(sys.modules)))'
+    output = subprocess.check_output([sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    assert output.strip() == b'[]'
+
+def test_verse_set():
+    vs = VerseSet.from_string('Gen.1.30-Gen.2.2 Gen.1.1 Gen.1.2')
+    assert str(vs) == 'Gen.1.1-Gen.1.2 Gen.1.30-Gen.2.2'
+    assert len(vs) == 6
+    assert vs.first == Ref('Gen.1.1')
+    assert vs.last == Ref('Gen.2.2')
+    assert Ref('Gen.1.31') in vs
+    assert 'Gen.1.3' not in vs
+    assert list(vs) == [Ref('Gen.1.1'), Ref('Gen.1.2'), Ref('Gen.1.30'), Ref('Gen.1.31'), Ref('Gen.2.1'), Ref('Gen.2.2')]
+    assert str(vs | VerseSet.from_string('Gen.1.3-Gen.1.29')) == 'Gen.1.1-Gen.2.2'
+    assert str(vs - VerseSet.from_string('Gen.1.2-Gen.1.31')) == 'Gen.1.1 Gen.2.1-Gen.2.2'
+    assert str(vs & VerseSet.range('Gen.1.2', 'Gen.1.31')) == 'Gen.1.2 Gen.1.30-Gen.1.31'
+    assert VerseSet.from_refs(refrange('Gen.1.1', 'Gen.1.5')) == VerseSet.range('Gen.1.1', 'Gen.1.5')
+    whole_bible = expand_ranges('Gen.1.1-Rev.22.21', verse_set=True)
+    assert len(whole_bible) == 31103 and len(whole_bible.starts) == 1
+    assert first_reference(whole_bible) == ('Gen', 1, 1)
+    assert last_reference(whole_bible) == ('Rev', 22, 21)
+    assert str(VerseSet.from_string('Isa.12.10 Isa.12.6')) == 'Isa.12.6 Isa.12.10'
+
+def test_verse_membership():
+    m = VerseMembership()
+    figure, note = object(), object()
+    m.add(figure, VerseSet.range('Gen.1.1', 'Gen.11.32'))
+    m.add(note, VerseSet.from_string('Gen.1.2'))
+    m.add(note, VerseSet.from_string('Gen.1.3'))
+    assert len(m) == 2
+    assert [len(vs.starts) for c, vs in m] == [1, 1]
+    assert [c for c, vs in m if Ref('Gen.1.3') in vs] == [figure, note]
+    assert [c for c, vs in m if Ref('Gen.12.1') in vs] == []
+
+def test_verse_owners():
+    from study2osis.overlapping import VerseOwners
+    owners = VerseOwners()
+    a, b = object(), object()
+    owners.assign(0, 99, a)
+    owners.assign(10, 19, b)
+    assert owners[Ref.from_ordinal(15)] is b and owners[Ref.from_ordinal(20)] is a
+    assert list(owners.owners_in(0, 99)) == [a, b, a]
+    assert list(owners.owners_in(12, 15)) == [b]
+    assert list(owners.owners_in(19, 20)) == [b, a]
+    assert list(owners.owners_in(100, 200)) == []
+    owners[Ref('Gen.1.32')] = b
+    assert owners[Ref('Gen.1.32')] is b and Ref('Gen.1.33') not in owners
+    assert owners.verse_sets()[id(b)] == VerseSet([(10, 19)], [Ref('Gen.1.32')])
+
+def test_verse_claims():
+    from study2osis.overlapping import VerseClaims
+    a, b, c = object(), object(), object()
+    claims = VerseClaims([(0, 99), (10, 19), (20, 29), (5, 9)])
+    claims.claim(0, 99, a)
+    claims.claim(10, 19, b)
+    assert claims.owner_at(15) is b and claims.owner_at(20) is a and claims.owner_at(100) is None
+    assert claims.first_verse(b) == Ref.from_ordinal(10)
+    claims.claim(5, 9, c)
+    claims.claim(20, 29, c)
+    claims.claim_outside(Ref('Gen.1.32'), b)
+    assert claims.first_verse(a) == Ref.from_ordinal(0)
+    assert claims.first_verse(c) == Ref.from_ordinal(5)
+    claims.claim(0, 99, c)
+    assert claims.first_verse(a) is None and claims.first_verse(b) == Ref('Gen.1.32')
+    owners = claims.owners()
+    assert (owners.starts, owners.stops, owners.owners) == ([0], [99], [c])
+    assert owners[Ref('Gen.1.32')] is b
+
+def _resolve_overlapping(xml, resolver, no_nonadj=False):
+    class resolver_options(options):
+        pass
+    resolver_options.overlap_resolver = resolver
+    resolver_options.no_nonadj = no_nonadj
+    osistext = BeautifulSoup(xml, 'xml')
+    s = Commentary(resolver_options)
+    s.root_soup = osistext
+    s.osistext = osistext.find('osisText')
+    s.expand_all_ranges()
+    s.fix_overlapping_ranges()
+    return str(osistext)
+
+def test_overlap_resolvers_give_same_result():
+    import random
+    rnd = random.Random(1)
+    compared = 0
+    for _ in range(60):
+        divs = []
+        pos = rnd.choice([0, 25])
+        for k in range(rnd.randint(1, 10)):
+            pos = max(0, pos + rnd.choice([0, 0, 1, 1, 2, 3, 5, -1]))
+            ref = str(Ref.from_ordinal(pos))
+            if rnd.random() < 0.5:
+                ref += '-%s' % Ref.from_ordinal(pos + rnd.randint(0, 8))
+            if rnd.random() < 0.2:
+                start = pos + rnd.randint(9, 20)
+                ref += ' %s-%s' % (Ref.from_ordinal(start), Ref.from_ordinal(start + rnd.randint(0, 3)))
+            if rnd.random() < 0.2:
+                # verses outside versification, between Gen.1.31 and Gen.2.1
+                outside = 'Gen.1.%s' % rnd.choice([32, 33])
+                ref = '%s %s' % (outside, ref) if rnd.random() < 0.5 else '%s %s' % (ref, outside)
+            table = '<table/>' if rnd.random() < 0.05 else ''
+            divs.append('<div annotateRef="%s" annotateType="commentary"><reference>c%s</reference>%s</div>'
+                        % (ref, k, table))
+        xml = '<osisText>%s</osisText>' % ''.join(divs)
+        for no_nonadj in [False, True]:
+            try:
+                legacy = _resolve_overlapping(xml, 'legacy', no_nonadj)
+            except AssertionError:
+                continue  # legacy resolver refuses some inconsistent inputs
+            assert _resolve_overlapping(xml, 'intervals', no_nonadj) == legacy
+            compared += 1
+    assert compared > 60
+
+def test_comment_records():
+    osistext = BeautifulSoup("""
+        <osisText>
+        <div annotateRef="Gen.1.1-Gen.1.4" annotateType="commentary"><reference>blah1</reference></div>
+        <div annotateRef="Gen.1.1" annotateType="commentary"><reference>blah2</reference></div>
+        <div annotateRef="Gen.1.3" annotateType="commentary"><reference>blah3</reference></div>
+        </osisText>
+    """, 'xml')
+
+    s = Commentary(options)
+    s.root_soup = osistext
+    s.osistext = osistext.find('osisText')
+    s.expand_all_ranges()
+    first, merged, third = s._comments_in_document_order()
+    assert str(first.orig_verses) == 'Gen.1.1-Gen.1.4'
+    s.fix_overlapping_ranges()
+    assert merged.replaced_by is first
+    assert first.orig_ref == 'Gen.1.1-Gen.1.4 Gen.1.1'
+    assert str(first.verses) == 'Gen.1.1-Gen.1.2'
+    assert str(s.verse_comment_dict[Ref('Gen.1.4')].verses) == 'Gen.1.4'
+    assert third.links == {first}
+    assert first.tag['annotateRef'] == 'Gen.1.1 Gen.1.2'
+    title, osis_ref = s._link_summary(first)
+    assert title == 'blah1blah2...' and osis_ref.endswith(':Gen.1.1')
+    s._add_reference_link(third, merged)
+    assert third.links == {first}
+    assert len(third.tag.find('list', cls='reference_links').find_all('item')) == 1
+
+OVERLAPPING_FIXTURE = """
+    <osisText>
+    <div annotateRef="Gen.1.1-Gen.1.4" annotateType="commentary"><reference>blah1</reference></div>
+    <div annotateRef="Gen.1.2" annotateType="commentary"><reference>blah2</reference></div>
+    <div annotateRef="Gen.1.4-Gen.1.6" annotateType="commentary"><reference>blah4</reference></div>
+    <div annotateRef="Gen.1.30-Gen.2.3" annotateType="commentary"><reference>blah5</reference></div>
+    </osisText>
+"""
+
+def _fixed_commentary(collapse_ranges):
+    class collapse_options(options):
+        pass
+    collapse_options.collapse_ranges = collapse_ranges
+    s = Commentary(collapse_options)
+    for div in BeautifulSoup(OVERLAPPING_FIXTURE, 'xml').find_all('div'):
+        s.osistext.append(div)
+    s.expand_all_ranges()
+    s.fix_overlapping_ranges()
+    s.finalize()
+    return s
+
+def test_collapse_ranges():
+    refs = [d['annotateRef'] for d in _fixed_commentary(True).osistext.find_all('div', annotateType='commentary')]
+    assert refs == ['Gen.1.1', 'Gen.1.3', 'Gen.1.2', 'Gen.1.4-Gen.1.6', 'Gen.1.30-Gen.2.3']
+    refs = [d['annotateRef'] for d in _fixed_commentary(False).osistext.find_all('div', annotateType='commentary')]
+    assert refs == ['Gen.1.1', 'Gen.1.3', 'Gen.1.2', 'Gen.1.4 Gen.1.5 Gen.1.6', 'Gen.1.30 Gen.1.31 Gen.2.1 Gen.2.2 Gen.2.3']
+
+def test_collapse_ranges_test_epub(tmp_path):
+    import io
+    outputs = []
+    for collapse in [False, True]:
+        c = _read_test_epub_commentary(tmp_path / 'test.epub', collapse_ranges=collapse)
+        output = io.BytesIO()
+        c.write_osis(output)
+        outputs.append(make_soup(output.getvalue()).find_all('div', annotateType='commentary'))
+    refs = [[d['annotateRef'] for d in divs] for divs in outputs]
+    assert refs[0] == ['Gen.1.1 Gen.1.2 Gen.1.3', 'Gen.1.4', 'Gen.2.1', 'Exod.1.1', 'Exod.1.3 Exod.1.4 Exod.1.5',
+                       'Exod.1.2']
+    assert refs[1] == ['Gen.1.1-Gen.1.3', 'Gen.1.4', 'Gen.2.1', 'Exod.1.1', 'Exod.1.3-Exod.1.5', 'Exod.1.2']
+    for ref, collapsed_ref in zip(*refs):
+        assert expand_ranges(ref, verse_set=True) == expand_ranges(collapsed_ref, verse_set=True)
+    assert [d.contents for d in outputs[0]] == [d.contents for d in outputs[1]]
+
+@pytest.mark.skipif(not shutil.which('osis2mod'), reason='osis2mod (libsword tools) not installed')
+def test_collapse_ranges_osis2mod(tmp_path):
+    modules = []
+    for collapse in [False, True]:
+        osis_file = tmp_path / ('collapse_%s.xml' % collapse)
+        osis_file.write_text(str(_fixed_commentary(collapse).root_soup), encoding='utf-8')
+        module_dir = tmp_path / ('module_%s' % collapse)
+        module_dir.mkdir()
+        subprocess.check_call(['osis2mod', str(module_dir), str(osis_file), '-v', 'NRSV', '-z', '-b', '3'],
+                              stdout=subprocess.DEVNULL)
+        modules.append({p.name: p.read_bytes() for p in module_dir.iterdir()})
+    assert modules[0] == modules[1]
+
+def test_sword_tools(tmp_path, monkeypatch):
+    import sys
+    from study2osis.main import Convert, ToolRunner
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    # fake tools: osis2mod copies its stdin and xml2gbs its input file into the module directory
+    for name, script in [('osis2mod', 'shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1] + "/out.xml", "wb"))'),
+                         ('xml2gbs', 'shutil.copyfile(sys.argv[1], sys.argv[2] + "/out.xml")')]:
+        tool = bindir / name
+        tool.write_text('#!%s\nimport sys, shutil\n%s\n' % (sys.executable, script))
+        tool.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s%s%s' % (bindir, os.pathsep, os.environ['PATH']))
+    monkeypatch.chdir(tmp_path)
+
+    class tool_options(options):
+        debug = False
+        cipher_key = None
+        commentary_writer = 'osis2mod'
+        articles_writer = 'xml2gbs'
+    convert = Convert.__new__(Convert)
+    convert.options = tool_options
+    convert.commentary = Commentary(tool_options)
+    convert.articles = Articles(tool_options, convert.commentary)
+    for d in ['commentary', 'articles']:
+        (tmp_path / d).mkdir()
+    convert._run_sword_tools(str(tmp_path / 'commentary'), str(tmp_path / 'articles'), 'osis.xml')
+    assert (tmp_path / 'commentary' / 'out.xml').read_bytes() == (tmp_path / 'osis.xml').read_bytes() == \
+        str(convert.commentary.root_soup).encode('utf-8')
+    assert (tmp_path / 'articles' / 'out.xml').read_bytes() == (tmp_path / 'articles_osis.xml').read_bytes() == \
+        str(convert.articles.root_soup).encode('utf-8')
+
+    tool_options.commentary_writer = tool_options.articles_writer = 'native'
+    monkeypatch.setenv('PATH', '')  # no tools needed
+    (tmp_path / 'commentary' / 'out.xml').unlink()
+    convert._run_sword_tools(str(tmp_path / 'commentary'), str(tmp_path / 'articles'))
+    assert sorted(p.name for p in (tmp_path / 'commentary').iterdir()) == \
+        ['nt.czs', 'nt.czv', 'nt.czz', 'ot.czs', 'ot.czv', 'ot.czz']
+    assert all((tmp_path / ('articles' + ext)).exists() for ext in ['.bdt', '.idx', '.dat'])
+
+    tools = ToolRunner()
+    tools.start('ok', [sys.executable, '-c', 'pass'])
+    tools.start('failing', [sys.executable, '-c', 'import sys; sys.exit(3)'])
+    with pytest.raises(Exception):
+        tools.wait()
+    assert tools.results['ok'][0] == 0 and tools.results['failing'][0] == 3
+
+    # after an error, tools still running are stopped
+    started = []
+    monkeypatch.setattr(ToolRunner, 'start', lambda self, *args, _start=ToolRunner.start, **kwargs:
+                        started.append(_start(self, *args, **kwargs)) or started[-1])
+    monkeypatch.setenv('PATH', '%s%s%s' % (bindir, os.pathsep, os.environ['PATH']))
+    (bindir / 'xml2gbs').write_text('#!%s\nimport time\ntime.sleep(60)\n' % sys.executable)
+    tool_options.commentary_writer = 'osis2mod'
+    tool_options.articles_writer = 'xml2gbs'
+
+    def failing_write_osis(*outputs):
+        raise RuntimeError('write failed')
+    monkeypatch.setattr(convert.commentary, 'write_osis', failing_write_osis)
+    with pytest.raises(RuntimeError):
+        convert._run_sword_tools(str(tmp_path / 'commentary'), str(tmp_path / 'articles'))
+    assert [p.args[0] for p in started] == ['xml2gbs', 'osis2mod']
+    assert all(p.poll() is not None for p in started) and started[0].returncode != 0
+
+def test_cipher_key_option():
+    from study2osis.main import Convert, option_parser, dict_to_options, Options
+
+    def set_options(*args):
+        convert = Convert.__new__(Convert)
+        convert.options = dict_to_options(option_parser().parse_args(list(args) + ['study.epub'])[0])
+        convert.options.metadata = Options({'title': 'Study Bible'})
+        convert.set_options()
+        return convert.options
+    assert set_options().cipher_key is None
+    assert set_options('--cipher_key', '').cipher_key is None
+    assert set_options('--commentary_writer', 'native').cipher_key is None
+    assert set_options('--cipher_key', 'secret').cipher_key == 'secret'
+    with pytest.raises(Exception):
+        set_options('--commentary_writer', 'native', '--cipher_key', 'secret')
+
+def _zcom_entries(s):
+    """ expected entries: verse ordinal -> content of the commentary div of the verse """
+    entries = {}
+    for div in s.find_all('div', annotateType='commentary'):
+        for v in expand_ranges(div['annotateRef'], verse_set=True):
+            entries[v.ordinal] = ''.join(str(c) for c in div.contents).encode('utf-8')
+    return entries
+
+def test_zcom_writer(tmp_path):
+    from study2osis.zcom import read_zcom, verse_index
+    assert verse_index(Ref('Gen.1.1')) == (0, 4)
+    assert verse_index(Ref('Gen.2.1')) == (0, 36)
+    assert verse_index(Ref('Matt.1.1')) == (1, 4)
+    s = _fixed_commentary(False)
+    s.write_zcom(str(tmp_path))
+    assert read_zcom(str(tmp_path)) == _zcom_entries(s.osistext)
+    # all entries are in Gen 1, i.e. in one chapter block
+    assert (tmp_path / 'ot.czs').stat().st_size == 12
+    assert (tmp_path / 'nt.czs').stat().st_size == 0
+
+def test_zcom_writer_testaments(tmp_path):
+    from study2osis.zcom import ZComWriter, read_zcom
+    writer = ZComWriter(str(tmp_path))
+    writer.set_entry(Ref('Mal.4.5'), b'end of ot')
+    writer.link_entry(Ref('Mal.4.6'), Ref('Mal.4.5'))
+    with pytest.raises(Exception):
+        writer.link_entry(Ref('Matt.1.1'), Ref('Mal.4.5'))
+    with pytest.raises(Exception):
+        writer.set_entry(Ref('Matt.1.2'), b'x' * 0x10000)
+    writer.set_entry(Ref('Matt.1.1'), b'end of ot')
+    writer.close()
+    assert read_zcom(str(tmp_path)) == {Ref(v).ordinal: b'end of ot' for v in ['Mal.4.5', 'Mal.4.6', 'Matt.1.1']}
+
+@pytest.mark.skipif(not shutil.which('osis2mod'), reason='osis2mod (libsword tools) not installed')
+def test_zcom_writer_osis2mod(tmp_path):
+    from study2osis.zcom import read_zcom
+    s = _fixed_commentary(False)
+    native_dir = tmp_path / 'native'
+    osis2mod_dir = tmp_path / 'osis2mod'
+    native_dir.mkdir()
+    osis2mod_dir.mkdir()
+    s.write_zcom(str(native_dir))
+    osis_file = tmp_path / 'commentary.xml'
+    osis_file.write_text(str(s.root_soup), encoding='utf-8')
+    subprocess.check_call(['osis2mod', str(osis2mod_dir), str(osis_file), '-v', 'NRSV', '-z', '-b', '3'],
+                          stdout=subprocess.DEVNULL)
+    assert sorted(p.name for p in native_dir.iterdir()) == sorted(p.name for p in osis2mod_dir.iterdir())
+    native = read_zcom(str(native_dir))
+    reference = read_zcom(str(osis2mod_dir))
+    assert native.keys() == reference.keys()
+    assert native == reference
+    # same block layout and same linked verses
+    assert _zcom_index(native_dir) == _zcom_index(osis2mod_dir)
+
+def _zcom_index(path):
+    """ verse ordinal -> (testament, block, start, size) of verses with entry, and uncompressed block sizes """
+    from study2osis.bibleref import VERSE_COUNT
+    from study2osis.zcom import TESTAMENTS, VERSE_ENTRY, BLOCK_ENTRY, verse_index
+    verse_indexes = [(path / ('%s.czv' % t)).read_bytes() for t in TESTAMENTS]
+    records = {}
+    for ordinal in range(VERSE_COUNT):
+        testament, index = verse_index(Ref.from_ordinal(ordinal))
+        if (index + 1) * VERSE_ENTRY.size <= len(verse_indexes[testament]):
+            record = VERSE_ENTRY.unpack_from(verse_indexes[testament], index * VERSE_ENTRY.size)
+            if record[2]:
+                records[ordinal] = (testament,) + record
+    block_sizes = [[size for _, _, size in BLOCK_ENTRY.iter_unpack((path / ('%s.czs' % t)).read_bytes())]
+                   for t in TESTAMENTS]
+    return records, block_sizes
+
+def _read_test_epub_commentary(path, **extra_options):
+    import zipfile
+    _studynotes_epub(path)
+    c = Commentary(dict(commentary_work_id='ESVN', commentary_images_path='', metadata={}, bible_work_id='ESV',
+                        images=True, **extra_options))
+    with zipfile.ZipFile(path) as z:
+        c.read_studynotes(z)
+        c.expand_all_ranges()
+        c.read_cross_references(z)
+    c.fix_overlapping_ranges()
+    c.finalize()
+    return c
+
+def test_zcom_writer_round_trip(tmp_path):
+    import io
+    from study2osis.zcom import read_zcom
+    c = _read_test_epub_commentary(tmp_path / 'test.epub')
+    module_dir = tmp_path / 'module'
+    module_dir.mkdir()
+    c.write_zcom(str(module_dir))
+    output = io.BytesIO()
+    c.write_osis(output)
+    osis = make_soup(output.getvalue())
+    entries = read_zcom(str(module_dir))
+    assert entries == _zcom_entries(osis)
+    assert sorted(str(Ref.from_ordinal(o)) for o in entries) == \
+        ['Exod.1.1', 'Exod.1.2', 'Exod.1.3', 'Exod.1.4', 'Exod.1.5', 'Gen.1.1', 'Gen.1.2', 'Gen.1.3', 'Gen.1.4', 'Gen.2.1']
+    # verses of a comment are linked to the entry of its first verse
+    records, block_sizes = _zcom_index(module_dir)
+    for div in osis.find_all('div', annotateType='commentary'):
+        verses = expand_ranges(div['annotateRef'], verse_set=True)
+        assert len({records[v.ordinal] for v in verses}) == 1
+    assert len(set(records.values())) == len(osis.find_all('div', annotateType='commentary'))
+    # the blocks hold exactly the distinct entries
+    for testament, sizes in enumerate(block_sizes):
+        assert sizes == [sum(size for t, b, _, size in set(records.values()) if (t, b) == (testament, block))
+                         for block in range(len(sizes))]
+    assert block_sizes[1] == []
+
+LXML_PARSER_FIXTURE = b"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<!-- comment --><html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<body epub:type="bodymatter" xml:lang="en">
+  <p class="study-note" id="n01001001">x&amp;y <![CDATA[<cdata>]]>\t <i>i</i> \n <?pi data?>
+    <span class="smallcap">ord</span><!-- inside --></p>  \n</body></html>"""
+
+def test_lxml_parser():
+    a = make_soup(LXML_PARSER_FIXTURE)
+    b = make_soup(LXML_PARSER_FIXTURE, parser='lxml')
+    assert str(a) == str(b)
+    assert [repr(i) for i in a.descendants] == [repr(i) for i in b.descendants]
+    assert [repr(i) for i in list(a.descendants)[-1].previous_elements] == \
+           [repr(i) for i in list(b.descendants)[-1].previous_elements]
+    assert [(t.prefix, t.namespace, t.attrs) for t in a.find_all()] == \
+           [(t.prefix, t.namespace, t.attrs) for t in b.find_all()]
+    assert b.find('p', class_='study-note').span.previous_sibling == a.find('p', class_='study-note').span.previous_sibling
+
+def test_parse_only():
+    for parse_only in ['span', ('p', {'class': 'study-note'}), 'nothing']:
+        a = make_soup(LXML_PARSER_FIXTURE, parse_only=parse_only)
+        b = make_soup(LXML_PARSER_FIXTURE, parser='lxml', parse_only=parse_only)
+        assert [repr(i) for i in a.descendants] == [repr(i) for i in b.descendants]
+    p = make_soup(LXML_PARSER_FIXTURE, parser='lxml', parse_only=('p', {'class': 'study-note'})).contents[0]
+    assert str(p) == str(make_soup(LXML_PARSER_FIXTURE).find('p'))
+    assert [t.name for t in make_soup(LXML_PARSER_FIXTURE, parse_only='span').contents] == ['span']
+
+def test_lxml_parser_doctype_and_pi():
+    # doctype is built from its name and ids (not from the root element), and a PI without data
+    # keeps the separating space, as in BeautifulSoup
+    data = (b'<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" '
+            b'"http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n<html><?empty?><p/></html><?after?>')
+    a = make_soup(data)
+    b = make_soup(data, parser='lxml')
+    assert str(a) == str(b)
+    assert [repr(i) for i in a.contents] == [repr(i) for i in b.contents]
+    assert b.contents[0] == 'svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd"'
+    assert b.html.contents[0] == 'empty '
+
+def test_write_soup():
+    import io
+    from study2osis.soupwriter import write_soup
+    soup = make_soup(LXML_PARSER_FIXTURE)
+    p = soup.find('p')
+    p['title'] = 'a "quoted" & <b>'
+    p['alt'] = 'both \'quotes\' "here"'
+    p.append(soup.new_tag('cell', add=1))
+    outputs = [io.BytesIO(), io.BytesIO()]
+    write_soup(soup, outputs, chunk_size=10)
+    assert outputs[0].getvalue() == outputs[1].getvalue() == str(soup).encode('utf-8')
+    output = io.BytesIO()
+    write_soup(p, [output])
+    assert output.getvalue() == str(p).encode('utf-8')
+
+def _studynotes_epub(path):
+    import zipfile
+    html = '<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml"><body>%s</body></html>'
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('OEBPS/Text/gen-studynotes.xhtml', html % (
+            '<h1 id="gen-studynotes">Studynotes for Genesis</h1>'
+            '<p class="study-note" id="n01001001-01001003"><strong>1:1-3</strong> Note <span class="smallcap">Lord</span> '
+            '<a href="gen-text.xhtml#v01001002">v. 2</a>.</p>'
+            '<p class="study-note-continue">Continued.</p>'
+            '<p class="study-note" id="n01002001">Note with <a href="exod-studynotes.xhtml#n02001001">link</a>.</p>'))
+        z.writestr('OEBPS/Text/exod-studynotes.xhtml', html % (
+            '<p class="study-note-continue">Continued from Genesis.</p>'
+            '<p class="outline-1" id="n02001001-02001005"><span class="outline-1">1:1-5</span> Outline</p>'))
+        z.writestr('OEBPS/Text/gen-crossrefs.xhtml', html % (
+            '<p class="crossref"><a href="gen-text.xhtml#v01001001">1:1</a> <i>Ps. 33:6</i></p>'
+            '<p class="crossref"><a href="gen-text.xhtml#v01001004">1:4</a> Ps. 1:1</p>'))
+        z.writestr('OEBPS/Text/exod-crossrefs.xhtml', html % (
+            '<p class="crossref"><a href="exod-text.xhtml#v02001002">1:2</a> Gen. 1:1</p>'))
+
+def test_parallel_jobs(tmp_path):
+    import zipfile
+    _studynotes_epub(tmp_path / 'test.epub')
+    results = []
+    for jobs in [1, 2]:
+        c = Commentary(dict(commentary_work_id='ESVN', commentary_images_path='', metadata={}, bible_work_id='ESV',
+                            images=True, jobs=jobs))
+        with zipfile.ZipFile(tmp_path / 'test.epub') as z:
+            c.read_studynotes(z)
+            c.expand_all_ranges()
+            c.read_cross_references(z)
+        c.fix_overlapping_ranges()
+        results.append(str(c.root_soup))
+    assert results[0] == results[1]
+    assert 'Continued from Genesis' in results[0] and 'ESV: ' in results[0]
+
+ALL_FIXES_FIXTURE = """<div class="object"><h3>Chart</h3><p><span class="bible-version">esv</span> \
+<a href="ESV_text.xhtml#v01001001">1:1</a> <strong>s</strong><sup>1</sup><i></i><em>e <i>it</i></em>\
+<span class="crossref-letter">a</span><span class="time">t</span></p><ul><li>x<br/></li></ul>\
+<table><colgroup><col/></colgroup><tr><th>h</th><th>h</th></tr><tr><td rowspan="2">a</td><td>b</td></tr>\
+<tr><td>c</td></tr></table><img src="../Images/a.jpg"/></div>"""
+
+ALL_FIXES_RESULT = """<div class="object"><title>Chart</title><div type="paragraph">ESV \
+<reference osisRef="ESV:Gen.1.1">1:1</reference> <hi type="bold">s</hi><hi type="super">1</hi>\
+<hi type="bold">e <hi type="italic">it</hi></hi><hi type="super">a</hi><span class="time">t</span></div>\
+<list><item>x<lb/></item></list><table><colgroup><col/></colgroup>\
+<row><cell role="label">h</cell><cell role="label">h</cell></row><row><cell>a</cell><cell>b</cell></row>\
+<row><cell add="1"> </cell><cell>c</cell></row></table><figure src="images/a.jpg"/></div>"""
+
+def test_all_fixes():
+    c = Commentary(dict(commentary_work_id='ESVN', commentary_images_path='images/', metadata={}, bible_work_id='ESV',
+                        images=True))
+    c.current_filename = 'f.xhtml'
+    soup = BeautifulSoup(ALL_FIXES_FIXTURE, 'xml')
+    c._all_fixes(soup.div)
+    assert str(soup.div) == ALL_FIXES_RESULT
+    assert c.tag_data.get(soup.title, 'origFile') == 'f.xhtml'
+    assert [t.name for t in soup.find_all() if c.tag_data.get(t, 'unwrap')] == ['span', 'colgroup', 'col']
+    assert c.images == ['a.jpg']
+
+def test_linkmap_and_finalize():
+    s = Commentary(options)
+    soup = BeautifulSoup(
+        '<div annotateType="commentary" annotateRef="Gen.1.1" origFile="OEBPS/Text/gen.xhtml" postpone="1">'
+        '<div id="n01001001"><span unwrap="1">x</span> '
+        '<reference postpone="1" origRef="gen.xhtml#n01001001">a</reference> '
+        '<reference postpone="1" origRef="gen.xhtml#missing"><hi unwrap="1">b</hi></reference></div></div>', 'xml')
+    s.tag_data.from_attributes(soup)
+    assert 'origFile' not in soup.div.attrs and s.tag_data.get(soup.div, 'postpone') is True
+    s.osistext.append(soup.div)
+    s.expand_all_ranges()
+    linkmap = {}
+    s.collect_linkmap(linkmap)
+    assert linkmap == {'gen.xhtml#n01001001': 'ESVN:Gen.1.1'}
+    s.finalize(linkmap)
+    assert str(s.osistext.div) == ('<div annotateRef="Gen.1.1" annotateType="commentary"><div>x '
+                                   '<reference osisRef="ESVN:Gen.1.1">a</reference> [b]</div></div>')
+
+def test_adjust_studynotes():
+    c = Commentary(options)
+    body = BeautifulSoup(
+        '<body><div annotateType="commentary" annotateRef="Gen.1.31"/>'
+        '<div annotateType="commentary" annotateRef="Gen.2.1-Gen.2.3"/><p>continue</p>'
+        '<div annotateType="commentary" annotateRef="Gen.2.4"/><div class="object chart">chart</div>'
+        '<div annotateType="commentary" annotateRef="Gen.2.4"/></body>', 'xml').body
+    c.tag_data.set(body.find('div', class_='object chart'), move_to_first_verse=True)
+    rootlevel_tags = body.find_all(recursive=False)
+    for t in rootlevel_tags:
+        c.osistext.append(t.extract())
+    c._adjust_studynotes(rootlevel_tags)
+    comments = c.osistext.find_all('div', annotateType='commentary')
+    assert [d.text for d in comments] == ['', 'continuechart', '', '']
+    assert c.first_comments[Ref('Gen.2.4')] is comments[2]
+
+    a = Articles(options, c)
+    article = BeautifulSoup('<div><title>Article</title><p>text</p></div>', 'xml').div
+    a._move_to_studynote(article, 'Gen.2.4')
+    assert comments[2].div is article
+
+def test_genbook_paths():
+    s = Articles(options, None)
+    s.current_filename = 'OEBPS/Text/article.xhtml'
+    for title in ['Concordance', 'Other']:
+        body = BeautifulSoup('<body><h1>%s</h1><h2>Section</h2><p id="p1">text</p>'
+                             '<h3>Sub</h3><p id="p2">text</p></body>' % title, 'xml').body
+        s._process_html_body(body)
+        s.articles.append(body)
+        s.article_ids.setdefault(body['osisID'], body)
+    concordance = BeautifulSoup('<body><p class="concordance-section">A</p><p id="p3">Aaron</p></body>',
+                                'xml').body
+    try:
+        s._manual_fixes(concordance)
+    except Articles.ExceptionalProcessing:
+        pass
+    assert concordance.parent is s.article_ids['Concordance']
+    s._set_section_ids()
+    linkmap = {}
+    s.collect_linkmap(linkmap)
+    assert linkmap == {'article.xhtml#p1': 'ESVN:Articles/Other/Section',
+                       'article.xhtml#p2': 'ESVN:Articles/Other/Section',
+                       'article.xhtml#p3': 'ESVN:Articles/Concordance/A'}
+
+POST_PROCESS_FIXTURE = """<body>
+<h1>Article</h1><p>Intro with <a href="x.xhtml#y">link</a></p>
+<div class="passagetitle"><p>Passage</p></div>
+<h2>First section</h2><div epub:type="x" type="note"><p>typed</p></div>
+<h3>Sub <i>one</i> text</h3><p>sub text</p><div><p>untyped div</p></div>
+<h3>Sub two</h3><ul><li>item</li></ul>
+<h2>Second section</h2><p>second</p>
+</body>"""
+
+POST_PROCESS_RESULT = (
+    '\n<div osisID="Book introductions" type="book"/><div osisID="Articles" type="book"/>'
+    '<div osisID="Uncategorized resources" type="book"><p><title>Table of Contents</title><list><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 1">Article 1</reference><list><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 1/First section">First section</reference>'
+    '</item><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 1/Second section">Second section</reference>'
+    '</item></list></item><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 2">Article 2</reference><list><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 2/First section">First section</reference>'
+    '</item><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 2/Second section">Second section</reference>'
+    '</item></list></item></list></p><div osisID="Article 1" type="chapter">\n<title>Article 1</title>'
+    '<p>Intro with [link]</p>\n<p>Passage</p>\n<p><title>Table of Contents</title><list><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 1/First section">First section</reference>'
+    '</item><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 1/Second section">Second section</reference>'
+    '</item></list></p><div osisID="First section" type="section"><title>First section</title>'
+    '<div type="note"><p>typed</p></div>\n<p><hi type="italic">one</hi><hi type="bold">Sub  text</hi></p>'
+    '<p>sub text</p><p>untyped div</p>\n<p><hi type="bold">Sub two</hi></p><list><item>item</item>'
+    '</list>\n</div><div osisID="Second section" type="section"><title>Second section</title>'
+    '<p>second</p>\n</div></div><div osisID="Article 2" type="chapter">\n<title>Article 2</title>'
+    '<p>Intro with [link]</p>\n<p>Passage</p>\n<p><title>Table of Contents</title><list><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 2/First section">First section</reference>'
+    '</item><item>'
+    '<reference osisRef="ESVN:Uncategorized resources/Article 2/Second section">Second section</reference>'
+    '</item></list></p><div osisID="First section" type="section"><title>First section</title>'
+    '<div type="note"><p>typed</p></div>\n<p><hi type="italic">one</hi><hi type="bold">Sub  text</hi></p>'
+    '<p>sub text</p><p>untyped div</p>\n<p><hi type="bold">Sub two</hi></p><list><item>item</item>'
+    '</list>\n</div><div osisID="Second section" type="section"><title>Second section</title>'
+    '<p>second</p>\n</div></div></div></osisText>'
+)
+
+def _post_processed_articles():
+    s = Articles(options, None)
+    s.current_filename = 'OEBPS/Text/article.xhtml'
+    for title in ['Article 2', 'Article 1']:
+        body = BeautifulSoup(POST_PROCESS_FIXTURE.replace('Article', title), 'xml').body
+        s._process_html_body(body)
+        s.other.append(body)
+    s._set_section_ids()
+    s.post_process()
+    s.finalize()
+    return s
+
+def test_articles_post_process():
+    s = _post_processed_articles()
+    result = str(s.osistext)
+    assert result[result.index('</header>') + len('</header>'):] == POST_PROCESS_RESULT
+
+def test_genbook_writer(tmp_path):
+    from study2osis.rawgenbook import read_genbook
+    s = _post_processed_articles()
+    s.write_genbook(str(tmp_path / 'articles'))
+    entries = read_genbook(str(tmp_path / 'articles'))
+    assert list(entries) == ['Full Table of Contents', 'Book introductions', 'Articles', 'Uncategorized resources',
+                             'Uncategorized resources/Article 1', 'Uncategorized resources/Article 1/First section',
+                             'Uncategorized resources/Article 1/Second section', 'Uncategorized resources/Article 2',
+                             'Uncategorized resources/Article 2/First section',
+                             'Uncategorized resources/Article 2/Second section']
+    assert entries['Articles'] == b''
+    assert entries['Uncategorized resources/Article 2/Second section'] == \
+        b'<title>Second section</title><p>second</p>\n'
+    assert entries['Uncategorized resources'].startswith(b'<p><title>Table of Contents</title>')
+    tree = _genbook_tree(str(tmp_path / 'articles'))
+    assert [key for key, _, _ in tree] == list(entries)
+    assert tree[5] == ('Uncategorized resources/Article 1/First section', 'Uncategorized resources/Article 1', True)
+
+@pytest.mark.skipif(not shutil.which('xml2gbs'), reason='xml2gbs (libsword tools) not installed')
+def test_genbook_writer_xml2gbs(tmp_path):
+    from study2osis.rawgenbook import read_genbook
+    s = _post_processed_articles()
+    s.write_genbook(str(tmp_path / 'native'))
+    osis_file = tmp_path / 'articles.xml'
+    osis_file.write_text(str(s.root_soup), encoding='utf-8')
+    subprocess.check_call(['xml2gbs', str(osis_file), str(tmp_path / 'xml2gbs')], stdout=subprocess.DEVNULL)
+    native = read_genbook(str(tmp_path / 'native'))
+    reference = read_genbook(str(tmp_path / 'xml2gbs'))
+    assert set(native) == set(reference)
+    assert native == reference
+    assert _genbook_tree(str(tmp_path / 'native')) == _genbook_tree(str(tmp_path / 'xml2gbs'))
+
+def _genbook_tree(path):
+    """ (key, parent key, has entry) of the nodes of a RawGenBook module, in tree and sibling order """
+    import struct
+    from study2osis.rawgenbook import NODE_OFFSETS, IDX_ENTRY
+    with open(path + '.idx', 'rb') as f:
+        idx = f.read()
+    with open(path + '.dat', 'rb') as f:
+        dat = f.read()
+
+    def node(idx_offset):
+        start = IDX_ENTRY.unpack_from(idx, idx_offset)[0]
+        parent, next_sibling, first_child = NODE_OFFSETS.unpack_from(dat, start)
+        name_end = dat.index(b'\0', start + NODE_OFFSETS.size)
+        name = dat[start + NODE_OFFSETS.size:name_end].decode('utf-8')
+        return name, parent, next_sibling, first_child, struct.unpack_from('<H', dat, name_end + 1)[0] > 0
+
+    tree = []
+    keys = {0: ''}
+    stack = [node(0)[3]]
+    while stack:
+        idx_offset = stack.pop()
+        if idx_offset < 0:
+            continue
+        name, parent, next_sibling, first_child, has_entry = node(idx_offset)
+        parent_key = keys[parent]
+        keys[idx_offset] = '%s/%s' % (parent_key, name) if parent_key else name
+        tree.append((keys[idx_offset], parent_key, has_entry))
+        stack.append(next_sibling)
+        stack.append(first_child)
+    return tree
+
+def test_crossref_empty_comment_order(tmp_path):
+    import zipfile
+    html = '<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml"><body>%s</body></html>'
+    crossref = '<p class="crossref"><a href="gen-text.xhtml#v%s">x</a> Ps. 1:1</p>'
+    with zipfile.ZipFile(tmp_path / 'test.epub', 'w') as z:
+        z.writestr('OEBPS/Text/gen-studynotes.xhtml', html % (
+            '<p class="study-note" id="n01001001">Note 1</p><p class="study-note" id="n01001005">Note 5</p>'))
+        z.writestr('OEBPS/Text/gen-crossrefs.xhtml', html % ''.join(crossref % v for v in
+                   ['01001004', '01001003', '01001005', '01001002', '01002005', '01002001']))
+    c = Commentary(dict(commentary_work_id='ESVN', commentary_images_path='', metadata={}, bible_work_id='ESV',
+                        images=True))
+    with zipfile.ZipFile(tmp_path / 'test.epub') as z:
+        c.read_studynotes(z)
+        c.expand_all_ranges()
+        c.read_cross_references(z)
+    refs = [d['annotateRef'] for d in c.osistext.find_all('div', annotateType='commentary', recursive=False)]
+    assert refs == ['Gen.1.1', 'Gen.1.2', 'Gen.1.3', 'Gen.1.4', 'Gen.1.5', 'Gen.2.1', 'Gen.2.5']
+    assert sum(1 for r in c.comment_records.values() if r.crossrefs) == 6
+    c.fix_overlapping_ranges()
+    assert len(c.osistext.find_all('list', cls='reference_links')) == 6